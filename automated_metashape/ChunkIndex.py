@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Peter Betlem
+@institution: University Centre in Svalbard, Svalbard
+@year: 2023
+
+Cached indexes of the cameras and markers of a Metashape chunk, shared by
+the processing stages instead of walking chunk.cameras (and reading camera
+attributes through the Metashape API) over and over, and the bulk import of
+GCP projections and reference coordinates built on them.
+
+Metashape itself is not imported here, so that everything can be used (and
+benchmarked) with stand-in chunk objects.
+"""
+
+# import standard libs
+import os
+import logging
+
+class chunk_index():
+    """
+    Cached indexes of the cameras and markers of a chunk: cameras by label 
+    (case-insensitive), photo path (normalised, see photo_key, including the
+    photos of every plane of multi-plane cameras) and enabled/aligned state,
+    and markers by label (exact). If labels occur more than once, the first
+    camera or marker is used.
+    
+    chunk.cameras is traversed once, and the attributes of the cameras are 
+    read once when an index is first used. Changes made through the index 
+    (relabel, set_enabled, marker) keep it up to date; after the chunk is
+    changed otherwise (e.g. by addPhotos or alignCameras), the affected 
+    indexes have to be invalidated.
+    """
+    def __init__(self, chunk):
+        self.chunk = chunk
+        self.invalidate()
+
+    def invalidate(self, *indexes):
+        """
+        Invalidates the given indexes ("labels", "paths", "photos", "enabled",
+        "aligned", "markers"), or everything (including the list of cameras)
+        if none are given.
+        """
+        if not indexes:
+            self.all_cameras = list(self.chunk.cameras)
+            self._cache = {}
+        for name in indexes:
+            self._cache.pop(name, None)
+
+    def _cached(self, name, build):
+        if name not in self._cache:
+            self._cache[name] = build()
+        return self._cache[name]
+
+    @property
+    def cameras(self):
+        """
+        {lowercase label: camera}
+        """
+        def build():
+            cameras = {}
+            for camera in self.all_cameras:
+                cameras.setdefault(camera.label.lower(), camera)
+            return cameras
+        return self._cached("labels", build)
+
+    @property
+    def camera_paths(self):
+        """
+        {camera: photo path}
+        """
+        return self._cached("paths", lambda: {camera: camera.photo.path for camera in self.all_cameras})
+
+    @property
+    def photos(self):
+        """
+        {photo key: camera}, including the photos of all planes (e.g. the
+        bands of a multispectral camera), which map onto the master camera.
+        """
+        def build():
+            photos = {}
+            for camera, path in self.camera_paths.items():
+                photos.setdefault(photo_key(path), camera)
+                for plane in getattr(camera, "planes", None) or ():
+                    if plane.photo is not None:
+                        photos.setdefault(photo_key(plane.photo.path), camera)
+            return photos
+        return self._cached("photos", build)
+
+    @property
+    def enabled(self):
+        """
+        {camera: enabled}
+        """
+        return self._cached("enabled", lambda: {camera: camera.enabled for camera in self.all_cameras})
+
+    @property
+    def aligned(self):
+        """
+        {camera: aligned}
+        """
+        return self._cached("aligned", lambda: {camera: camera.transform is not None for camera in self.all_cameras})
+
+    @property
+    def enabled_cameras(self):
+        return [camera for camera, enabled in self.enabled.items() if enabled]
+
+    @property
+    def unaligned_cameras(self):
+        """
+        The enabled cameras that are not aligned, i.e. that failed alignment
+        (disabled cameras are not aligned by alignCameras at all).
+        """
+        return [camera for camera in self.enabled_cameras if not self.aligned[camera]]
+
+    @property
+    def markers(self):
+        """
+        {label: marker}
+        """
+        def build():
+            markers = {}
+            for marker in self.chunk.markers:
+                markers.setdefault(marker.label, marker)
+            return markers
+        return self._cached("markers", build)
+
+    def camera(self, label):
+        return self.cameras.get(label.lower())
+
+    def new_photos(self, photo_files):
+        """
+        Returns the photo_files that are not yet the photo of a camera.
+        """
+        return [path for path in photo_files if photo_key(path) not in self.photos]
+
+    def cameras_of(self, photo_files):
+        """
+        Returns the cameras of photo_files (skipping photos without camera),
+        each camera once, also if several of the photos are its planes.
+        """
+        keys = (photo_key(path) for path in photo_files)
+        return list(dict.fromkeys(self.photos[key] for key in keys if key in self.photos))
+
+    def marker(self, label, create = False):
+        """
+        Returns the marker with label, adding it to the chunk if it does not
+        exist and create is set.
+        """
+        marker = self.markers.get(label)
+        if marker is None and create:
+            marker = self.chunk.addMarker()
+            marker.label = label
+            self.markers[label] = marker
+        return marker
+
+    def relabel(self, labels, cameras = None):
+        """
+        Sets the labels of the cameras (all cameras by default, in the order 
+        of all_cameras).
+        """
+        for camera, label in zip(self.all_cameras if cameras is None else cameras, labels):
+            camera.label = label
+        self.invalidate("labels")
+
+    def set_enabled(self, cameras, enabled = True):
+        for camera in cameras:
+            camera.enabled = enabled
+            if "enabled" in self._cache:
+                self._cache["enabled"][camera] = enabled
+
+    def update_alignment(self, cameras):
+        """
+        Re-reads the alignment state of the given cameras only, e.g. after
+        (re)aligning a subset of the cameras without resetting the others.
+        """
+        if "aligned" in self._cache:
+            for camera in cameras:
+                self._cache["aligned"][camera] = camera.transform is not None
+
+def photo_key(path):
+    """
+    Returns the normalised path of a photo, to compare the paths of the photos
+    of cameras with paths of photos on disk.
+    """
+    return os.path.normcase(os.path.abspath(str(path))).replace("\\", "/")
+
+def marker_label(value):
+    """
+    Returns the label of a marker id as read from a table, i.e. 12 for 12,
+    12.0 or "12", and other labels (e.g. 6X6_250_12) as is.
+    """
+    try:
+        return str(int(float(value)))
+    except (TypeError, ValueError):
+        return str(value).strip()
+
+def add_marker_projections(index, marker_pixel_data, projection, logger = logging.getLogger(__name__)):
+    """
+    Adds the marker projections of marker_pixel_data (with label, camera, x
+    and y columns) to the chunk of index, creating missing markers. The
+    projection function converts the (x, y) pixel coordinates into a marker
+    projection, i.e. Metashape.Marker.Projection((x, y), True).
+
+    Projections on photos that are not cameras of the chunk are skipped and
+    reported once. Returns the number of projections added.
+    """
+    cameras = marker_pixel_data["camera"].str.lower().map(index.cameras)
+    missing = cameras.isna().to_numpy()
+    if missing.any():
+        labels = marker_pixel_data.loc[missing, "camera"].unique()
+        logger.warning(f"Skipped {missing.sum()} marker projections on {len(labels)} photos that are " +\
+                       f"not cameras of the project: {', '.join(labels[:5])}" +\
+                       (f" (and {len(labels) - 5} more)." if len(labels) > 5 else "."))
+
+    found = ~missing
+    labels = marker_pixel_data["label"].to_numpy()[found]
+    markers = {label: index.marker(label, create = True) for label in set(labels)}
+    for camera, label, x, y in zip(
+            cameras.to_numpy()[found], labels,
+            marker_pixel_data["x"].to_numpy()[found], marker_pixel_data["y"].to_numpy()[found]
+            ):
+        markers[label].projections[camera] = projection(float(x), float(y))
+    return int(found.sum())
+
+def set_marker_references(index, marker_coordinate_data, accuracy):
+    """
+    Sets the reference locations of the markers in marker_coordinate_data
+    (with marker, x, y and z columns, and optionally dx, dy and dz accuracy
+    columns; accuracy otherwise), creating missing markers.
+    """
+    columns = [marker_coordinate_data[name].to_numpy() for name in ["marker", "x", "y", "z"]]
+    if all(name in marker_coordinate_data.columns for name in ["dx", "dy", "dz"]):
+        accuracies = zip(*[marker_coordinate_data[name].astype(float).to_numpy() for name in ["dx", "dy", "dz"]])
+    else:
+        accuracies = [tuple(accuracy)] * len(marker_coordinate_data)
+
+    for label, x, y, z, marker_accuracy in zip(*columns, accuracies):
+        marker = index.marker(marker_label(label), create = True)
+        marker.reference.location = (float(x), float(y), float(z))
+        marker.reference.accuracy = tuple(float(a) for a in marker_accuracy)
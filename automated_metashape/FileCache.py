@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Peter Betlem
+@institution: University Centre in Svalbard, Svalbard
+@year: 2023
+
+Persistent per-file cache of results computed from photos, shared by the
+marker detection, the photo pre-scan and the local image quality estimate,
+so that repeat runs only process new or changed photos.
+
+The cache is a JSON file of {"settings": settings, "entries": entries}. The
+entries are keyed by file path and hold the file size, modification time
+(and optionally a content hash) next to the cached result (the payload).
+All entries are discarded if the settings used to compute them changed.
+"""
+
+# import standard libs
+import os
+import json
+import hashlib
+import logging
+from pathlib import Path
+
+class file_cache():
+    """
+    Per-file cache of the payload (e.g. markers) of files, validated against
+    the file size and modification time and, if use_hash is set, a content
+    hash, so that a touched but otherwise unchanged file remains valid.
+    """
+    def __init__(self, path, settings, payload, use_hash = False, name = "cache",
+                 logger = logging.getLogger(__name__)):
+
+        self.path = Path(path)
+        self.settings = settings
+        self.payload = payload
+        self.use_hash = use_hash
+        self.name = name
+        self.logger = logger
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0, "pruned": 0}
+        self.entries = {}
+
+        try:
+            with open(self.path, 'r') as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            self.logger.warning(f"Unable to read {self.name} {self.path}, rebuilding...")
+            return
+
+        if data.get("settings") != self.settings:
+            self.logger.info(f"Settings changed, invalidating {self.name}.")
+            self.stats["invalidations"] += len(data.get("entries", {}))
+            return
+        self.entries = data["entries"]
+
+    def entry(self, filename):
+        """
+        Returns the cached entry of a file without validating it, e.g. to
+        validate it in a pool worker instead (see unchanged).
+        """
+        return self.entries.get(os.path.abspath(filename))
+
+    def lookup(self, filename):
+        """
+        Returns the cached payload of the file, or None if the file is not in
+        the cache or has changed since it was cached.
+        """
+        key = os.path.abspath(filename)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            stat = None
+        if stat and unchanged(entry, stat):
+            self.stats["hits"] += 1
+            return entry[self.payload]
+
+        if stat and self.use_hash and entry["size"] == stat.st_size and \
+                entry.get("hash") == file_hash(filename):
+            entry["mtime"] = stat.st_mtime_ns
+            self.stats["hits"] += 1
+            return entry[self.payload]
+
+        del self.entries[key]
+        self.stats["invalidations"] += 1
+        return None
+
+    def store(self, filename, value, stat = None):
+        """
+        Stores the payload of a file, given its os.stat result if known.
+        """
+        stat = stat or os.stat(filename)
+        entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns, self.payload: value}
+        if self.use_hash:
+            entry["hash"] = file_hash(filename)
+        self.entries[os.path.abspath(filename)] = entry
+
+    def prune(self):
+        """
+        Removes all entries of files that no longer exist.
+        """
+        missing = [key for key in self.entries if not os.path.exists(key)]
+        for key in missing:
+            del self.entries[key]
+        self.stats["pruned"] += len(missing)
+
+    def save(self):
+        # write to a temporary file first so an interrupted run cannot corrupt the cache
+        tmp_file = self.path.with_suffix(".tmp")
+        with open(tmp_file, 'w') as file:
+            json.dump({"settings": self.settings, "entries": self.entries}, file)
+        os.replace(tmp_file, self.path)
+        self.logger.info(f"Stored {len(self.entries)} files in {self.name} {self.path}.")
+
+def unchanged(entry, stat):
+    """
+    Returns whether a cached entry matches the os.stat result of its file.
+    """
+    return entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns
+
+def file_hash(filename, blocksize = 2**20):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
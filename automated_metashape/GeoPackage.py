@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Peter Betlem
+@institution: University Centre in Svalbard, Svalbard
+@year: 2023
+
+Minimal GeoPackage reader for point layers, e.g. a database of surveyed GCPs.
+GeoPackages are SQLite databases, read here with the standard library only.
+Spatial queries use the R-tree index of the geometry column (the
+gpkg_rtree_index extension), so that only the features within the queried
+bounds are read, rather than the full table.
+"""
+
+# import standard libs
+import struct
+import sqlite3
+import logging
+from pathlib import Path
+
+# import calc libs
+import numpy as np
+import pandas as pd
+
+# size of the envelope of a GeoPackage geometry blob, by envelope indicator
+_ENVELOPE_SIZE = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}
+
+def parse_gpkg_point(blob):
+    """
+    Returns the (x, y, z) of a GeoPackage point geometry blob (the GP header,
+    followed by a WKB point), with z NaN for 2D points, or None if the
+    geometry is empty or not a point.
+    """
+    if blob is None or bytes(blob[:2]) != b'GP':
+        return None
+    flags = blob[3]
+    if flags & 0x10: # empty geometry
+        return None
+    wkb = bytes(blob[8 + _ENVELOPE_SIZE[(flags >> 1) & 0x07]:])
+
+    endian = '<' if wkb[0] == 1 else '>'
+    kind = struct.unpack(endian + 'I', wkb[1:5])[0]
+    # ISO WKB (1001, 2001, 3001) or extended WKB (high bit flags) dimensions
+    has_z = (kind & 0x80000000) or (kind & 0xFFFF) // 1000 in (1, 3)
+    has_m = (kind & 0x40000000) or (kind & 0xFFFF) // 1000 in (2, 3)
+    if (kind & 0xFFFF) % 1000 != 1:
+        return None
+    n = 2 + bool(has_z) + bool(has_m)
+    values = struct.unpack(endian + 'd' * n, wkb[5:5 + 8 * n])
+    return values[0], values[1], values[2] if has_z else np.nan
+
+class geopackage():
+    """
+    Read-only access to the point layers of a GeoPackage.
+    """
+    def __init__(self, path, logger = logging.getLogger(__name__)):
+        self.path = Path(path)
+        self.logger = logger
+        if not self.path.is_file():
+            raise FileNotFoundError(f"GeoPackage {self.path} not found.")
+        self.connection = sqlite3.connect(f"{self.path.resolve().as_uri()}?mode=ro", uri = True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.close()
+
+    def layers(self):
+        """
+        Returns {table name: (geometry column, geometry type, srs id)} of all
+        feature layers.
+        """
+        rows = self.connection.execute(
+            "SELECT table_name, column_name, geometry_type_name, srs_id FROM gpkg_geometry_columns"
+            ).fetchall()
+        return {table: (column, kind, srs_id) for table, column, kind, srs_id in rows}
+
+    def crs(self, table):
+        """
+        Returns the CRS of a layer as an authority string, e.g. EPSG:32633.
+        """
+        organization, code = self.connection.execute(
+            "SELECT organization, organization_coordsys_id FROM gpkg_spatial_ref_sys WHERE srs_id = ?",
+            (self.layers()[table][2],)
+            ).fetchone()
+        return f"{organization.upper()}:{code}"
+
+    def point_layer(self, table = None):
+        """
+        Returns the name of table if it is a feature layer, or of the first
+        point layer if table is None.
+        """
+        layers = self.layers()
+        if table is None:
+            points = [name for name, (_, kind, _) in layers.items() if kind.upper() in ("POINT", "MULTIPOINT", "GEOMETRY")]
+            if not points:
+                raise ValueError(f"No point layers in {self.path.name}.")
+            return points[0]
+        if table not in layers:
+            raise ValueError(f"Layer {table} not found in {self.path.name}, " +\
+                             f"choose from {', '.join(layers)}.")
+        return table
+
+    def _primary_key(self, table):
+        for _, name, _, _, _, pk in self.connection.execute(f'PRAGMA table_info("{table}")'):
+            if pk:
+                return name
+        return "rowid"
+
+    def _rtree(self, table, column):
+        """
+        Returns the name of the R-tree index of the geometry column, if any.
+        """
+        name = f"rtree_{table}_{column}"
+        exists = self.connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+            ).fetchone()
+        return name if exists else None
+
+    def read_points(self, table = None, bounds = None):
+        """
+        Reads the point features of table (by default the first point layer)
+        with all their attributes, plus the x, y and z of the geometry (or of
+        a z attribute for 2D points). If
+        bounds, a list of (minx, miny, maxx, maxy) in the layer CRS, is given,
+        only the features within any of the bounds are read, through the
+        R-tree index if the layer has one.
+        """
+        table = self.point_layer(table)
+        column = self.layers()[table][0]
+        pk = self._primary_key(table)
+        rtree = self._rtree(table, column)
+
+        if bounds is None:
+            queries = [(f'SELECT * FROM "{table}"', ())]
+        elif rtree:
+            queries = [
+                (f'SELECT t.* FROM "{table}" AS t JOIN "{rtree}" AS r ON t."{pk}" = r.id ' +\
+                 'WHERE r.minx <= ? AND r.maxx >= ? AND r.miny <= ? AND r.maxy >= ?',
+                 (maxx, minx, maxy, miny))
+                for minx, miny, maxx, maxy in bounds
+                ]
+        else:
+            self.logger.warning(f"Layer {table} has no spatial index, reading all features.")
+            queries = [(f'SELECT * FROM "{table}"', ())]
+
+        rows, names = {}, None
+        for query, parameters in queries:
+            cursor = self.connection.execute(query, parameters)
+            names = [d[0] for d in cursor.description]
+            key = names.index(pk) if pk in names else None
+            for i, row in enumerate(cursor):
+                rows[row[key] if key is not None else (query, i)] = row
+
+        df = pd.DataFrame(list(rows.values()), columns = names)
+        points = np.array(
+            [parse_gpkg_point(blob) or (np.nan, np.nan, np.nan) for blob in df[column]], dtype = float
+            ).reshape(-1, 3)
+        df = df.drop(columns = column)
+        if "z" in df: # 2D points with a z attribute
+            points[:, 2] = np.where(np.isnan(points[:, 2]), pd.to_numeric(df["z"], errors = "coerce"), points[:, 2])
+        df["x"], df["y"], df["z"] = points[:, 0], points[:, 1], points[:, 2]
+        df = df[df["x"].notna()]
+
+        # the R-tree holds rounded envelopes, so the bounds are checked exactly
+        if bounds is not None:
+            inside = np.zeros(len(df), dtype = bool)
+            for minx, miny, maxx, maxy in bounds:
+                inside |= df["x"].between(minx, maxx).to_numpy() & df["y"].between(miny, maxy).to_numpy()
+            df = df[inside]
+
+        self.logger.info(f"Read {len(df)} points from layer {table} of {self.path.name}" +\
+                         (" using its spatial index." if bounds is not None and rtree else "."))
+        return df.reset_index(drop = True)
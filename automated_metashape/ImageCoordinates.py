@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Peter Betlem
+@institution: University Centre in Svalbard, Svalbard
+@year: 2023
+
+Storage of the GCP image coordinate table (marker, camera, x, y, and the
+ArUcO dictionary of each marker), written by the marker detection and read by
+AutomatedProcessing.add_gcps.
+
+The default CSV format is kept for compatibility with external tools (e.g.
+R/prep_gcps.R), and only gets a fifth (dictionary) column if markers of
+several dictionaries are detected. The columnar formats (npz, parquet, feather) store typed
+columns in a directory of parts, {table}.{format}/part-XXXXX.{format}, so that
+incremental detection runs can append a part with the rows of new or changed
+images only. When reading, the rows of every camera are taken from the last
+part that contains the camera. Appending removes the parts that no longer
+hold the latest rows of any camera, and compacts the store into a single part
+once it has more than max_parts parts, or holds rows of photos that no longer
+exist (see image_coordinate_store.retain).
+"""
+
+# import standard libs
+import os
+import re
+import logging
+import importlib.util
+from pathlib import Path
+
+# import calc libs
+import numpy as np
+import pandas as pd
+
+output_formats = ("csv", "npz", "parquet", "feather")
+
+_columns = ["marker", "camera", "x", "y"]
+_dtypes = {"marker": np.int32, "x": np.float32, "y": np.float32}
+_part_pattern = re.compile(r"^part-(\d+)\.(npz|parquet|feather)$")
+
+# marker id of the row that records an image without markers in an appended
+# part, so that rows of a previous part are superseded for that camera
+_NO_MARKERS = -1
+
+class image_coordinate_store():
+    """
+    Writer of the image coordinate table, used as a context manager. Rows are
+    written per image with write(camera, records).
+
+    CSV rows are streamed into the file. Rows of the columnar formats are
+    collected and written as a single part when closing the store; unless
+    append is set, existing parts are removed at that point. In append mode,
+    the store is compacted into a single part once it has more than
+    max_parts parts.
+    
+    dictionaries maps the dictionary tags of the records onto their names, 
+    which are stored in the dictionary column.
+    """
+    def __init__(self, path, output_format = "csv", append = False, dictionaries = None,
+                 max_parts = 8, logger = logging.getLogger(__name__)):
+        if output_format not in output_formats:
+            raise ValueError(f"Unknown output_format '{output_format}', " +\
+                             f"choose from {', '.join(output_formats)}.")
+        if append and output_format == "csv":
+            raise ValueError("Appending is only supported by the columnar output formats.")
+        if output_format in ("parquet", "feather"):
+            if importlib.util.find_spec("pyarrow") is None:
+                raise ImportError(f"The {output_format} output format requires pyarrow.")
+
+        self.output_format = output_format
+        self.append = append
+        self.dictionaries = dictionaries or {}
+        self.tagged = bool(self.dictionaries) and (output_format != "csv" or len(self.dictionaries) > 1)
+        self.max_parts = max_parts
+        self.logger = logger
+        self.path = Path(path).with_suffix("." + output_format)
+        self.row_count = 0
+        self.cameras = None
+
+    @property
+    def exists(self):
+        """
+        Whether the store already contains data to append to.
+        """
+        return bool(_list_parts(self.path)) if self.output_format != "csv" else self.path.exists()
+
+    def __enter__(self):
+        if self.output_format == "csv":
+            self._file = open(self.path, mode = 'w', newline = '')
+        else:
+            self._cameras, self._records = [], []
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.output_format == "csv":
+            self._file.close()
+        elif exc_type is None:
+            self._write_part()
+
+    def retain(self, cameras):
+        """
+        Restricts an appended store to the given camera labels (e.g. of all
+        photos that still exist) when closing it: rows of other cameras, kept
+        in earlier parts, are removed by compacting the store.
+        """
+        self.cameras = set(cameras)
+
+    def write(self, camera, records):
+        """
+        Writes the marker records (a structured array with marker, x, y and
+        dictionary fields) of a single image. In append mode, an image without
+        markers is recorded as well, to supersede its rows in earlier parts.
+        """
+        if self.output_format == "csv":
+            df = pd.DataFrame(
+                {
+                    'marker': records["marker"],
+                    'camera': camera,
+                    'x': records["x"],
+                    'y': records["y"]
+                    }
+                )
+            if self.tagged:
+                df["dictionary"] = [self.dictionaries.get(d, str(d)) for d in records["dictionary"]]
+            df.to_csv(self._file, header = False, index = False, sep = ',')
+        elif len(records):
+            self._cameras.append(camera)
+            self._records.append(records)
+        elif self.append:
+            empty = np.zeros(1, dtype = records.dtype)
+            empty["marker"], empty["x"], empty["y"] = _NO_MARKERS, np.nan, np.nan
+            self._cameras.append(camera)
+            self._records.append(empty)
+        self.row_count += len(records)
+
+    def _write_part(self):
+        parts = _list_parts(self.path)
+        if self.append and parts and not self._records:
+            self.logger.info(f"No new image coordinates to append to {self.path.name}.")
+            return
+        self.path.mkdir(parents = True, exist_ok = True)
+
+        records = np.concatenate(self._records) if self._records else \
+            np.empty(0, dtype = [("marker", np.int32), ("x", np.float32), ("y", np.float32), ("dictionary", np.int16)])
+        df = pd.DataFrame(
+            {
+                'marker': records["marker"],
+                'camera': np.repeat(np.array(self._cameras, dtype = str), [len(r) for r in self._records]),
+                'x': records["x"],
+                'y': records["y"]
+                }
+            ).astype(_dtypes)
+        columns = _columns
+        if self.tagged:
+            tags = pd.Series(records["dictionary"])
+            df["dictionary"] = tags.map(self.dictionaries).fillna(tags.astype(str)).astype(str)
+            columns = _columns + ["dictionary"]
+
+        index = max(parts) + 1 if (self.append and parts) else 0
+        part = Path(self.path, f"part-{index:05d}.{self.output_format}")
+        tmp_file = self._write_frame(df, columns, part)
+        if not self.append:
+            for stale in parts.values():
+                os.remove(stale)
+        os.replace(tmp_file, part)
+        self.logger.info(f"Wrote {len(df)} image coordinates to {part.name} " +\
+                         f"({'appended to' if self.append and parts else 'in'} {self.path.name}).")
+        if self.append and parts:
+            self._compact()
+
+    def _write_frame(self, df, columns, part):
+        """
+        Writes the columns of df to a temporary file next to part, which is
+        returned (to be moved into place).
+        """
+        tmp_file = part.with_suffix(".tmp")
+        if self.output_format == "npz":
+            with open(tmp_file, 'wb') as file:
+                np.savez(file, **{
+                    column: df[column].to_numpy(dtype = str if column in ("camera", "dictionary") else None)
+                    for column in columns
+                    })
+        else:
+            # dictionary encoded camera labels
+            for column in ("camera", "dictionary"):
+                if column in df:
+                    df[column] = df[column].astype("category")
+            if self.output_format == "parquet":
+                df[columns].to_parquet(tmp_file, index = False)
+            else:
+                df[columns].reset_index(drop = True).to_feather(tmp_file)
+        return tmp_file
+
+    def _compact(self):
+        """
+        Removes the parts that no longer hold the latest rows of any camera 
+        (e.g. after appending the rows of all photos), and rewrites the valid
+        rows into a single part if more than max_parts parts remain or rows of
+        cameras outside retain(cameras) are left.
+        """
+        parts = _list_parts(self.path)
+        df = _read_parts(parts)
+        current = df[df["part"] == df.groupby("camera")["part"].transform("max")]
+        removed = self.cameras is not None and not set(current["camera"]) <= self.cameras
+        stale = [index for index in parts if index not in set(current["part"])]
+        
+        if not removed and len(parts) - len(stale) <= self.max_parts:
+            for index in stale:
+                os.remove(parts[index])
+            if stale:
+                self.logger.info(f"Removed {len(stale)} superseded parts of {self.path.name}.")
+            return
+        
+        if self.cameras is not None:
+            current = current[current["camera"].isin(self.cameras)]
+        current = current[current["marker"] != _NO_MARKERS].astype(_dtypes)
+        columns = _columns + (["dictionary"] if "dictionary" in current else [])
+        part = Path(self.path, f"part-{max(parts) + 1:05d}.{self.output_format}")
+        tmp_file = self._write_frame(current.copy(), columns, part)
+        for old in parts.values():
+            os.remove(old)
+        os.replace(tmp_file, part)
+        self.logger.info(f"Compacted {len(parts)} parts of {self.path.name} into {part.name} " +\
+                         f"({len(current)} image coordinates).")
+
+def _list_parts(path):
+    """
+    Returns {index: path} of the parts of a columnar store.
+    """
+    parts = {}
+    if Path(path).is_dir():
+        for entry in os.scandir(path):
+            match = _part_pattern.match(entry.name)
+            if match:
+                parts[int(match.group(1))] = Path(entry.path)
+    return parts
+
+def _read_part(part):
+    if part.suffix == ".npz":
+        with np.load(part, allow_pickle = False) as data:
+            return pd.DataFrame({column: data[column] for column in data.files})
+    if part.suffix == ".parquet":
+        return pd.read_parquet(part)
+    return pd.read_feather(part)
+
+def _read_parts(parts):
+    """
+    Reads all parts ({index: path}) into a single DataFrame, with the index of
+    the part of every row in the part column.
+    """
+    df = pd.concat(
+        [_read_part(parts[index]).assign(part = index) for index in sorted(parts)],
+        ignore_index = True
+        )
+    df["camera"] = df["camera"].astype(str)
+    return df
+
+def find_image_coordinates(prepared_dir, name = "gcp_imagecoords_table"):
+    """
+    Returns the path of the most recently written image coordinate table
+    in prepared_dir, in any of the output formats, or None if there is none.
+    """
+    candidates = [
+        path for path in (Path(prepared_dir, f"{name}.{fmt}") for fmt in output_formats)
+        if path.is_file() or _list_parts(path)
+        ]
+    if not candidates:
+        return None
+    return max(candidates, key = lambda path: os.stat(path).st_mtime_ns)
+
+def read_image_coordinates(path):
+    """
+    Reads an image coordinate table (a CSV file or a columnar store) into a
+    DataFrame with typed marker, camera, x and y columns, and the dictionary
+    column (None for tables without dictionary tags).
+    """
+    path = Path(path)
+    if path.suffix == ".csv":
+        df = pd.read_csv(path, header = None, dtype = str)
+        df.columns = (_columns + ["dictionary"])[:len(df.columns)]
+    else:
+        parts = _list_parts(path)
+        if not parts:
+            raise FileNotFoundError(f"No image coordinates stored in {path}.")
+        df = _read_parts(parts)
+
+        # only the rows of the last part containing a camera are valid
+        latest = df.groupby("camera")["part"].transform("max")
+        df = df[(df["part"] == latest) & (df["marker"] != _NO_MARKERS)]
+
+    if "dictionary" not in df:
+        df["dictionary"] = None
+    df["dictionary"] = df["dictionary"].astype(object).where(df["dictionary"].notna(), None)
+    return df[_columns + ["dictionary"]].astype({**_dtypes, "camera": str}).reset_index(drop = True)
+
+def marker_labels(df, primary = None):
+    """
+    Returns the Metashape marker labels of the rows of an image coordinate 
+    table. Markers of the primary dictionary (by name, e.g. DICT_4X4_50) and
+    of untagged tables are labeled by their id, so that they match the 
+    gcp_table; markers of other dictionaries are labeled {dictionary}_{id},
+    e.g. 6X6_250_12. Without a primary dictionary, the dictionary of a table
+    with a single dictionary is the primary one.
+    """
+    labels = df["marker"].astype(str)
+    tagged = df["dictionary"].notna()
+    if primary is None and df.loc[tagged, "dictionary"].nunique() == 1:
+        primary = df.loc[tagged, "dictionary"].iloc[0]
+    other = tagged & (df["dictionary"] != primary)
+    labels[other] = df.loc[other, "dictionary"].str.replace("DICT_", "", regex = False) + "_" + labels[other]
+    return labels
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Peter Betlem
+@institution: University Centre in Svalbard, Svalbard
+@year: 2023
+
+Minimal readers for the headers of JPEG, TIFF (incl. BigTIFF and DNG) and
+PNG photos, to obtain e.g. the image dimensions, camera (EXIF) metadata or
+the GPS position without decoding the image itself.
+"""
+
+# import standard libs
+import os
+import mmap
+import struct
+
+# JPEG start of frame markers, which contain the image dimensions
+_JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+# TIFF field types: (struct format, size in bytes)
+_TIFF_TYPES = {
+    1: ("B", 1), 2: ("s", 1), 3: ("H", 2), 4: ("L", 4), 5: ("LL", 8),
+    6: ("b", 1), 7: ("s", 1), 8: ("h", 2), 9: ("l", 4), 10: ("ll", 8),
+    11: ("f", 4), 12: ("d", 8), 13: ("L", 4),
+    16: ("Q", 8), 17: ("q", 8), 18: ("Q", 8),
+    }
+
+# the tail of a JPEG that is searched for the end of image marker first
+_JPEG_TAIL = 4096
+
+# EXIF tags read by read_image_header: {tag: key}
+_EXIF_TAGS = {
+    271: "make", 272: "model", 306: "datetime",
+    36867: "timestamp", 37386: "focal_length", 41989: "focal_length_35mm",
+    }
+
+def read_image_size(filename):
+    """
+    Returns the (width, height) of an image read from its header, or None if
+    the format is not supported or the header is unreadable.
+    """
+    try:
+        with open(filename, 'rb') as file:
+            head = file.read(8)
+            if head[:2] == b'\xff\xd8':
+                return _jpeg_size(file)
+            if _tiff_header(head):
+                return _tiff_size(file, *_tiff_header(head))
+            if head == b'\x89PNG\r\n\x1a\n':
+                file.seek(16)
+                return struct.unpack('>II', file.read(8))
+    except (OSError, struct.error, ValueError):
+        pass
+    return None
+
+def _jpeg_segments(file):
+    """
+    Generator yielding the (marker, offset, length) of the JPEG segments up
+    to the start of the image data, with the file positioned at the start
+    of the segment data.
+    """
+    file.seek(2)
+    while True:
+        byte = file.read(1)
+        while byte == b'\xff':
+            byte = file.read(1)
+        if not byte:
+            return
+        marker = byte[0]
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            continue
+        length = struct.unpack('>H', file.read(2))[0] - 2
+        offset = file.tell()
+        yield marker, offset, length
+        if marker == 0xDA: # start of scan, header ends here
+            return
+        file.seek(offset + length)
+
+def _jpeg_complete(file, size):
+    """
+    Returns whether a JPEG is complete, i.e. whether its image data is
+    followed by an end of image marker. Cameras may append padding or a
+    trailer (e.g. maker notes or a preview) after the end of image, so the
+    marker is searched for in the tail of the file first, and otherwise in
+    all image data. The image data cannot contain the marker itself, as
+    0xFF bytes are stuffed there.
+    """
+    scan = None
+    for marker, offset, length in _jpeg_segments(file):
+        if marker == 0xDA:
+            scan = offset + length
+    if scan is None or scan >= size:
+        return False
+    file.seek(max(scan, size - _JPEG_TAIL))
+    if b'\xff\xd9' in file.read():
+        return True
+    with mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ) as data:
+        return data.find(b'\xff\xd9', scan) >= 0
+
+def _jpeg_size(file):
+    for marker, offset, length in _jpeg_segments(file):
+        if marker in _JPEG_SOF:
+            height, width = struct.unpack('>xHH', file.read(5))
+            return width, height
+    return None
+
+def _tiff_header(head):
+    """
+    Returns the (endian, bigtiff) of a TIFF (or BigTIFF) file from its first
+    bytes, or None if it is not a TIFF file.
+    """
+    if head[:4] in (b'II*\x00', b'MM\x00*'):
+        return '<' if head[:2] == b'II' else '>', False
+    if head[:4] in (b'II+\x00', b'MM\x00+'):
+        return '<' if head[:2] == b'II' else '>', True
+    return None
+
+def _tiff_first_ifd(file, endian, bigtiff=False):
+    """
+    Returns the offset of the first IFD of a TIFF file.
+    """
+    file.seek(8 if bigtiff else 4)
+    return struct.unpack(endian + ('Q' if bigtiff else 'L'), file.read(8 if bigtiff else 4))[0]
+
+def read_tiff_ifd(file, offset, endian, base=0, bigtiff=False):
+    """
+    Reads the TIFF image file directory at offset (relative to base, e.g. the
+    start of the EXIF block in a JPEG). Returns a dictionary of tag: value,
+    in which single values are unpacked, and the offset of the next IFD.
+    BigTIFF directories have 8 byte counts and offsets.
+    """
+    count_fmt, entry_fmt, offset_fmt = ('Q', 'HHQ8s', 'Q') if bigtiff else ('H', 'HHL4s', 'L')
+    file.seek(base + offset)
+    read = lambda fmt: struct.unpack(endian + fmt, file.read(struct.calcsize(endian + fmt)))
+    count = read(count_fmt)[0]
+    entries = [read(entry_fmt) for _ in range(count)]
+    next_offset = read(offset_fmt)[0]
+
+    tags = {}
+    for tag, kind, n, data in entries:
+        if kind not in _TIFF_TYPES:
+            continue
+        fmt, size = _TIFF_TYPES[kind]
+        if size * n > len(data):
+            file.seek(base + struct.unpack(endian + offset_fmt, data)[0])
+            data = file.read(size * n)
+        if fmt == 's':
+            tags[tag] = data[:n].split(b'\x00')[0].decode('latin-1').strip()
+            continue
+        values = struct.unpack(endian + fmt * n, data[:size * n])
+        if kind in (5, 10):
+            values = tuple(a / b if b else 0 for a, b in zip(values[::2], values[1::2]))
+        tags[tag] = values[0] if len(values) == 1 else values
+    return tags, next_offset
+
+def read_image_header(filename):
+    """
+    Reads the header and EXIF metadata of a photo without decoding the image.
+    Returns a dictionary with the width and height, the EXIF make, model, 
+    focal_length, focal_length_35mm and timestamp (None if not recorded), and
+    whether the file is complete, i.e. not truncated after the header. Raises
+    ValueError if the format is not supported or the header is unreadable.
+    """
+    try:
+        with open(filename, 'rb') as file:
+            head = file.read(8)
+            size = os.fstat(file.fileno()).st_size
+            if head[:2] == b'\xff\xd8':
+                dimensions = _jpeg_size(file)
+                complete = _jpeg_complete(file, size)
+            elif _tiff_header(head):
+                dimensions = _tiff_size(file, *_tiff_header(head))
+                complete = _tiff_extent(file, *_tiff_header(head)) <= size
+            elif head == b'\x89PNG\r\n\x1a\n':
+                file.seek(16)
+                dimensions = struct.unpack('>II', file.read(8))
+                file.seek(max(0, size - 8))
+                complete = file.read() == b'IEND\xaeB`\x82'
+            else:
+                raise ValueError("unsupported image format")
+            if not dimensions:
+                raise ValueError("no image dimensions in header")
+            metadata = _exif_metadata(file)
+    except (OSError, struct.error) as e:
+        raise ValueError(f"unreadable header ({e})")
+
+    header = {"width": dimensions[0], "height": dimensions[1], "complete": complete}
+    for key in _EXIF_TAGS.values():
+        header[key] = metadata.get(key)
+    if header["timestamp"] is None:
+        header["timestamp"] = header["datetime"]
+    del header["datetime"]
+    return header
+
+def _exif_metadata(file):
+    """
+    Returns {key: value} of the _EXIF_TAGS found in IFD0 and the EXIF IFD, 
+    ignoring (corrupt) EXIF data that cannot be read.
+    """
+    metadata = {}
+    try:
+        exif = _exif_ifd0(file)
+        if not exif:
+            return metadata
+        base, endian, offset, bigtiff = exif
+        tags, _ = read_tiff_ifd(file, offset, endian, base, bigtiff)
+        if 34665 in tags:
+            tags.update(read_tiff_ifd(file, tags[34665], endian, base, bigtiff)[0])
+    except (OSError, struct.error, ValueError):
+        return metadata
+    for tag, key in _EXIF_TAGS.items():
+        if tag in tags and tags[tag] not in ("", 0):
+            metadata[key] = tags[tag]
+    return metadata
+
+def _exif_ifd0(file):
+    """
+    Locates the EXIF data (the TIFF structure itself for TIFF/DNG files, or
+    the APP1 segment of a JPEG). Returns the (base, endian, offset of IFD0,
+    bigtiff), or None if the file has no EXIF data.
+    """
+    file.seek(0)
+    head = file.read(4)
+    if _tiff_header(head):
+        endian, bigtiff = _tiff_header(head)
+        return 0, endian, _tiff_first_ifd(file, endian, bigtiff), bigtiff
+    elif head[:2] == b'\xff\xd8':
+        for marker, offset, length in _jpeg_segments(file):
+            if marker == 0xE1 and file.read(6) == b'Exif\x00\x00':
+                base = offset + 6
+                break
+        else:
+            return None
+    else:
+        return None
+    file.seek(base)
+    header = file.read(8)
+    endian = '<' if header[:2] == b'II' else '>'
+    return base, endian, struct.unpack(endian + 'L', header[4:])[0], False
+
+def read_gps_position(filename):
+    """
+    Returns the (longitude, latitude, altitude) in decimal degrees (and
+    metres) from the EXIF GPS tags of a photo, with altitude None if it is not
+    recorded, or None if the photo has no GPS position.
+    """
+    try:
+        with open(filename, 'rb') as file:
+            exif = _exif_ifd0(file)
+            if not exif:
+                return None
+            base, endian, offset, bigtiff = exif
+            tags, _ = read_tiff_ifd(file, offset, endian, base, bigtiff)
+            if 34853 not in tags:
+                return None
+            gps, _ = read_tiff_ifd(file, tags[34853], endian, base, bigtiff)
+    except (OSError, struct.error, ValueError):
+        return None
+    if not all(tag in gps for tag in (1, 2, 3, 4)):
+        return None
+
+    def degrees(value, ref, negative):
+        value = value if isinstance(value, tuple) else (value,)
+        decimal = sum(v / 60**i for i, v in enumerate(value))
+        return -decimal if ref == negative else decimal
+
+    altitude = None
+    if 6 in gps:
+        altitude = -gps[6] if gps.get(5) == 1 else gps[6]
+    return degrees(gps[4], gps[3], 'W'), degrees(gps[2], gps[1], 'S'), altitude
+
+def _tiff_ifds(file, endian, bigtiff=False):
+    """
+    Returns the tags of the first IFD and of its SubIFDs.
+    """
+    tags, _ = read_tiff_ifd(file, _tiff_first_ifd(file, endian, bigtiff), endian, bigtiff = bigtiff)
+    ifds = [tags]
+
+    # DNG (and some TIFF) files store the full resolution image in a SubIFD,
+    # with a thumbnail in the first IFD
+    sub_ifds = tags.get(330, ())
+    for offset in (sub_ifds if isinstance(sub_ifds, tuple) else (sub_ifds,)):
+        ifds.append(read_tiff_ifd(file, offset, endian, bigtiff = bigtiff)[0])
+    return ifds
+
+def _tiff_extent(file, endian, bigtiff=False):
+    """
+    Returns the end of the image data (strips or tiles) of all images, i.e.
+    the minimum size of a complete file.
+    """
+    extent = 0
+    for tags in _tiff_ifds(file, endian, bigtiff):
+        for offsets, counts in ((273, 279), (324, 325)):
+            if offsets in tags and counts in tags:
+                as_tuple = lambda value: value if isinstance(value, tuple) else (value,)
+                extent = max([extent] + [o + c for o, c in zip(as_tuple(tags[offsets]), as_tuple(tags[counts]))])
+    return extent
+
+def _tiff_size(file, endian, bigtiff=False):
+    sizes = [(tags.get(256), tags.get(257)) for tags in _tiff_ifds(file, endian, bigtiff)]
+    sizes = [size for size in sizes if None not in size]
+    if not sizes:
+        return None
+    return max(sizes, key = lambda size: size[0] * size[1])
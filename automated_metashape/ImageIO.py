@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Peter Betlem
+@institution: University Centre in Svalbard, Svalbard
+@year: 2023
+
+Image loaders shared by the marker detection and the local image analyses
+(image quality, near-duplicate detection), which decode photos straight to
+grayscale, optionally at a reduced resolution.
+"""
+
+# import calc and image libs
+import cv2
+
+# decoding modes for the (reduced resolution) grayscale image loader
+reduced_grayscale_modes = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+    }
+
+def load_grayscale(filename, reduction=1):
+    """
+    Decodes an image straight into a single channel (grayscale) buffer,
+    optionally at 1/2, 1/4 or 1/8 of its resolution. For JPEGs the reduced
+    modes are handled by the decoder itself, without a full-resolution copy.
+    Raises IOError if the image cannot be read.
+    """
+    gray = cv2.imread(str(filename), reduced_grayscale_modes[reduction])
+    if gray is None:
+        raise IOError(f"Unable to read image {filename}.")
+    return gray
+
+def load_bgr(filename, reduction=1):
+    """
+    Decodes an image into a 3-channel BGR buffer and converts it to grayscale
+    afterwards (the original behaviour), e.g. for images that decode
+    differently directly into grayscale.
+    """
+    frame = cv2.imread(str(filename))
+    if frame is None:
+        raise IOError(f"Unable to read image {filename}.")
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    if reduction != 1:
+        gray = cv2.resize(gray, None, fx = 1/reduction, fy = 1/reduction, interpolation = cv2.INTER_AREA)
+    return gray
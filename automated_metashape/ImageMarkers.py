@@ -10,9 +10,10 @@
 import os
 import sys
 from pathlib import Path, PurePath
-import glob
-import re
+import time
+import itertools
 import logging
+from functools import partial
 
 # import calc and image libs
 import numpy as np
@@ -23,152 +24,836 @@ import logging
 
 # import multiprocessing libs
 import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+import threading
+
+try:  # not available on Windows
+    import resource
+except ImportError:
+    resource = None
+
+try:  # optional, to transform photo positions into the GCP database CRS
+    from pyproj import Transformer
+except ImportError:
+    Transformer = None
 
 ## Load custom modules and config file: slightly different depending whether running interactively or via command line
 from .read_yaml import read_yaml
+from .PhotoDiscovery import find_photos, camera_label, split_raw_photos
+from .ImageHeaders import read_image_size, read_gps_position
+from .ImageCoordinates import image_coordinate_store, marker_labels
+from .GeoPackage import geopackage
+from .FileCache import file_cache
+from .ImageIO import load_grayscale, load_bgr, reduced_grayscale_modes
+
+# OpenCV < 4.7 only has the functional ArUcO API (DetectorParameters_create,
+# detectMarkers); checked by feature, as version strings do not compare as text
+legacy_aruco_api = not hasattr(aruco, "ArucoDetector")
+
+# compact per-marker detection result, as returned by the detection workers
+marker_record = np.dtype([("marker", np.int32), ("x", np.float32), ("y", np.float32), ("dictionary", np.int16)])
+
+# corner order as returned by the OpenCV Aruco Library
+_corner_index = {"topleft": 0, "topright": 1, "bottomright": 2, "bottomleft": 3}
+
+# ArUcO detectors of the current (worker) process, see _get_detector
+_detectors = threading.local()
+
+# length of a degree of latitude (and of longitude at the equator), in metres
+_METRES_PER_DEGREE = 111320
 
 class marker_detection():
     """
     Class used for the detection of ArUcO markers from photos. Configuration 
     file setup (YML) is shared with the metashapw_workflow_functions to allow
     for interoperability.
+    
+    By default all photos in the photo_path are processed into the image
+    coordinate table. A subset of the photos (photo_files) can be processed 
+    into another image_coordinate_store (output) instead, e.g. for a shard of
+    a distributed detection (see ShardedDetection).
+    
+    The detected markers are also kept in memory, as a compact table that is
+    handed to AutomatedProcessing.add_gcps (see image_coordinates) without
+    reading back the image coordinate table.
     """
-    def __init__(self, cfg, logger = logging.getLogger(__name__)):
+    def __init__(self, cfg, logger = logging.getLogger(__name__), photo_files = None, output = None):
         
         # Internalise configuration to class
         self.cfg = cfg
         self.logger = logger
+        self.photo_files = photo_files
         
         # create output file dir for gcps, if not existing
-        self.output_file = Path(
-            self.cfg["detectGCPs"]["photo_path"],"gcps","prepared","gcp_imagecoords_table.csv"
+        self.output = output or image_coordinate_store(
+            Path(self.cfg["detectGCPs"]["photo_path"],"gcps","prepared","gcp_imagecoords_table"),
+            output_format = self.cfg["detectGCPs"].get("output_format", "csv"),
+            append = self.cfg["detectGCPs"].get("append", False),
+            max_parts = self.cfg["detectGCPs"].get("max_parts", 8),
+            dictionaries = {
+                d: dictionary_name(d) for d in aruco_dicts(self.cfg["detectGCPs"]["aruco_dict"])
+                },
+            logger = self.logger
             )
+        self.output_file = self.output.path
         _check_output_path(self.cfg["detectGCPs"]["photo_path"])
         
         self.logger.info(f"Accessing and analysing photos @ {self.cfg['photo_path']}")
         
+        self.settings = detection_settings(self.cfg)
         self.process_images()
         
     def process_images(self):
         """
         Processing all images found in the photo_path dir specified by the YML
-        configuration file. To speed things up, this step uses parallel processing
+        configuration file. To speed things up, this step uses parallel processing:
+        images are submitted to the pool in chunks and the results are streamed
+        into the output file in order of completion.
 
         """
         
         # Search all images
-        a = glob.iglob(os.path.join(self.cfg["detectGCPs"]["photo_path"],"**","*.*"))   #(([jJ][pP][gG])|([tT][iI][fF]))
-        b = [path for path in a]
-        photo_files = [x for x in b if (re.search("(.tif$)|(.jpg$)|(.TIF$)|(.JPG$)",x) and (not re.search("dem_usgs.tif",x)))]
-        
-        self.logger.info(f"Found {len(photo_files)} images for processing.")        
-        self.logger.info("Starting multiprocessing...")
-        # Start multiprocessing on all found images
-        pool = mp.Pool(mp.cpu_count())
-        
-        combined = [pool.apply(
-            _assign_marker_coordinates_on_image,
-            args = (x,
-                    self.cfg["detectGCPs"]["aruco_dict"],
-                    self.cfg["detectGCPs"]["corner"])
-            ) for x in photo_files]
-        
-        pool.close() 
-        
-        self.logger.info("Finalised multiprocessing...")
-        # drop all None entries
-        combined = list(filter(None.__ne__,combined))
-        
-        # Combine pixel coordinate lists into single dataframe (if not empty)
-        try:
-            self.image_markers = pd.concat(combined)
-        except:
+        photo_files = self.photo_files
+        if photo_files is None:
+            photo_files = find_photos(
+                self.cfg["detectGCPs"]["photo_path"],
+                max_depth = self.cfg["detectGCPs"].get("max_depth", 1),
+                manifest = self.cfg["detectGCPs"].get("photo_manifest", False),
+                logger = self.logger
+                )
+
+        # OpenCV cannot decode raw photos, see PhotoDiscovery.raw_extensions
+        photo_files, raw_files = split_raw_photos(photo_files)
+        if raw_files:
+            self.logger.warning(f"Skipping {len(raw_files)} raw photos, which cannot be decoded for " +\
+                                "marker detection; add JPEG or TIFF copies to detect their markers.")
+
+        self.logger.info(f"Found {len(photo_files)} images for processing.")
+        if self.photo_files is None:
+            # rows of deleted (or raw) photos are dropped from an appended table
+            self.output.retain(camera_label(x) for x in photo_files)
+        
+        # Only images that are new or have changed since the previous run need
+        # to be analysed if the detection cache is enabled
+        cache = None
+        if "cache" in self.cfg["detectGCPs"] and self.cfg["detectGCPs"]["cache"]["enabled"]:
+            cache = detection_cache(
+                Path(self.output_file.parent, "gcp_detection_cache.json"),
+                settings = self.settings,
+                use_hash = self.cfg["detectGCPs"]["cache"].get("hash", False),
+                logger = self.logger
+                )
+        
+        # when appending, markers served from the cache are already stored
+        skip_cached = self.output.append and self.output.exists
+        
+        self.marker_count = 0
+        self._cameras, self._records = [], []
+        self.stage_times = dict.fromkeys(["decode", "detect", "geometry", "write"], 0.0)
+        with self.output as output:
+            
+            if cache:
+                pending = []
+                for x in photo_files:
+                    markers = cache.lookup(x)
+                    if markers is None:
+                        pending.append(x)
+                    elif skip_cached:
+                        self.marker_count += len(markers)
+                        self._keep_markers(x, _as_records(markers))
+                    else:
+                        self._write_markers(x, markers, output)
+                self.logger.info(f"Detection cache: {cache.stats['hits']} hits, " +\
+                                 f"{cache.stats['misses']} misses, " +\
+                                 f"{cache.stats['invalidations']} invalidations.")
+            else:
+                pending = photo_files
+                
+            if pending:
+                self._detect_markers(pending, output, cache)
+        
+        if cache:
+            if self.cfg["detectGCPs"]["cache"].get("prune", False):
+                cache.prune()
+                self.logger.info(f"Pruned {cache.stats['pruned']} cache entries of missing files.")
+            cache.save()
+        
+        if not self.marker_count:
             self.logger.warning("No GCPs identified in image pool...")
-            raise
+            # a subset of the photos may well be without markers
+            if self.photo_files is None:
+                raise ValueError(f"No markers detected in {len(photo_files)} images.")
             
-        self.image_markers["filename"] = self.image_markers["filename"].apply(lambda x: os.path.join(
-            os.path.basename(os.path.dirname(x)),
-            os.path.basename(x)
-            ).replace("\\","/"))
-        self.image_markers.to_csv(self.output_file, mode = 'w', header = False, index = False, sep = ',')
-        self.logger.info(f'Exported pixel coordinates to {PurePath(self.cfg["detectGCPs"]["photo_path"],"gcps","prepared")} folder.')
+        self.logger.info(f'Exported pixel coordinates to {self.output.path}.')
            
-def _assign_marker_coordinates_on_image(filename,aruco_dict,corner=None):
+    def _detect_markers(self, photo_files, output, cache = None):
+        """
+        Detects the markers in all photo_files in parallel. Images are submitted
+        to the pool in chunks and the results are streamed into the output 
+        file (and cache) in order of completion.
+        
+        """
+        backend = self.cfg["detectGCPs"].get("backend", "process")
+        pool_type = _get_detection_pool(backend)
+        workers = 1 if backend == "serial" else \
+            (self.cfg["detectGCPs"].get("workers") or mp.cpu_count())
+        settings = dict(self.settings)
+        tracking = settings.pop("tracking")
+        if tracking and tracking["enabled"]:
+            # every task is a sequence of photos, returning a list of results
+            tasks = _sequence_segments(photo_files, tracking.get("segment_length", 100))
+            detect = partial(_track_markers_in_sequence, tracking = tracking, **settings)
+            chunksize = 1
+            self.logger.info(f"Tracking markers in {len(tasks)} photo sequences.")
+        else:
+            tasks = photo_files
+            detect = partial(_detect_markers_on_image, **settings)
+            chunksize = self.cfg["detectGCPs"].get("chunksize") or \
+                max(1, min(32, len(photo_files) // (4 * workers)))
+        
+        # limits the (estimated) memory of the decoded frames in flight, by
+        # holding back task submission until earlier tasks have returned
+        budget = None
+        if self.cfg["detectGCPs"].get("memory_budget_mb"):
+            budget = _memory_budget(self.cfg["detectGCPs"]["memory_budget_mb"] * 2**20)
+            costs = _estimate_task_memory(
+                tasks, self.settings, self.cfg["detectGCPs"].get("memory_per_pixel", 10)
+                )
+            tasks = budget.submit(tasks, costs)
+            chunksize = 1
+            self.logger.info(f"Limiting detection to {self.cfg['detectGCPs']['memory_budget_mb']} MB " +\
+                             f"of frames in flight (largest task {max(costs)/2**20:.0f} MB).")
+        
+        self.logger.info(f"Starting {backend} detection of {len(photo_files)} images " +\
+                         f"on {workers} workers (chunksize {chunksize})...")
+        
+        # validates the detector parameters and image loader before they are 
+        # passed to the workers
+        _init_detection_worker(self.settings["aruco_dict"], self.settings["detector_parameters"])
+        _get_image_loader(self.settings["image_loader"], self.settings["image_reduction"])
+        
+        with pool_type(workers, initializer = _init_detection_worker,
+                       initargs = (self.settings["aruco_dict"],
+                                   self.settings["detector_parameters"])) as pool:
+            try:
+                self._collect_results(pool.imap_unordered(detect, tasks, chunksize), 
+                                      len(photo_files), output, cache, budget)
+            finally:
+                # unblocks the task submission if detection is interrupted
+                if budget:
+                    budget.close()
+        
+        self.logger.info(f"Finalised {backend} detection...")
+        self.logger.info("Mean time per image: " + ", ".join(
+            f"{stage} {total/len(photo_files):.3f} s" for stage, total in self.stage_times.items()
+            ) + ".")
+        if tracking and tracking["enabled"]:
+            self.logger.info(f"Tracked markers in {self.tracked_count} images, " +\
+                             f"{len(photo_files) - self.tracked_count} images required full frame detection.")
+        if self.full_detect_time:
+            self.logger.info(f"Pyramid detection saved {(self.full_detect_time - self.stage_times['detect'])/len(photo_files):.3f} s " +\
+                             f"per image ({self.full_detect_time/len(photo_files):.3f} s at full resolution).")
+        if budget:
+            self.logger.info(f"Peak estimated memory of frames in flight: {budget.peak/2**20:.0f} MB.")
+        if resource and backend == "process":
+            self.logger.info(f"Peak memory of the largest worker: {_peak_worker_memory()/2**20:.0f} MB.")
+        
+    def _collect_results(self, results, n_images, output, cache = None, budget = None):
+        """
+        Streams the (filename, records, timings) results of the detection pool
+        into the output file and cache, in order of completion.
+        """
+        self.full_detect_time = self.tracked_count = 0
+        progress_interval = max(1, n_images // 20)
+        start = time.perf_counter()
+        
+        # tracked sequences return a list of results
+        results = (r for result in results for r in (result if isinstance(result, list) else [result]))
+        for i, (filename, records, timings) in enumerate(results, 1):
+            if budget:
+                budget.release(filename)
+            for stage in ("decode", "detect", "geometry"):
+                self.stage_times[stage] += timings.get(stage, 0)
+            self.tracked_count += timings.get("tracked", False)
+            if "detect_full" in timings:
+                self.full_detect_time += timings["detect_full"]
+                self.logger.debug(f"Pyramid detection on {filename} took {timings['detect']:.2f} s, " +\
+                                  f"saving {timings['detect_full'] - timings['detect']:.2f} s.")
+            if cache:
+                cache.store(filename, records)
+            if records is not None:
+                self._write_markers(filename, records, output)
+            
+            if i % progress_interval == 0 or i == n_images:
+                elapsed = time.perf_counter() - start
+                self.logger.info(f"Processed {i}/{n_images} images " +\
+                                 f"({i/elapsed:.2f} images/s, {self.marker_count} markers).")
+        
+    def _write_markers(self, filename, records, output):
+        """
+        Appends the markers of a single image to the (open) output store.
+        """
+        start = time.perf_counter()
+        records = _as_records(records)
+        output.write(camera_label(filename), records)
+        self._keep_markers(filename, records)
+        self.marker_count += len(records)
+        self.stage_times["write"] += time.perf_counter() - start
+    
+    def _keep_markers(self, filename, records):
+        if len(records):
+            self._cameras.append(camera_label(filename))
+            self._records.append(records)
+    
+    @property
+    def image_coordinates(self):
+        """
+        The detected markers as a DataFrame with the columns of 
+        read_image_coordinates (marker, camera, x, y, dictionary) and the
+        Metashape marker labels (label, see marker_labels). Cameras are
+        labeled like add_photos labels them ({folder}/{filename}).
+        """
+        dictionaries = {d: dictionary_name(d) for d in self.settings["aruco_dict"]}
+        records = np.concatenate(self._records) if self._records else np.empty(0, dtype = marker_record)
+        tags = pd.Series(records["dictionary"])
+        df = pd.DataFrame(
+            {
+                'marker': records["marker"],
+                'camera': np.repeat(np.array(self._cameras, dtype = str), [len(r) for r in self._records]),
+                'x': records["x"],
+                'y': records["y"],
+                'dictionary': tags.map(dictionaries).fillna(tags.astype(str)).astype(object),
+                }
+            )
+        df["label"] = marker_labels(df, dictionary_name(self.settings["aruco_dict"][0]))
+        return df
+        
+class detection_cache(file_cache):
+    """
+    Persistent per-image cache of detected markers (see FileCache), stored 
+    next to the image coordinate table. Entries are validated against the 
+    file size and modification time (and optionally a content hash), as well
+    as against the detection settings (aruco_dict, corner, etc.) used to 
+    create them.
+    """
+    def __init__(self, path, settings, use_hash = False, logger = logging.getLogger(__name__)):
+        super().__init__(path, settings, "markers", use_hash, "detection cache", logger)
+    
+    def store(self, filename, records):
+        """
+        Stores the detection result (marker records or None) of an image.
+        """
+        super().store(filename, [] if records is None else records.tolist())
+        
+class _memory_budget():
+    """
+    Backpressure for the detection pool: tasks are only submitted as long as
+    the estimated memory of all tasks in flight stays within the budget (in
+    bytes). A task exceeding the budget by itself is submitted once nothing 
+    else is in flight. Costs are released by the filename of the (last) image
+    of a task, as returned by the workers.
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.in_flight = 0
+        self.peak = 0
+        self.closed = False
+        self._pending = {}
+        self._condition = threading.Condition()
+        
+    def submit(self, tasks, costs):
+        """
+        Generator yielding the tasks, blocking until their cost fits the budget.
+        """
+        for task, cost in zip(tasks, costs):
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self.closed or not self.in_flight or self.in_flight + cost <= self.budget
+                    )
+                if self.closed:
+                    return
+                self.in_flight += cost
+                self.peak = max(self.peak, self.in_flight)
+                self._pending[task[-1] if isinstance(task, list) else task] = cost
+            yield task
+            
+    def release(self, filename):
+        with self._condition:
+            if filename in self._pending:
+                self.in_flight -= self._pending.pop(filename)
+                self._condition.notify_all()
+                
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+            
+def _estimate_task_memory(tasks, settings, memory_per_pixel=10):
+    """
+    Estimates the peak memory (in bytes) of each detection task (an image or
+    a tracked sequence of images) from the image dimensions in the headers:
+    the decoded frame plus memory_per_pixel bytes of detector buffers per
+    analysed pixel. Images with unreadable headers are assigned the largest
+    estimate of the other images.
+    """
+    decode = 4 if settings["image_loader"] == "bgr" else 1
+    detect = memory_per_pixel
+    if settings["pyramid"] and settings["pyramid"]["enabled"]:
+        detect *= settings["pyramid"].get("scale", 0.25) ** 2
+    
+    sizes = {}
+    for task in tasks:
+        for filename in (task if isinstance(task, list) else [task]):
+            size = read_image_size(filename)
+            if size:
+                sizes[filename] = size[0] * size[1] / settings["image_reduction"]**2 * (decode + detect)
+    default = max(sizes.values(), default = 0)
+    
+    # a sequence is tracked one image at a time
+    return [
+        max(sizes.get(filename, default) for filename in (task if isinstance(task, list) else [task]))
+        for task in tasks
+        ]
+
+def _peak_worker_memory():
+    """
+    Returns the peak resident memory (in bytes) of the largest (terminated) 
+    child process.
+    """
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def _as_records(records):
+    """
+    Converts a cached [marker, x, y] list of an image into marker records.
+    """
+    if not isinstance(records, np.ndarray):
+        records = np.array([tuple(m) for m in records], dtype = marker_record)
+    return records
+
+def detection_settings(cfg):
+    """
+    Collects the detectGCPs parameters that affect the detection results.
+    These are passed on to the detection workers and are used to validate
+    the detection cache.
+    """
+    return {
+        "aruco_dict": [int(d) for d in aruco_dicts(cfg["detectGCPs"]["aruco_dict"])],
+        "corner": cfg["detectGCPs"]["corner"],
+        "pyramid": cfg["detectGCPs"].get("pyramid"),
+        "detector_parameters": cfg["detectGCPs"].get("detector_parameters"),
+        "image_loader": cfg["detectGCPs"].get("image_loader", "grayscale"),
+        "image_reduction": cfg["detectGCPs"].get("image_reduction", 1),
+        "tracking": cfg["detectGCPs"].get("tracking"),
+        }
+
+def _detect_markers_on_image(filename, **settings):
+    """
+    Pool worker wrapper returning the filename and detection timings alongside
+    the detected markers, as results are returned in order of completion.
+    """
+    timings = {}
+    records = _assign_marker_coordinates_on_image(filename, timings = timings, **settings)
+    return filename, records, timings
+
+def _assign_marker_coordinates_on_image(filename,aruco_dict,corner=None,pyramid=None,timings=None,
+                                        detector_parameters=None,image_loader="grayscale",image_reduction=1):
     """
     Standalone script for the identification of ArUcO markers in an image 
-    (filename). The specified aruco_dict is cross-chcked vs those found in the 
-    opencv specifications. The corner parameter specifies which corner of the
-    marker is reported back.   
+    (filename). The specified aruco_dict (or list of dictionaries, which are 
+    all detected on the same decoded image) is cross-chcked vs those found in
+    the opencv specifications. The corner parameter specifies which corner of
+    the marker is reported back.   
+    
+    If the pyramid dictionary is enabled, the markers are first detected on 
+    a downscaled copy of the image and refined at full resolution (see 
+    _detect_marker_corners_pyramid). Detection times are added to the 
+    timings dictionary, if supplied. The OpenCV detector is configured with
+    the detector_parameters dictionary (see _get_detector). The image is 
+    decoded by image_loader at 1/image_reduction of its resolution (see 
+    _get_image_loader); marker positions always refer to the full resolution.
+    
+    Returns the marker records (see _marker_positions), or None if no markers
+    were found.
 
     """
     
     # opencv magic
-    frame = cv2.imread(filename)
-    if cv2.getVersionString() < "4.7":
-        parameters =  aruco.DetectorParameters_create()
+    start = time.perf_counter()
+    gray = _get_image_loader(image_loader, image_reduction)(filename)
+    if timings is not None:
+        timings["decode"] = time.perf_counter() - start
+    
+    # all dictionaries are detected on the same decoded image
+    records = []
+    for dictionary in aruco_dicts(aruco_dict):
+        corners, ids = _detect_marker_corners_on_frame(gray, dictionary, pyramid, detector_parameters, timings)
+        
+        start = time.perf_counter()
+        records.append(_corners_to_records(corners, ids, corner, image_reduction, dictionary))
+        if timings is not None:
+            timings["geometry"] = timings.get("geometry", 0) + time.perf_counter() - start
+    return _concatenate_records(records)
+
+def _detect_marker_corners_on_frame(gray, aruco_dict, pyramid=None, detector_parameters=None, timings=None):
+    """
+    Detects the markers of a single dictionary on the full frame, using the 
+    pyramid approach if enabled. Detection times are added to the timings 
+    dictionary, if supplied.
+    """
+    start = time.perf_counter()
+    if pyramid and pyramid["enabled"]:
+        corners, ids = _detect_marker_corners_pyramid(
+            gray, aruco_dict, 
+            scale = pyramid.get("scale", 0.25),
+            margin = pyramid.get("margin", 0.5),
+            fallback = pyramid.get("fallback", True),
+            detector_parameters = detector_parameters
+            )
+        if timings is not None:
+            timings["detect"] = timings.get("detect", 0) + time.perf_counter() - start
+            if pyramid.get("report_savings", False):
+                start = time.perf_counter()
+                _detect_marker_corners(gray, aruco_dict, detector_parameters)
+                timings["detect_full"] = timings.get("detect_full", 0) + time.perf_counter() - start
+    else:
+        corners, ids = _detect_marker_corners(gray, aruco_dict, detector_parameters)
+        if timings is not None:
+            timings["detect"] = timings.get("detect", 0) + time.perf_counter() - start
+    return corners, ids
+
+def _corners_to_records(corners, ids, corner=None, image_reduction=1, aruco_dict=0):
+    """
+    Converts the detected corners of a (reduced resolution) image into the
+    full resolution marker records, tagged with the aruco_dict they were
+    detected with, or None if no markers were found.
+    """
+    if isinstance(ids, (np.ndarray, np.generic) ):
+        if image_reduction != 1:
+            # maps pixel centres of the reduced image onto the full resolution
+            corners = [(c + np.float32(0.5)) * np.float32(image_reduction) - np.float32(0.5) for c in corners]
+        records = _marker_positions(corners, ids, corner)
+        records["dictionary"] = aruco_dict
+        return records
+    else:
+        return None
+
+def _concatenate_records(records):
+    """
+    Concatenates the marker records of several dictionaries, or returns None 
+    if no markers were found with any of them.
+    """
+    records = [r for r in records if r is not None]
+    if not records:
+        return None
+    return records[0] if len(records) == 1 else np.concatenate(records)
+
+def aruco_dicts(aruco_dict):
+    """
+    Returns the configured aruco_dict, a single dictionary or a list, as a list.
+    """
+    return list(aruco_dict) if isinstance(aruco_dict, (list, tuple)) else [aruco_dict]
+
+def dictionary_name(aruco_dict):
+    """
+    Returns the name of an OpenCV ArUcO dictionary, e.g. DICT_4X4_50.
+    """
+    for name in dir(aruco):
+        if name.startswith("DICT_") and getattr(aruco, name) == aruco_dict:
+            return name
+    return str(aruco_dict)
+    
+def _marker_positions(corners, ids, corner=None):
+    """
+    Reduces the (n, 4, 2) corners array of the detected markers to a single
+    pixel position per marker, i.e. the requested corner or (by default) the
+    centre, defined as the mean of the midpoints of the four marker edges.
+    
+    Returns a compact record array (marker, x, y, dictionary), sorted by 
+    marker id.
+    """
+    corners = np.asarray(corners, dtype = np.float32).reshape(-1, 4, 2)
+    ids = np.asarray(ids).flatten()
+    order = np.argsort(ids, kind = "stable")
+    corners, ids = corners[order], ids[order]
+    
+    # specifying the corner for which the pixel coords are reported
+    if corner in _corner_index: # as defined by the OpenCV Aruco Library
+        positions = corners[:, _corner_index[corner]]
+    else:
+        midpoints = (corners + np.roll(corners, -1, axis = 1)) / np.float32(2)
+        positions = midpoints.mean(axis = 1)
+    
+    records = np.zeros(len(ids), dtype = marker_record)
+    records["marker"] = ids
+    records["x"] = positions[:, 0]
+    records["y"] = positions[:, 1]
+    return records
+    
+# image loaders that can be selected with detectGCPs.image_loader
+_image_loaders = {"grayscale": load_grayscale, "bgr": load_bgr}
+
+def _get_image_loader(name="grayscale", reduction=1):
+    """
+    Returns a function that loads an image (filename) as a grayscale array,
+    using the loader registered in _image_loaders under name.
+    """
+    if name not in _image_loaders:
+        raise ValueError(f"Unknown image loader '{name}', choose from {list(_image_loaders)}.")
+    if reduction not in reduced_grayscale_modes:
+        raise ValueError(f"Image reduction should be one of {list(reduced_grayscale_modes)}.")
+    return partial(_image_loaders[name], reduction = reduction)
+
+def _get_detector(aruco_dict, detector_parameters=None):
+    """
+    Returns the ArUcO detector for aruco_dict, configured with the 
+    (DetectorParameters attribute name: value) pairs in detector_parameters.
+    Detectors are created once per process (or thread) and reused for all
+    subsequent images. For OpenCV < 4.7 a (dictionary, parameters) tuple is
+    returned.
+    """
+    if not hasattr(_detectors, "by_key"):
+        _detectors.by_key = {}
+    detectors = _detectors.by_key
+    key = (aruco_dict, tuple(sorted((detector_parameters or {}).items())))
+    if key not in detectors:
+        if legacy_aruco_api:
+            parameters = aruco.DetectorParameters_create()
+        else:
+            parameters = aruco.DetectorParameters()
+        for name, value in (detector_parameters or {}).items():
+            if not hasattr(parameters, name):
+                raise AttributeError(f"Unknown ArUcO detector parameter '{name}'.")
+            setattr(parameters, name, value)
+            
+        if legacy_aruco_api:
+            detectors[key] = (aruco.Dictionary_get(aruco_dict), parameters)
+        else:
+            detectors[key] = aruco.ArucoDetector(
+                aruco.getPredefinedDictionary(aruco_dict), parameters
+                )
+    return detectors[key]
+
+def _init_detection_worker(aruco_dict, detector_parameters=None):
+    """
+    Pool initializer, creating the detector(s) of the worker (process or 
+    thread) up front.
+    """
+    for dictionary in aruco_dicts(aruco_dict):
+        _get_detector(dictionary, detector_parameters)
+
+class _serial_pool():
+    """
+    Stand-in for a multiprocessing pool that runs all tasks in the calling
+    process, in order of submission.
+    """
+    def __init__(self, processes=None, initializer=None, initargs=()):
+        if initializer:
+            initializer(*initargs)
+            
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+    
+    def imap_unordered(self, func, iterable, chunksize=1):
+        return map(func, iterable)
+
+# Executor backends for the marker detection. OpenCV releases the GIL while
+# decoding and detecting, so threads avoid the process startup and the 
+# pickling of results at little cost in parallelism.
+_detection_backends = {
+    "process": mp.Pool,
+    "thread": ThreadPool,
+    "serial": _serial_pool,
+    }
+
+def _get_detection_pool(backend="process"):
+    if backend not in _detection_backends:
+        raise ValueError(f"Unknown detection backend '{backend}', " +\
+                         f"choose from {', '.join(_detection_backends)}.")
+    return _detection_backends[backend]
+
+def _detect_marker_corners(gray, aruco_dict, detector_parameters=None):
+    """
+    Runs the OpenCV ArUcO detector on a grayscale image, returning the 
+    detected marker corners and ids (None if no markers were found).
+    """
+    detector = _get_detector(aruco_dict, detector_parameters)
+    if legacy_aruco_api:
+        dictionary, parameters = detector
         corners, ids, rejectedImgPoints = aruco.detectMarkers(
-            cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY),                                           
-            aruco.Dictionary_get(aruco_dict),                                   
+            gray,                                           
+            dictionary,                                   
             parameters=parameters
             )
     else:
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        dictionary = aruco.getPredefinedDictionary(aruco_dict)
-        detector = aruco.ArucoDetector(dictionary)
         corners, ids, _ = detector.detectMarkers(gray)
+    return corners, ids
 
-    # compiling all corners into np array
-    corners2 = np.array([c[0] for c in corners])
+def _detect_marker_corners_pyramid(gray, aruco_dict, scale=0.25, margin=0.5, fallback=True, detector_parameters=None):
+    """
+    Coarse-to-fine marker detection for very large images. Markers are 
+    detected on a copy of the image downscaled by scale, after which each 
+    candidate is re-detected at full resolution in a region around it, padded
+    by margin times the marker size. Markers that are too small to be detected
+    at the coarse scale are missed; if the coarse pass finds no markers at all
+    the full resolution image is analysed instead (if fallback is set).
     
-    if isinstance(ids, (np.ndarray, np.generic) ):
-        # and then into a pd DataFrame    
-        data = pd.DataFrame(
-            {"x": corners2[:,:,0].flatten(), 
-            "y": corners2[:,:,1].flatten()},
-            index = pd.MultiIndex.from_product(
-                [ids.flatten(), ["c{0}".format(i )for i in np.arange(4)+1]],
-                names = ["marker", ""] 
-                )
-            )
+    Returns the corners and ids in the format of _detect_marker_corners.
+    """
+    small = cv2.resize(gray, None, fx = scale, fy = scale, interpolation = cv2.INTER_AREA)
+    coarse_corners, coarse_ids = _detect_marker_corners(small, aruco_dict, detector_parameters)
+    if coarse_ids is None:
+        if fallback:
+            return _detect_marker_corners(gray, aruco_dict, detector_parameters)
+        return (), None
+    
+    regions = [_marker_region(c / scale, margin, gray.shape, 1 / scale) for c in coarse_corners]
+    return _detect_marker_corners_in_regions(gray, regions, aruco_dict, detector_parameters)
+
+def _marker_region(corners, margin, shape, pad=0):
+    """
+    Returns the (x0, y0, x1, y1) region around the marker corners, padded by
+    margin times the marker size (plus pad pixels), clipped to the image shape.
+    """
+    corners = np.asarray(corners).reshape(4, 2)
+    (x0, y0), (x1, y1) = corners.min(axis = 0), corners.max(axis = 0)
+    pad = margin * max(x1 - x0, y1 - y0) + pad
+    height, width = shape[:2]
+    return (
+        max(0, int(x0 - pad)), max(0, int(y0 - pad)),
+        min(width, int(np.ceil(x1 + pad))), min(height, int(np.ceil(y1 + pad)))
+        )
+
+def _detect_marker_corners_in_regions(gray, regions, aruco_dict, detector_parameters=None):
+    """
+    Detects the markers within the (x0, y0, x1, y1) regions of a grayscale 
+    image. Markers found in several (overlapping) regions are reported once.
+    
+    Returns the corners and ids in the format of _detect_marker_corners.
+    """
+    corners, ids, centres = [], [], []
+    for x0, y0, x1, y1 in regions:
+        if x1 <= x0 or y1 <= y0:
+            continue
+        roi_corners, roi_ids = _detect_marker_corners(gray[y0:y1, x0:x1], aruco_dict, detector_parameters)
+        if roi_ids is None:
+            continue
+        for rc, rid in zip(roi_corners, roi_ids.flatten()):
+            rc = rc + np.array([x0, y0], dtype = rc.dtype)
+            centre = rc.reshape(4, 2).mean(axis = 0)
+            if any(i == rid and np.abs(centre - m).max() < 1 for i, m in zip(ids, centres)):
+                continue
+            corners.append(rc)
+            ids.append(rid)
+            centres.append(centre)
+    
+    if not ids:
+        return (), None
+    return tuple(corners), np.array(ids, dtype = np.int32).reshape(-1, 1)
+
+def _track_markers_in_sequence(filenames, aruco_dict, corner=None, pyramid=None, tracking=None,
+                               detector_parameters=None, image_loader="grayscale", image_reduction=1):
+    """
+    Detects the markers in a sequence of photos (filenames, in capture order),
+    using the marker positions in the previous photos to predict where the 
+    markers are in the next one. The markers are first searched for in the 
+    predicted regions only (padded by tracking["margin"] times the marker 
+    size); the full frame is analysed for the first photo, every 
+    tracking["keyframe_interval"] photos (default 10, 0 for none), whenever
+    a marker of the previous photo is lost, and whenever a new marker enters
+    the field of view.
+    
+    New markers are found by a cheap scan of the full frame, downscaled by
+    tracking["scan_scale"] (default 0.25, None to disable the scan). Markers
+    that are too small to be detected at that scale are picked up by the 
+    next keyframe only; set a keyframe_interval of 1 to analyse every full
+    frame. Markers that are clipped by the image border may be detected
+    differently in a region than in the full frame.
+    
+    Markers are tracked per dictionary if aruco_dict is a list.
+    
+    Returns a list of (filename, records, timings) tuples, in the format of
+    _detect_markers_on_image.
+    """
+    dictionaries = aruco_dicts(aruco_dict)
+    tracking = tracking or {}
+    margin = tracking.get("margin", 1.0)
+    keyframe_interval = tracking.get("keyframe_interval", 10)
+    scan_scale = tracking.get("scan_scale", 0.25)
+    load = _get_image_loader(image_loader, image_reduction)
+    
+    results = []
+    history = {} # (dictionary, marker id): corners in the last (two) photos
+    for k, filename in enumerate(filenames):
+        timings = {}
+        start = time.perf_counter()
+        gray = load(filename)
+        timings["decode"] = time.perf_counter() - start
         
-        # calculating the centre
-        data = data.unstack().swaplevel(0, 1, axis = 1).stack()
-        data["m1"] = data[["c1", "c2"]].mean(axis = 1)
-        data["m2"] = data[["c2", "c3"]].mean(axis = 1)
-        data["m3"] = data[["c3", "c4"]].mean(axis = 1)
-        data["m4"] = data[["c4", "c1"]].mean(axis = 1)
-        data["centre"] = data[["m1", "m2", "m3", "m4"]].mean(axis = 1)
-        data = data.reset_index()
-        
-        # specifying the corner for which the pixel coords are reported
-        if corner == "topleft": # as defined by the OpenCV Aruco Library
-            x_data = data[data['level_1']=='x'].c1.values
-            y_data = data[data['level_1']=='y'].c1.values
-        elif corner == "topright":
-            x_data = data[data['level_1']=='x'].c2.values
-            y_data = data[data['level_1']=='y'].c2.values
-        elif corner == "bottomright":
-            x_data = data[data['level_1']=='x'].c3.values
-            y_data = data[data['level_1']=='y'].c3.values
-        elif corner == "bottomleft":
-            x_data = data[data['level_1']=='x'].c4.values
-            y_data = data[data['level_1']=='y'].c4.values
+        start = time.perf_counter()
+        tracked = bool(history) and not (keyframe_interval and k % keyframe_interval == 0)
+        if tracked:
+            # constant velocity prediction of the marker positions
+            detections = {}
+            for dictionary in dictionaries:
+                regions = [
+                    _marker_region(2 * c[-1] - c[0] if len(c) == 2 else c[-1], margin, gray.shape)
+                    for (d, i), c in history.items() if d == dictionary
+                    ]
+                detections[dictionary] = _detect_marker_corners_in_regions(
+                    gray, regions, dictionary, detector_parameters
+                    )
+            found = {
+                (d, i) for d, (corners, ids) in detections.items() if ids is not None 
+                for i in ids.flatten().tolist()
+                }
+            if not set(history) <= found:
+                tracked = False
+            elif scan_scale:
+                # any marker that is not tracked yet requires full frame detection
+                small = cv2.resize(gray, None, fx = scan_scale, fy = scan_scale, interpolation = cv2.INTER_AREA)
+                for dictionary in dictionaries:
+                    corners, ids = _detect_marker_corners(small, dictionary, detector_parameters)
+                    if ids is not None and not {(dictionary, i) for i in ids.flatten().tolist()} <= found:
+                        tracked = False
+                        break
+        if tracked:
+            timings["detect"] = time.perf_counter() - start
         else:
-            x_data = data[data['level_1']=='x'].centre.values
-            y_data = data[data['level_1']=='y'].centre.values
-            
-        df = pd.DataFrame(
-            {
-                'marker':data[data['level_1']=='x'].marker.values,
-                'filename':filename,
-                'x':x_data,
-                'y':y_data
+            detections = {
+                dictionary: _detect_marker_corners_on_frame(gray, dictionary, pyramid, detector_parameters, timings)
+                for dictionary in dictionaries
                 }
-            )
-        return df
-    else:
-        return None
-    
+        timings["tracked"] = tracked
+        
+        history = {
+            (d, i): history.get((d, i), [])[-1:] + [c.reshape(4, 2)] 
+            for d, (corners, ids) in detections.items() if ids is not None
+            for c, i in zip(corners, ids.flatten().tolist())
+            }
+        start = time.perf_counter()
+        records = _concatenate_records([
+            _corners_to_records(corners, ids, corner, image_reduction, d)
+            for d, (corners, ids) in detections.items()
+            ])
+        timings["geometry"] = time.perf_counter() - start
+        results.append((filename, records, timings))
+    return results
+
+def _sequence_segments(photo_files, segment_length=100):
+    """
+    Splits the photos into sequences per folder (in capture, i.e. filename,
+    order) of at most segment_length photos, to be tracked in parallel.
+    """
+    segments = []
+    for folder, photos in itertools.groupby(sorted(photo_files), key = os.path.dirname):
+        photos = list(photos)
+        segments.extend(photos[i:i + segment_length] for i in range(0, len(photos), segment_length))
+    return segments
+
 def _check_output_path(photo_path):    
     output_dir = Path(
             photo_path,"gcps","prepared"
@@ -186,6 +871,7 @@ class real_world_positions():
         
         # internalise config data
         self.cfg = cfg
+        self.logger = logger
                
         # create output dir if not existing
         self.output_file = Path(
@@ -197,9 +883,12 @@ class real_world_positions():
         if "template" in self.cfg["detectGCPs"] and self.cfg["detectGCPs"]["template"]["enabled"]:
             self.logger.info("Implementing real world positions from 2D template file.")
             self.real_world_positions_from_2D_template()
-        else:
+        elif "gpkg" in self.cfg["detectGCPs"] and self.cfg["detectGCPs"]["gpkg"]["enabled"]:
             self.logger.info("Implementing real world positions from geopackage file.")
             self.real_world_positions_from_gpkg()
+        else:
+            self.logger.warning("Neither a template nor a geopackage is enabled.")
+            self.logger.warning("Nothing will be outputted. Please format your own marker data according to the template.")
             
             
     def real_world_positions_from_2D_template(self):
@@ -214,17 +903,21 @@ class real_world_positions():
         Remote Sens. 2020, 12(2), 330; https://doi.org/10.3390/rs12020330
         """
         
-        # aruco magic
-        frame = cv2.imread(self.cfg["detectGCPs"]["template"]["template_file_path"].as_posix())
-        self.image_markers = _assign_marker_coordinates_on_image(
-            self.cfg["detectGCPs"]["template"]["template_file_path"].as_posix(),
-            self.cfg["detectGCPs"]["aruco_dict"]
+        # aruco magic, decoding the template only once
+        gray = _get_image_loader(self.cfg["detectGCPs"].get("image_loader", "grayscale"))(
+            self.cfg["detectGCPs"]["template"]["template_file_path"].as_posix()
             )
+        corners, ids = _detect_marker_corners(
+            gray, 
+            aruco_dicts(self.cfg["detectGCPs"]["aruco_dict"])[0],
+            self.cfg["detectGCPs"].get("detector_parameters")
+            )
+        self.image_markers = pd.DataFrame(_marker_positions(corners, ids))
         
         # transforming pixel values to real world distances based on known
         # template dimensions.
-        self.image_markers.x *= self.cfg["detectGCPs"]["template"]["template_size"]/np.shape(frame)[0] 
-        self.image_markers.y *= self.cfg["detectGCPs"]["template"]["template_size"]/np.shape(frame)[0]
+        self.image_markers.x *= self.cfg["detectGCPs"]["template"]["template_size"]/np.shape(gray)[0] 
+        self.image_markers.y *= self.cfg["detectGCPs"]["template"]["template_size"]/np.shape(gray)[0]
         self.image_markers['z'] = 0
         
         # stores marker real world positions in gcp_table file.
@@ -233,8 +926,90 @@ class real_world_positions():
         self.logger.info(f'Exported real world marker coordinates to {PurePath(self.cfg["detectGCPs"]["photo_path"],"gcps","prepared")} folder.')
         
     def real_world_positions_from_gpkg(self):
-        self.logger.warning("This function has yet to be implemented...")
-        self.logger.warning("Nothing will be outputted. Please format your own marker data according to the template.")
+        """
+        This function is used for field surveys with GCPs surveyed in a (e.g.
+        national) GCP database, stored as a point layer of a geopackage. Only
+        the GCPs within the footprint of the survey are read, through the
+        spatial index of the layer; the footprint is given by bounds 
+        ([minx, miny, maxx, maxy] in the layer CRS) or otherwise derived from
+        the EXIF GPS positions of the photos (per folder, padded by buffer in
+        metres). Marker labels are read from label_column, elevations
+        from the point geometry or z_column and optional accuracies from 
+        accuracy_columns ([dx, dy, dz]).
+        """
+        gpkg_cfg = self.cfg["detectGCPs"]["gpkg"]
+        
+        with geopackage(gpkg_cfg["gpkg_path"], logger = self.logger) as gpkg:
+            layer = gpkg.point_layer(gpkg_cfg.get("layer"))
+            if gpkg_cfg.get("bounds"):
+                bounds = [tuple(gpkg_cfg["bounds"])]
+            else:
+                bounds = self._photo_footprint(gpkg.crs(layer), gpkg_cfg.get("buffer", 100))
+            points = gpkg.read_points(layer, bounds)
+        
+        label_column = gpkg_cfg.get("label_column", "marker")
+        if label_column not in points:
+            raise ValueError(f"Label column {label_column} not found in layer {layer}.")
+        self.image_markers = pd.DataFrame({
+            'marker': points[label_column],
+            'x': points["x"],
+            'y': points["y"],
+            'z': points[gpkg_cfg["z_column"]] if gpkg_cfg.get("z_column") else points["z"].fillna(0)
+            })
+        columns = ['marker','x','y','z']
+        if gpkg_cfg.get("accuracy_columns"):
+            for name, column in zip(['dx','dy','dz'], gpkg_cfg["accuracy_columns"]):
+                self.image_markers[name] = points[column]
+            columns += ['dx','dy','dz']
+        
+        duplicates = self.image_markers["marker"].duplicated()
+        if duplicates.any():
+            self.logger.warning(f"Ignoring {duplicates.sum()} GCPs with duplicate labels: " +\
+                                f"{', '.join(map(str, self.image_markers.loc[duplicates, 'marker'].unique()))}.")
+            self.image_markers = self.image_markers[~duplicates]
+        
+        # stores marker real world positions in gcp_table file.
+        self.image_markers[columns].to_csv(self.output_file, mode='w', header=False,index=False,sep=',')
+        
+        self.logger.info(f'Exported {len(self.image_markers)} real world marker coordinates to ' +\
+                         f'{PurePath(self.cfg["detectGCPs"]["photo_path"],"gcps","prepared")} folder.')
+        
+    def _photo_footprint(self, crs, buffer=100):
+        """
+        Returns the bounds (minx, miny, maxx, maxy) of the GPS positions of 
+        the photos per folder, padded by buffer (in metres) and transformed 
+        into crs.
+        """
+        positions = {}
+        for filename in find_photos(
+                self.cfg["detectGCPs"]["photo_path"],
+                max_depth = self.cfg["detectGCPs"].get("max_depth", 1)
+                ):
+            position = read_gps_position(filename)
+            if position:
+                positions.setdefault(os.path.dirname(filename), []).append(position[:2])
+        if not positions:
+            raise ValueError("No photos with GPS positions found, please specify the bounds of the GCPs.")
+        
+        transformer = None
+        if crs != "EPSG:4326":
+            if Transformer is None:
+                raise ImportError(f"Transforming photo positions into {crs} requires pyproj, " +\
+                                  "please install pyproj or specify the bounds of the GCPs.")
+            transformer = Transformer.from_crs("EPSG:4326", crs, always_xy = True)
+        
+        bounds = []
+        for folder, p in positions.items():
+            p = np.asarray(p)
+            (minx, miny), (maxx, maxy) = p.min(axis = 0), p.max(axis = 0)
+            # the buffer in degrees, at the latitude furthest from the equator
+            dy = buffer / _METRES_PER_DEGREE
+            dx = dy / max(np.cos(np.radians(max(abs(miny), abs(maxy)))), 1e-6)
+            box = (minx - dx, max(miny - dy, -90), maxx + dx, min(maxy + dy, 90))
+            bounds.append(transformer.transform_bounds(*box) if transformer else box)
+        self.logger.info(f"Photo footprint of {sum(map(len, positions.values()))} GPS positions " +\
+                         f"in {len(bounds)} folders.")
+        return bounds
         
         
 if __name__ == "__main__":
@@ -244,7 +1019,7 @@ if __name__ == "__main__":
     except:  # running from command line
         config_file = "../config/identify_markers_config.yml"
         
-    cfg = read_yaml.read_yaml(config_file)
+    cfg = read_yaml(config_file)
     if "detectGCPs" in cfg and cfg["detectGCPs"]["enabled"]:
         B = real_world_positions(cfg)
         A = marker_detection(cfg)
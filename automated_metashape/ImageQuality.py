@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Peter Betlem
+@institution: University Centre in Svalbard, Svalbard
+@year: 2023
+
+Local estimate of the image quality of photos, as an alternative to the
+Metashape analyzeImages step that runs on the processing node itself, also
+in network mode (before the batch is submitted). The sharpness of a photo is
+the variance of the Laplacian of a reduced resolution grayscale decode, and
+is cached per photo (see FileCache).
+"""
+
+# import standard libs
+import time
+import logging
+
+# import calc and image libs
+import numpy as np
+import cv2
+
+# import multiprocessing libs
+import multiprocessing as mp
+
+from .ImageIO import load_grayscale, reduced_grayscale_modes
+from .FileCache import file_cache
+
+def laplacian_variance(filename, reduction = 4):
+    """
+    Returns the sharpness of a photo: the variance of the Laplacian of the
+    grayscale photo, decoded at 1/reduction of its resolution.
+    """
+    gray = load_grayscale(filename, reduction)
+    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+def _score_photo(task):
+    """
+    Pool worker returning the (filename, sharpness) of a photo, with
+    sharpness None if the photo cannot be read.
+    """
+    filename, reduction = task
+    try:
+        return filename, laplacian_variance(filename, reduction)
+    except IOError:
+        return filename, None
+
+def image_sharpness(photo_files, reduction = 4, workers = None, cache_file = None,
+                    logger = logging.getLogger(__name__)):
+    """
+    Computes the sharpness (see laplacian_variance) of photo_files in a local
+    process pool. Returns {filename: sharpness}, with sharpness None for
+    unreadable photos. If a cache_file is given, the sharpness of unchanged
+    photos is taken from it.
+    """
+    if reduction not in reduced_grayscale_modes:
+        raise ValueError(f"Unsupported reduction {reduction}, choose from " +\
+                         f"{', '.join(map(str, reduced_grayscale_modes))}.")
+    cache = file_cache(cache_file, {"reduction": reduction}, "sharpness", name = "image quality cache",
+                       logger = logger) if cache_file else None
+
+    sharpness = {}
+    pending = []
+    for filename in photo_files:
+        cached = cache.lookup(filename) if cache else None
+        if cached is None:
+            pending.append(filename)
+        else:
+            sharpness[filename] = cached
+
+    start = time.perf_counter()
+    if pending:
+        with mp.Pool(workers) as pool:
+            tasks = [(filename, reduction) for filename in pending]
+            for filename, score in pool.imap_unordered(_score_photo, tasks, chunksize = 4):
+                sharpness[filename] = score
+                if cache and score is not None:
+                    cache.store(filename, score)
+    elapsed = time.perf_counter() - start
+
+    if cache:
+        cache.save()
+    logger.info(f"Estimated the sharpness of {len(pending)} photos in {elapsed:.2f} s " +\
+                f"({len(pending) / max(elapsed, 1e-9):.1f} photos/s), " +\
+                f"{len(photo_files) - len(pending)} taken from the cache.")
+    return sharpness
+
+def relative_quality(sharpness):
+    """
+    Returns the sharpness relative to the median sharpness of all (readable)
+    photos, i.e. {filename: quality} with a quality of 1 for a photo of
+    median sharpness, and None for unreadable photos.
+    """
+    scores = [score for score in sharpness.values() if score is not None]
+    median = np.median(scores) if scores else 0
+    return {
+        filename: (score / median if median else 0.) if score is not None else None
+        for filename, score in sharpness.items()
+        }
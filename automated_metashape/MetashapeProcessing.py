@@ -10,8 +10,6 @@ is documented here: https://github.com/ucdavis/metashape.
 
 from pathlib import Path
 import datetime
-import glob
-import re
 import logging
 from logging.config import dictConfig
 import yaml
@@ -25,7 +23,16 @@ from packaging import version
 
 
 from .read_yaml import read_yaml
-from .ImageMarkers import marker_detection, real_world_positions
+from .ImageMarkers import marker_detection, real_world_positions, dictionary_name, aruco_dicts
+from .PhotoDiscovery import find_photos, camera_label, existing_masks, is_raw_photo
+from .ShardedDetection import sharded_detection
+from .PhotoScan import scan_photos, sensor_groups, quarantine_photos
+from .ImageQuality import image_sharpness, relative_quality
+from .PhotoDuplicates import photo_hashes, find_duplicates
+from .SpatialPairs import camera_pairs, geodetic_to_geocentric
+from .ImageHeaders import read_gps_position
+from .ImageCoordinates import find_image_coordinates, read_image_coordinates, marker_labels
+from .ChunkIndex import chunk_index, add_marker_projections, set_marker_references
 
 
 import pkg_resources
@@ -60,12 +67,18 @@ def _check_metashape_version(logger=logging.getLogger(__name__)):
     if version.parse("2.0.0") > version.parse(pkg_resources.get_distribution('Metashape').version):
         raise  Exception("Metashape Python version > 2.0.0 required. Please update the current installation.")
 
+# next finer matchPhotos downscale, for the escalation of re-alignment rounds
+_finer_downscale = {8: 4, 4: 2, 2: 1, 1: 0, 0: 0}
+
 class AutomatedProcessing:
         
     def __init__(self, logger=logging.getLogger(__name__)):
         self.__version__ = pkg_resources.get_distribution('automated_metashape').version
         self._check_metashape_activated() # do this before doing anything else...
         self.logger = logger
+        self._chunk_index = None
+        self.image_coordinates = None # marker projections handed from detect_gcps to add_gcps
+        self.sensor_groups = None # sensors of the photos, if pre-scanned by add_photos
 
 
         
@@ -219,6 +232,7 @@ class AutomatedProcessing:
         
     def _init_metashape_document(self):
         self.doc = Metashape.Document()
+        self._chunk_index = None
         self.doc.read_only = False
         
         if self.cfg["load_project_path"]:
@@ -243,6 +257,29 @@ class AutomatedProcessing:
             self.doc.save(str(self.project_file.resolve().as_posix()))
             self.logger.info(f'Saved project as {str(self.project_file.resolve().as_posix())}'+self._return_parameters())
         
+    @property
+    def chunk_index(self):
+        """
+        Index of the cameras and markers of the active chunk, shared by the
+        processing stages. It is built on first use, and rebuilt if the active
+        chunk changed or after _invalidate_chunk_index.
+        """
+        chunk = self.doc.chunk
+        if self._chunk_index is None or self._chunk_index.chunk.key != chunk.key:
+            self._chunk_index = chunk_index(chunk)
+        return self._chunk_index
+    
+    def _invalidate_chunk_index(self, *indexes):
+        """
+        To be called after a stage changed the chunk other than through the
+        chunk index: invalidates the given indexes (see chunk_index.invalidate),
+        or the entire index if none are given.
+        """
+        if not indexes:
+            self._chunk_index = None
+        elif self._chunk_index is not None:
+            self._chunk_index.invalidate(*indexes)
+    
     def _init_network_processing(self):
         try:
             self.client = Metashape.NetworkClient()
@@ -267,6 +304,9 @@ class AutomatedProcessing:
         if "analyzeImages" in self.cfg and self.cfg["analyzeImages"]["enabled"]:
             self.analyze_images()
             
+        if "pruneDuplicates" in self.cfg and self.cfg["pruneDuplicates"]["enabled"]:
+            self.prune_duplicates()
+            
         if "detectGCPs" in self.cfg and self.cfg["detectGCPs"]["enabled"]:
             self.detect_gcps()
         
@@ -373,10 +413,26 @@ class AutomatedProcessing:
         
         # TODO: provide dictionary check to add_photos as per the other functions
         self.logger.info('Initiating add_photos step...')
-        a = glob.iglob(str(Path(self.cfg["addPhotos"]["photo_path"],"**","*.*")))   #(([jJ][pP][gG])|([tT][iI][fF]))
-        b = [path for path in a]
-        photo_files = [x for x in b if (re.search("(.tif$)|(.jpg$)|(.TIF$)|(.JPG$)",x) and (not re.search("_mask.",x)))]
+        photo_files = find_photos(
+            self.cfg["addPhotos"]["photo_path"],
+            max_depth = self.cfg["addPhotos"].get("max_depth", 1),
+            manifest = self.cfg["addPhotos"].get("photo_manifest", False),
+            logger = self.logger
+            )
+        self.logger.info(f'Found {len(photo_files)} photos.')
+        
+        # only add photos that are not in the (loaded) project yet, e.g. 
+        # those of a new campaign
+        incremental = self.cfg["addPhotos"].get("incremental", False)
+        if incremental:
+            photo_files = self.chunk_index.new_photos(photo_files)
+            self.logger.info(f'{len(photo_files)} photos are not yet in the project.')
+            if not photo_files:
+                self.logger.info('Finalised adding photos, no new photos found.'+self._return_parameters(stage="addPhotos"))
+                return
         
+        if "prescan" in self.cfg["addPhotos"] and self.cfg["addPhotos"]["prescan"]["enabled"]:
+            photo_files = self._prescan_photos(photo_files)
         
         ## Add them
         if self.cfg["addPhotos"]["enabled"] and self.cfg["addPhotos"]["multispectral"]:
@@ -385,6 +441,14 @@ class AutomatedProcessing:
         else:
             self.doc.chunk.addPhotos(photo_files)
             self.logger.info('Photos added to project.')
+        self._invalidate_chunk_index()
+        index = self.chunk_index
+        if self.sensor_groups is not None:
+            self.logger.info(f'The project has {len(self.doc.chunk.sensors)} sensors ' +\
+                             f'({len(self.sensor_groups)} sensor groups pre-scanned).')
+        
+        # the cameras to finalise (masks, labels and references)
+        new_cameras = index.cameras_of(photo_files) if incremental else index.all_cameras
             
         # add masks if present (preferably in same 1XXMEDIA folder, with suffix {image_name}_mask.img_ext)
         # TODO: Try function below
@@ -412,37 +476,27 @@ class AutomatedProcessing:
             mask_parameters["path"] = str(mask_parameters["path"].resolve())
 
             if not "cameras" in mask_parameters.keys():
-                mask_count = 0
-                for cam in self.doc.chunk.cameras:
-                    mask_parameters["cameras"] = [cam]
-                    try:
-                        self.doc.chunk.generateMasks(
-                            **mask_parameters
-                            )
-                        self.logger.debug(f'Applied mask to camera {cam}')
-                        mask_count += 1
-                    except:
-                        pass
+                self._generate_masks(
+                    new_cameras, mask_parameters, 
+                    batch_size = self.cfg["masks"].get("batch_size", 250)
+                    )
             else:
                 mask_count = len(mask_parameters["cameras"])
                 self.doc.chunk.generateMasks(
                             **mask_parameters
                             )
+                self.logger.info(f'Masks have been applied to {mask_count} cameras.')
                 
-                
-            self.logger.info(f'Masks have been applied to {mask_count} cameras.'+self._return_parameters(stage="masks"))
+            self._return_parameters(stage="masks",log=True)
             
         ## Need to change the label on each camera so that it includes the containing folder
-        for camera in self.doc.chunk.cameras:
-            path = camera.photo.path
-            path_parts = path.split("/")[-2:]
-            newlabel = "/".join(path_parts)
-            camera.label = newlabel
+        paths = index.camera_paths
+        index.relabel([camera_label(paths[camera]) for camera in new_cameras], new_cameras)
                        
-        self.logger.info('Successfully relabeled cameras.')
+        self.logger.info(f'Successfully relabeled {len(new_cameras)} cameras.')
             
         if self.cfg["addPhotos"]["enabled"] and self.cfg["addPhotos"]["remove_photo_location_metadata"]:
-            for camera in self.doc.chunk.cameras:
+            for camera in new_cameras:
                 camera.reference.location = None
                 camera.reference.rotation = None
                     
@@ -453,19 +507,100 @@ class AutomatedProcessing:
         self.logger.info('Finalised adding photos.'+self._return_parameters(stage="addPhotos"))
 
     
+    def _prescan_photos(self, photo_files):
+        """
+        Reads the headers of the photos before adding them (see PhotoScan), 
+        and returns the readable photos. Rejected (unreadable or truncated) 
+        photos are moved to {photo_path}/.quarantine if quarantine is set.
+        """
+        prescan = self.cfg["addPhotos"]["prescan"]
+        photo_path = self.cfg["addPhotos"]["photo_path"]
+        headers, rejected = scan_photos(
+            photo_files,
+            workers = prescan.get("workers"),
+            backend = prescan.get("backend", "thread"),
+            cache_file = Path(photo_path, ".photo_scan.json") if prescan.get("cache", True) else None,
+            logger = self.logger
+            )
+        if rejected and prescan.get("quarantine", False):
+            quarantine_photos(list(rejected), photo_path, logger = self.logger)
+        
+        self.sensor_groups = sensor_groups(headers)
+        for (make, model, width, height, focal_length), photos in self.sensor_groups.items():
+            self.logger.info(f'Sensor group {make or "unknown"} {model or ""} {width}x{height}, ' +\
+                             f'{focal_length or "unknown"} mm: {len(photos)} photos.')
+        return [filename for filename in photo_files if filename in headers]
+    
+    def _generate_masks(self, cameras, mask_parameters, batch_size = 250):
+        """
+        Applies masks to the cameras in batches of batch_size cameras. For the
+        masking modes that read mask files (file and background), cameras
+        without a mask file are skipped beforehand. If a batch fails, its
+        cameras are masked one by one to isolate the failing cameras.
+        """
+        masking_mode = mask_parameters.get("masking_mode")
+        if masking_mode in (Metashape.MaskingMode.MaskingModeFile, Metashape.MaskingMode.MaskingModeBackground):
+            template = mask_parameters["path"]
+            paths = self.chunk_index.camera_paths
+            exists = existing_masks(
+                template, [paths[camera] for camera in cameras],
+                [camera.label for camera in cameras] if "{camera}" in template else None
+                )
+            missing = [camera for camera, found in zip(cameras, exists) if not found]
+            cameras = [camera for camera, found in zip(cameras, exists) if found]
+            for camera in missing:
+                self.logger.debug(f'No mask file found for camera {camera}')
+        else:
+            missing = []
+        
+        applied, failed = 0, []
+        for start in range(0, len(cameras), batch_size):
+            batch = cameras[start:start + batch_size]
+            try:
+                self.doc.chunk.generateMasks(**{**mask_parameters, "cameras": batch})
+                applied += len(batch)
+                continue
+            except Exception as e:
+                self.logger.warning(f'Mask generation failed for a batch of {len(batch)} cameras ({e}), ' +\
+                                    'retrying camera by camera...')
+            for camera in batch:
+                try:
+                    self.doc.chunk.generateMasks(**{**mask_parameters, "cameras": [camera]})
+                    applied += 1
+                except Exception as e:
+                    self.logger.debug(f'Mask generation failed for camera {camera}: {e}')
+                    failed.append(camera)
+        
+        self.logger.info(f'Masks have been applied to {applied} cameras ' +\
+                         f'({len(missing)} without mask file, {len(failed)} failed).')
+        if failed:
+            self.logger.warning(f'Mask generation failed for {len(failed)} cameras: ' +\
+                                ', '.join(camera.label for camera in failed[:5]) +\
+                                (f' (and {len(failed) - 5} more).' if len(failed) > 5 else '.'))
+        return applied, missing, failed
+    
     def analyze_images(self):
         analyzeImages_dict = [
             "cameras",
             "filter_mask"
             ]
-        analyzeImages_parameters = []
+        analyzeImages_parameters = {}
         for key, value in self.cfg["analyzeImages"].items():
             if key in analyzeImages_dict:
                 analyzeImages_parameters[key] = value 
-                
-        if self.network:            
-            self.logger.warning("Current version do not support photo selection based on photo quality - use standalone instead.")
-            task = Metashape.Tasks.analyzeImages()
+        
+        # the quality engine: Metashape's analyzeImages, or the local sharpness 
+        # estimate (see ImageQuality), which also works in network mode
+        engine = self.cfg["analyzeImages"].get("engine", "metashape")
+        if engine not in ("metashape", "local"):
+            raise ValueError(f"Unknown analyzeImages engine '{engine}', choose from metashape, local.")
+        
+        if engine == "local":
+            self._analyze_images_locally()
+            
+        elif self.network:            
+            self.logger.warning("Current version do not support photo selection based on photo quality - use standalone or the local engine instead.")
+            task = Metashape.Tasks.AnalyzeImages()
             task.decode(analyzeImages_parameters)
             self._encode_task(task)
             self.logger.info('Photo-analysis tasks added to network batch list.'+self._return_parameters(stage="analyzeImages"))
@@ -483,21 +618,135 @@ class AutomatedProcessing:
             #if not "cameras" in analyzeImages_parameters:
             #    analyzeImages_parameters["cameras"] = self.doc.chunk.cameras
                 
-            for camera in self.doc.chunk.cameras:
-                if float(camera.meta['Image/Quality']) < self.cfg["analyzeImages"]["quality_cutoff"]:
-                    camera.enabled = False
-                    self.logger.debug(f'Disabled camera {camera}')
+            index = self.chunk_index
+            low_quality = [
+                camera for camera in index.all_cameras 
+                if float(camera.meta['Image/Quality']) < self.cfg["analyzeImages"]["quality_cutoff"]
+                ]
+            index.set_enabled(low_quality, False)
+            for camera in low_quality:
+                self.logger.debug(f'Disabled camera {camera}')
+            self.logger.info(f'Disabled {len(low_quality)} of {len(index.all_cameras)} cameras.')
+    
+    def _analyze_images_locally(self):
+        """
+        Disables the (enabled) cameras with a quality below quality_cutoff, 
+        where the quality is the sharpness of a photo relative to the median 
+        sharpness of all photos (or the absolute sharpness, if relative is
+        False). The sharpness is computed in a local process pool.
+        """
+        cfg = self.cfg["analyzeImages"]
+        quality_cutoff = cfg.get("quality_cutoff", 0.5)
+        index = self.chunk_index
+        paths = index.camera_paths
+        # raw photos cannot be decoded locally, see PhotoDiscovery.raw_extensions
+        cameras = [camera for camera in index.enabled_cameras if not is_raw_photo(paths[camera])]
+        if len(cameras) < len(index.enabled_cameras):
+            self.logger.warning(f'Not analysing the raw photos of {len(index.enabled_cameras) - len(cameras)} cameras.')
+        
+        sharpness = image_sharpness(
+            [paths[camera] for camera in cameras],
+            reduction = cfg.get("reduction", 4),
+            workers = cfg.get("workers"),
+            cache_file = Path(self.cfg["project_path"], "image_quality_cache.json") if cfg.get("cache", True) else None,
+            logger = self.logger
+            )
+        quality = relative_quality(sharpness) if cfg.get("relative", True) else sharpness
+        
+        unreadable = [camera for camera in cameras if quality[paths[camera]] is None]
+        low_quality = [
+            camera for camera in cameras 
+            if quality[paths[camera]] is not None and quality[paths[camera]] < quality_cutoff
+            ]
+        if unreadable:
+            self.logger.warning(f'Unable to read the photos of {len(unreadable)} cameras, disabling these.')
+        index.set_enabled(unreadable + low_quality, False)
+        for camera in low_quality:
+            self.logger.debug(f'Disabled camera {camera} (quality {quality[paths[camera]]:.3f})')
+        self.logger.info(f'Disabled {len(low_quality)} of {len(cameras)} cameras with a ' +\
+                         f'{"relative " if cfg.get("relative", True) else ""}sharpness below {quality_cutoff}.')
+        
+        self.doc.save()
+        self.logger.info('Photos analyzed locally.'+self._return_parameters(stage="analyzeImages"))
+        
+    def prune_duplicates(self):
+        """
+        Disables near-duplicate photos (see PhotoDuplicates): of every cluster
+        of enabled cameras with photos within max_distance bits of each other's
+        perceptual hash, taken at most max_sequence_gap photos apart and, if
+        their EXIF GPS positions are known, at most max_offset metres apart,
+        only the sharpest camera remains enabled.
+        """
+        self.logger.info('Pruning near-duplicate photos...')
+        cfg = self.cfg["pruneDuplicates"]
+        index = self.chunk_index
+        paths = index.camera_paths
+        # raw photos cannot be decoded locally, see PhotoDiscovery.raw_extensions
+        cameras = {paths[camera]: camera for camera in index.enabled_cameras if not is_raw_photo(paths[camera])}
+        if len(cameras) < len(index.enabled_cameras):
+            self.logger.warning(f'Not pruning the raw photos of {len(index.enabled_cameras) - len(cameras)} cameras.')
+        
+        hashes = photo_hashes(
+            list(cameras), 
+            reduction = cfg.get("reduction", 8), 
+            workers = cfg.get("workers"), 
+            logger = self.logger
+            )
+        positions = {}
+        max_offset = cfg.get("max_offset", 2)
+        if max_offset is not None:
+            for path in cameras:
+                position = read_gps_position(path)
+                if position:
+                    positions[path] = geodetic_to_geocentric(position[0], position[1], position[2] or 0)
+            self.logger.info(f'Read the GPS position of {len(positions)} of {len(cameras)} photos.')
+        
+        clusters = find_duplicates(
+            hashes, 
+            max_distance = cfg.get("max_distance", 4), 
+            max_sequence_gap = cfg.get("max_sequence_gap", 3), 
+            positions = positions, 
+            max_offset = max_offset
+            )
+        
+        duplicates = [cameras[path] for duplicate_paths in clusters.values() for path in duplicate_paths]
+        index.set_enabled(duplicates, False)
+        for kept, duplicate_paths in clusters.items():
+            self.logger.debug(f'Kept camera {cameras[kept]}, disabled {len(duplicate_paths)} near-duplicates.')
+        
+        # matching cost scales with the number of image pairs
+        before, after = len(cameras), len(cameras) - len(duplicates)
+        reduction = 1 - (after * (after - 1)) / max(before * (before - 1), 1)
+        self.logger.info(f'Disabled {len(duplicates)} of {before} cameras in {len(clusters)} clusters of ' +\
+                         f'near-duplicates, reducing the (exhaustive) number of image pairs by {reduction:.0%}.')
+        
+        self.doc.save()
+        self.logger.info('Near-duplicate photos pruned.'+self._return_parameters(stage="pruneDuplicates"))
         
     def detect_gcps(self):
         '''
         Detects aruco markers and stores these in a csv file.
         Currently only aruco markers are supported; though may in future be expended
-        to include Agisoft metashape markers.
+        to include Agisoft metashape markers. If a template or geopackage is enabled,
+        the real world positions of the markers are stored as well (gcp_table.csv).
 
         '''
-        #real_world_positions(self.cfg, logger=self.logger)
-        marker_detection(self.cfg, logger=self.logger)
-        # TODO: port real_world_position class
+        # the real world positions of the GCPs, from a 2D template or a geopackage
+        if any(source in self.cfg["detectGCPs"] and self.cfg["detectGCPs"][source]["enabled"] 
+               for source in ("template", "gpkg")):
+            real_world_positions(self.cfg, logger=self.logger)
+        
+        if "sharding" in self.cfg["detectGCPs"] and self.cfg["detectGCPs"]["sharding"]["enabled"]:
+            sharded_detection(self.cfg, logger=self.logger)
+            self.image_coordinates = None
+        else:
+            # the table is still written for reference, but add_gcps uses the
+            # detected markers directly
+            detection = marker_detection(self.cfg, logger=self.logger)
+            self.image_coordinates = (
+                Path(self.cfg["detectGCPs"]["photo_path"]).resolve(), 
+                detection.image_coordinates
+                )
         
     def add_gcps(self):
         '''
@@ -510,21 +759,30 @@ class AutomatedProcessing:
 
         self.logger.info('Adding ground control points.')
         ## Tag specific pixels in specific images where GCPs are located
-        path = Path(self.cfg["addGCPs"]["photo_path"], "gcps", "prepared", "gcp_imagecoords_table.csv")
-        marker_pixel_data = pd.read_csv(path,names=["marker","camera","x","y"])
-    
-        for index, row in marker_pixel_data.iterrows():
-            camera = _get_camera(self.doc.chunk, row.camera)
-            if not camera:
-                print(row.camera + " camera not found in project")
-                continue
+        if self.image_coordinates and self.image_coordinates[0] == Path(self.cfg["addGCPs"]["photo_path"]).resolve():
+            # detected in this run, with precomputed marker labels
+            marker_pixel_data = self.image_coordinates[1]
+            self.logger.info(f"Using {len(marker_pixel_data)} marker projections from the marker detection.")
+        else:
+            # the most recent table written by the marker detection, in any format
+            path = find_image_coordinates(Path(self.cfg["addGCPs"]["photo_path"], "gcps", "prepared")) or \
+                Path(self.cfg["addGCPs"]["photo_path"], "gcps", "prepared", "gcp_imagecoords_table.csv")
+            marker_pixel_data = read_image_coordinates(path)
+            self.logger.info(f"Loaded {len(marker_pixel_data)} marker projections from {path.name}.")
             
-            marker = _get_marker(self.doc.chunk, str(int(row.marker)))
-            if not marker:
-                marker = self.doc.chunk.addMarker()
-                marker.label = str(int(row.marker))
-                
-            marker.projections[camera] = Metashape.Marker.Projection((float(row.x), float(row.y)), True)
+            # markers of other than the first (GCP) dictionary get distinct labels
+            primary = None
+            if "detectGCPs" in self.cfg and "aruco_dict" in self.cfg["detectGCPs"]:
+                primary = dictionary_name(aruco_dicts(self.cfg["detectGCPs"]["aruco_dict"])[0])
+            marker_pixel_data["label"] = marker_labels(marker_pixel_data, primary)
+        
+        index = self.chunk_index
+        added = add_marker_projections(
+            index, marker_pixel_data, 
+            lambda x, y: Metashape.Marker.Projection((x, y), True),
+            logger = self.logger
+            )
+        self.logger.info(f"Added {added} marker projections of {len(index.markers)} markers.")
     
         ## Assign real-world coordinates to each GCP
         path = Path(self.cfg["addGCPs"]["photo_path"], "gcps", "prepared", "gcp_table.csv")
@@ -553,22 +811,10 @@ class AutomatedProcessing:
         #    marker_coordinate_data = pd.read_csv(path,names=["marker","x","y","z"])
         #    self.logger.info("Loaded marker coordinate data without accuracies.")
         #    
-        for index, row in marker_coordinate_data.iterrows():
-            marker = _get_marker(self.doc.chunk, str(int(row.marker)))
-            if not marker:
-                marker = self.doc.chunk.addMarker()
-                marker.label = str(int(row.marker))
-                
-            marker.reference.location = (float(row.x), float(row.y), float(row.z))
-            
-            if all([name in marker_coordinate_data.columns for name in ["dx","dy","dz"]]):
-                marker.reference.accuracy = (float(row.dx), float(row.dy), float(row.dz))
-            else:
-                marker.reference.accuracy = (
-                    self.cfg["addGCPs"]["marker_location_accuracy"], 
-                    self.cfg["addGCPs"]["marker_location_accuracy"], 
-                    self.cfg["addGCPs"]["marker_location_accuracy"]
-                    )
+        set_marker_references(
+            index, marker_coordinate_data, 
+            [self.cfg["addGCPs"]["marker_location_accuracy"]] * 3
+            )
     
         self.doc.chunk.marker_location_accuracy = (
             self.cfg["addGCPs"]["marker_location_accuracy"], 
@@ -626,6 +872,12 @@ class AutomatedProcessing:
         for key, value in self.cfg["alignPhotos"].items():
             if key in alignCameras_dict:
                 align_parameters[key] = value 
+        
+        # explicit list of image pairs, selected from the camera positions
+        if "spatial_pairs" in self.cfg["alignPhotos"] and self.cfg["alignPhotos"]["spatial_pairs"]["enabled"]:
+            pairs = self._spatial_pairs()
+            if pairs is not None:
+                match_parameters["pairs"] = pairs
             
         if self.network:            
             task = Metashape.Tasks.MatchPhotos()
@@ -636,8 +888,18 @@ class AutomatedProcessing:
             task.decode(align_parameters)
             self._encode_task(task)
             
-            if self.cfg["alignPhotos"]["enabled"] and self.cfg["alignPhotos"]["double_alignment"]:
-                self.logger.warning("Re-alignment of non-aligned photos currently only supported in non-server mode...")
+            # the unaligned cameras are only known once the batch has run, so a
+            # single incremental alignment of all cameras is queued instead; 
+            # further identical rounds would not align any further cameras
+            rounds, escalate = self._realignment_settings()
+            if rounds:
+                task = Metashape.Tasks.AlignCameras()
+                task.decode({**align_parameters, "reset_alignment": False})
+                self._encode_task(task)
+                self.logger.info("Added a re-alignment of all cameras to the network batch list.")
+                if rounds > 1 or escalate is not None:
+                    self.logger.warning(f"Queued 1 of {rounds} re-alignment rounds: targeted rounds (of the unaligned " +\
+                                        "cameras only) and escalation are only supported in non-server mode...")
                 
             self.logger.info('Photo-alignment tasks added to network batch list.'+self._return_parameters(stage="alignPhotos"))
                 
@@ -648,26 +910,121 @@ class AutomatedProcessing:
             self.doc.chunk.alignCameras(**align_parameters
                 )
             self.doc.save()
+            self._invalidate_chunk_index("aligned")
             
-            if self.cfg["alignPhotos"]["enabled"] and self.cfg["alignPhotos"]["double_alignment"]:
-                align_parameters["reset_alignment"] = False
-                aligned_photos = []   # empty list
-                for camera in self.doc.chunk.cameras:
-                    if camera.transform==None:
-                        aligned_photos.append(camera)
-               
-                if len(aligned_photos)>0:
-                    self.logger.info(f"Detected {len(aligned_photos)} cameras that failed alignment. Repeating alignment stage...")
-                    self.doc.chunk.alignCameras(aligned_photos,**align_parameters)
-                    self.doc.save()
-                    aligned_photos = []   # empty list
-                    for camera in self.doc.chunk.cameras:
-                        if camera.transform==None:
-                            aligned_photos.append(camera)
-                    
-                    self.logger.info(f"{len(aligned_photos)} non-aligned cameras remain.")
+            rounds, escalate = self._realignment_settings()
+            if rounds:
+                self._realign_cameras(match_parameters, align_parameters, rounds, escalate)
             self.logger.info('Cameras aligned.'+self._return_parameters(stage="alignPhotos"))
+    
+    def _realignment_settings(self):
+        """
+        Returns the (rounds, escalate) of the re-alignment of cameras that 
+        failed alignment, from alignPhotos.realignment, or a single round 
+        without escalation if (only) double_alignment is set. escalate is a
+        dictionary of the escalation settings (empty for the defaults, e.g.
+        for escalate: true) or None.
+        """
+        cfg = self.cfg["alignPhotos"]
+        if "realignment" in cfg and cfg["realignment"]["enabled"]:
+            escalate = cfg["realignment"].get("escalate")
+            if escalate is True:
+                escalate = {}
+            elif escalate is False:
+                escalate = None
+            return cfg["realignment"].get("rounds", 3), escalate
+        if cfg.get("double_alignment", False):
+            return 1, None
+        return 0, None
+    
+    def _realign_cameras(self, match_parameters, align_parameters, rounds, escalate = None):
+        """
+        Re-aligns the cameras that failed alignment, for at most rounds rounds, 
+        each on the cameras that are still unaligned, and stops when a round 
+        aligns no further cameras. If escalate is set, the photos of these 
+        cameras are first matched again (only the pairs of these cameras), 
+        with keypoint_limit multiplied by keypoint_limit_factor (default 2) 
+        and, if refine_downscale is set, at the next finer downscale, in 
+        every round.
+        """
+        index = self.chunk_index
+        align_parameters = {key: value for key, value in align_parameters.items() if key != "cameras"}
+        align_parameters["reset_alignment"] = False
+        match_parameters = {key: value for key, value in match_parameters.items() if key != "cameras"}
+        match_parameters["reset_matches"] = False
+        
+        unaligned = index.unaligned_cameras
+        for round_ in range(1, rounds + 1):
+            if not unaligned:
+                break
+            self.logger.info(f"Re-alignment round {round_}/{rounds}: {len(unaligned)} cameras failed alignment.")
             
+            if escalate is not None:
+                match_parameters["keypoint_limit"] = int(
+                    match_parameters.get("keypoint_limit", 40000) * escalate.get("keypoint_limit_factor", 2)
+                    )
+                if escalate.get("refine_downscale", False):
+                    match_parameters["downscale"] = _finer_downscale.get(match_parameters.get("downscale", 1), 0)
+                keys = {camera.key for camera in unaligned}
+                rematch_parameters = dict(match_parameters)
+                if "pairs" in match_parameters:
+                    rematch_parameters["pairs"] = [pair for pair in match_parameters["pairs"] if pair[0] in keys or pair[1] in keys]
+                else:
+                    rematch_parameters["cameras"] = sorted(keys)
+                # an empty pair list would match all pairs
+                if rematch_parameters.get("pairs", True):
+                    self.logger.info(f"Matching their photos again with a keypoint limit of {match_parameters['keypoint_limit']}" +\
+                                     f" (downscale {match_parameters.get('downscale', 1)}).")
+                    self.doc.chunk.matchPhotos(**rematch_parameters)
+            
+            self.doc.chunk.alignCameras(unaligned, **align_parameters)
+            self.doc.save()
+            # only the realigned cameras can have changed
+            index.update_alignment(unaligned)
+            remaining = index.unaligned_cameras
+            self.logger.info(f"Aligned {len(unaligned) - len(remaining)} cameras, {len(remaining)} non-aligned cameras remain.")
+            if len(remaining) == len(unaligned):
+                self.logger.info("No further cameras aligned, stopping re-alignment.")
+                break
+            unaligned = remaining
+            
+    def _spatial_pairs(self):
+        """
+        Selects the image pairs of the enabled cameras from their positions (see
+        SpatialPairs): the reference location of a camera or, if use_exif is
+        set, the GPS position of its photo. Returns a list of (key, key) pairs,
+        or None if too few cameras have a position.
+        """
+        cfg = self.cfg["alignPhotos"]["spatial_pairs"]
+        index = self.chunk_index
+        paths = index.camera_paths
+        crs = self.doc.chunk.crs
+        use_exif = cfg.get("use_exif", True)
+        
+        def locate(camera):
+            location = camera.reference.location
+            if location is not None:
+                # geocentric coordinates are metric in any CRS
+                return tuple(crs.unproject(location)) if crs else tuple(location)
+            if use_exif:
+                position = read_gps_position(paths[camera])
+                if position:
+                    return geodetic_to_geocentric(position[0], position[1], position[2] or 0)
+            return None
+        
+        cameras = index.enabled_cameras
+        pairs = camera_pairs(
+            cameras, locate, 
+            k = cfg.get("neighbours", 20), 
+            radius = cfg.get("radius"), 
+            logger = self.logger
+            )
+        if pairs is not None:
+            exhaustive = len(cameras) * (len(cameras) - 1) // 2
+            self.logger.info(f'Selected {len(pairs)} image pairs of {len(cameras)} cameras from their positions ' +\
+                             f'({len(pairs) / max(exhaustive, 1):.2%} of {exhaustive} exhaustive pairs).')
+        return pairs
+    
     def optimize_cameras(self):
         '''
         Optimize cameras
@@ -700,7 +1057,7 @@ class AutomatedProcessing:
         # Disable camera locations as reference if specified in YML
         if "addGCPs" in self.cfg and self.cfg["addGCPs"]["enabled"] and self.cfg["addGCPs"]["optimize_w_gcps_only"]:
             self.logger.info('GCP-only optimisation enabled.')
-            for camera in self.doc.chunk.cameras:
+            for camera in self.chunk_index.all_cameras:
                 camera.reference.enabled = False
         
         if self.network:
@@ -715,6 +1072,7 @@ class AutomatedProcessing:
                 **optimize_parameters
                 )
             self.doc.save()
+            self._invalidate_chunk_index("aligned")
             self.logger.info('Optimised camera alignment.'+self._return_parameters(stage="optimizeCameras"))
             
     def build_depth_maps(self):
@@ -1137,17 +1495,4 @@ def stamp_time(): #  - thank you UCDavis!
     '''
     stamp = datetime.datetime.now().strftime('%Y%m%dT%H%M')
     return stamp
-
-# Used by add_gcps function - thank you UCDavis!
-def _get_marker(chunk, label):
-    for marker in chunk.markers:
-        if marker.label == label:
-            return marker
-    return None
-
-# Used by add_gcps function - thank you UCDavis!
-def _get_camera(chunk, label):
-    for camera in chunk.cameras:
-        if camera.label.lower() == label.lower():
-            return camera
-    return None          
+          
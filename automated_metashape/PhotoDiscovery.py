@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Peter Betlem
+@institution: University Centre in Svalbard, Svalbard
+@year: 2023
+
+Photo discovery shared by AutomatedProcessing.add_photos and the marker
+detection, so that both see the same set of photos, and the lookup of the
+mask files of photos.
+"""
+
+# import standard libs
+import os
+import re
+import json
+import time
+import logging
+from pathlib import Path
+
+# A single filter for all photos: supported extensions (case-insensitive),
+# excluding masks ({image_name}_mask.img_ext) and USGS DEM files.
+photo_filter = re.compile(
+    r"^(?!.*(_mask\.|dem_usgs\.tif)).*\.(jpg|jpeg|tif|tiff|dng)$",
+    re.IGNORECASE
+    )
+
+# Raw photos are added to the project (Metashape decodes them itself), but
+# OpenCV cannot decode them: cv2.imread reads at most the embedded preview of
+# a DNG. The marker detection and the local image analyses skip them.
+raw_extensions = (".dng",)
+
+# placeholders of Metashape mask path templates, e.g. {filename}_mask.png
+_mask_placeholders = re.compile(r"\{(filename|fileext|camera|frame)\}")
+
+# directory mtimes younger than this (in ns) relative to the scan are not
+# trusted, as (network) filesystems may have a coarse mtime resolution
+_MTIME_TOLERANCE = 2 * 10**9
+
+def iter_photos(photo_path, max_depth=1, manifest=None, logger=logging.getLogger(__name__)):
+    """
+    Generator yielding the paths of all photos in the folders below
+    photo_path, down to max_depth folder levels (the default of 1 corresponds
+    to the {photo_path}/{1XXMEDIA}/{photo} layout). Photos directly in
+    photo_path are ignored, as cameras are labeled {folder}/{filename}.
+    Hidden files and folders are skipped and photos are yielded in sorted
+    order per folder. Raw (DNG) photos are included, see raw_extensions.
+
+    If a manifest file is given, the (filtered) listing of every folder is
+    cached in it. Folders that have not been modified since the previous
+    scan are then not listed again, which saves most of the time on network
+    shares.
+    """
+    photo_path = Path(photo_path)
+    cached, updated = {}, {}
+    if manifest:
+        try:
+            with open(manifest, 'r') as file:
+                cached = json.load(file)["folders"]
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+    scan_time = time.time_ns()
+    reused = 0
+    stack = [("", 0)]
+    while stack:
+        folder, depth = stack.pop()
+        directory = os.path.join(photo_path, folder)
+
+        mtime = os.stat(directory).st_mtime_ns
+        entry = cached.get(folder)
+        if entry and entry["mtime"] == mtime and mtime < entry["scanned"] - _MTIME_TOLERANCE:
+            reused += 1
+        else:
+            entry = {"mtime": mtime, "scanned": scan_time, "photos": [], "folders": []}
+            with os.scandir(directory) as it:
+                for dir_entry in it:
+                    if dir_entry.name.startswith('.'):
+                        continue
+                    if dir_entry.is_dir():
+                        entry["folders"].append(dir_entry.name)
+                    elif photo_filter.match(dir_entry.name):
+                        entry["photos"].append(dir_entry.name)
+            entry["photos"].sort()
+            entry["folders"].sort()
+        updated[folder] = entry
+
+        if depth > 0:
+            for name in entry["photos"]:
+                yield os.path.join(directory, name)
+        if depth < max_depth:
+            # reversed, so that folders are popped in sorted order
+            stack.extend((os.path.join(folder, name), depth + 1) for name in reversed(entry["folders"]))
+
+    if manifest:
+        tmp_file = Path(manifest).with_suffix(".tmp")
+        with open(tmp_file, 'w') as file:
+            json.dump({"folders": updated}, file)
+        os.replace(tmp_file, manifest)
+        logger.info(f"Photo manifest: reused {reused} of {len(updated)} folder listings.")
+
+def camera_label(path):
+    """
+    Returns the {folder}/{filename} label of a photo, i.e. the label that
+    AutomatedProcessing.add_photos assigns to its camera, and under which its
+    markers are stored in the image coordinate table.
+    """
+    return "/".join(str(path).replace("\\", "/").split("/")[-2:])
+
+def is_raw_photo(path):
+    """
+    Returns whether a photo is in a raw format (see raw_extensions).
+    """
+    return str(path).lower().endswith(raw_extensions)
+
+def split_raw_photos(photo_files):
+    """
+    Splits photo_files into the photos that OpenCV can decode and the raw
+    photos, keeping their order.
+    """
+    decodable, raw = [], []
+    for filename in photo_files:
+        (raw if is_raw_photo(filename) else decodable).append(filename)
+    return decodable, raw
+
+def mask_path(template, photo_path, label = None, frame = 0):
+    """
+    Returns the mask file of a photo according to a Metashape mask path 
+    template, i.e. with {filename} (without extension), {fileext}, {camera}
+    (the camera label, by default the filename) and {frame} filled in.
+    """
+    filename, fileext = os.path.splitext(os.path.basename(str(photo_path)))
+    values = {"filename": filename, "fileext": fileext[1:], "camera": label or filename, "frame": str(frame)}
+    return _mask_placeholders.sub(lambda match: values[match.group(1)], str(template))
+
+def existing_masks(template, photo_paths, labels = None):
+    """
+    Returns for each photo whether its mask file (see mask_path) exists. Every
+    mask folder is listed once, instead of checking each file separately.
+    """
+    listings = {}
+    exists = []
+    for i, photo_path in enumerate(photo_paths):
+        folder, name = os.path.split(mask_path(template, photo_path, labels[i] if labels else None))
+        if folder not in listings:
+            try:
+                listings[folder] = set(os.listdir(folder or "."))
+            except OSError:
+                listings[folder] = set()
+        exists.append(name in listings[folder])
+    return exists
+
+def find_photos(photo_path, max_depth=1, manifest=False, logger=logging.getLogger(__name__)):
+    """
+    Returns the list of all photos found by iter_photos. If manifest is True,
+    the manifest is stored as .photo_manifest.json in photo_path.
+    """
+    if manifest is True:
+        manifest = Path(photo_path, ".photo_manifest.json")
+    return list(iter_photos(photo_path, max_depth, manifest or None, logger))
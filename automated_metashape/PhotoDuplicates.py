@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Peter Betlem
+@institution: University Centre in Svalbard, Svalbard
+@year: 2023
+
+Detection of near-duplicate photos (e.g. of a hovering drone or an interval
+timer) by their perceptual (difference) hash. Near-duplicates are found with
+a BK-tree of the hashes, which only compares a photo to the hashes within
+the Hamming distance of interest instead of to all other photos.
+
+A similar hash alone does not make a duplicate: the hashes of low-texture
+photos (e.g. of snow) are similar for entirely different scenes. Photos are
+only considered duplicates if they were also taken shortly after each other
+and, if their GPS positions are known, close to each other.
+"""
+
+# import standard libs
+import os
+import time
+import logging
+
+# import calc and image libs
+import numpy as np
+import cv2
+
+# import multiprocessing libs
+import multiprocessing as mp
+
+from .ImageIO import load_grayscale
+
+def difference_hash(gray, hash_size = 8):
+    """
+    Returns the difference hash of a grayscale image as an integer of
+    hash_size**2 bits: whether each pixel of the image, downsampled to
+    (hash_size + 1) x hash_size pixels, is brighter than its right neighbour.
+    """
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation = cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def normalised_grayscale(gray):
+    """
+    Removes the illumination (e.g. vignetting) from a grayscale image, by
+    subtracting a strongly blurred copy, and equalises the histogram of the
+    remaining detail. Without this, the illumination dominates the hash of
+    flat, low-contrast photos, so that all of them hash alike.
+    """
+    gray = gray.astype(np.float32)
+    detail = gray - cv2.GaussianBlur(gray, (0, 0), max(gray.shape) / 16)
+    detail = cv2.normalize(detail, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    return cv2.equalizeHist(detail)
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+def _hash_photo(task):
+    """
+    Pool worker returning the (filename, hash, sharpness) of a photo, from a
+    single reduced resolution decode, or (filename, None, None) if the photo
+    cannot be read. The hash is computed from the normalised photo.
+    """
+    filename, reduction = task
+    try:
+        gray = load_grayscale(filename, reduction)
+    except IOError:
+        return filename, None, None
+    return filename, difference_hash(normalised_grayscale(gray)), float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+def photo_hashes(photo_files, reduction = 8, workers = None, logger = logging.getLogger(__name__)):
+    """
+    Computes the difference hash and the sharpness (variance of the Laplacian,
+    see ImageQuality) of photo_files, decoded at 1/reduction of their
+    resolution, in a local process pool. Returns {filename: (hash, sharpness)}
+    of the readable photos.
+    """
+    start = time.perf_counter()
+    hashes = {}
+    with mp.Pool(workers) as pool:
+        tasks = [(filename, reduction) for filename in photo_files]
+        for filename, photo_hash, sharpness in pool.imap_unordered(_hash_photo, tasks, chunksize = 4):
+            if photo_hash is None:
+                logger.warning(f"Unable to read {filename}, skipping it.")
+                continue
+            hashes[filename] = (photo_hash, sharpness)
+    elapsed = time.perf_counter() - start
+    logger.info(f"Hashed {len(photo_files)} photos in {elapsed:.2f} s " +\
+                f"({len(photo_files) / max(elapsed, 1e-9):.1f} photos/s).")
+    return hashes
+
+class bk_tree():
+    """
+    Burkhard-Keller tree of hashes, for the lookup of all items with a hash
+    within a Hamming distance of a query hash. Every node is a (hash, items,
+    {distance: child}) tuple; the triangle inequality restricts the search to
+    the children at a distance of the query distance +- the radius.
+    """
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, value, item):
+        self.size += 1
+        if self.root is None:
+            self.root = (value, [item], {})
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            if distance not in node[2]:
+                node[2][distance] = (value, [item], {})
+                return
+            node = node[2][distance]
+
+    def query(self, value, radius):
+        """
+        Returns the items with a hash within radius of value.
+        """
+        found = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node_value, items, children = stack.pop()
+            distance = hamming_distance(value, node_value)
+            if distance <= radius:
+                found.extend(items)
+            stack.extend(
+                child for child_distance, child in children.items()
+                if distance - radius <= child_distance <= distance + radius
+                )
+        return found
+
+def find_duplicates(hashes, max_distance = 4, max_sequence_gap = 3, positions = None, max_offset = None):
+    """
+    Clusters near-duplicate photos, given {filename: (hash, sharpness)}.
+    Starting from the sharpest photo, every photo that is not yet part of a
+    cluster keeps all unclustered photos within max_distance bits of its hash
+    as duplicates, so that every duplicate resembles a sharper photo that is
+    kept (rather than chaining a slow series of photos into one cluster).
+
+    Besides the hash, duplicates need to be in the same folder (e.g.
+    100MEDIA) at most max_sequence_gap positions apart in the (sorted)
+    sequence of its photos and, if max_offset is set, at most max_offset
+    apart in space, given positions {filename: (x, y, z)} (in metres) of the
+    photos with a known position. At least one of the two needs to be set.
+
+    Returns {kept filename: [duplicate filenames]} of the clusters with
+    duplicates.
+    """
+    if max_sequence_gap is None and max_offset is None:
+        raise ValueError("Set max_sequence_gap, max_offset, or both, to find duplicates.")
+    positions = {filename: np.asarray(p, dtype = float) for filename, p in (positions or {}).items()}
+
+    def nearby(a, b):
+        if max_sequence_gap is not None and (
+                sequence[a][0] != sequence[b][0] or abs(sequence[a][1] - sequence[b][1]) > max_sequence_gap
+                ):
+            return False
+        if max_offset is not None and a in positions and b in positions:
+            return np.linalg.norm(positions[a] - positions[b]) <= max_offset
+        return max_sequence_gap is not None or (a in positions and b in positions)
+
+    # the capture sequence restarts in every folder
+    sequence, counts = {}, {}
+    for filename in sorted(hashes):
+        folder = os.path.dirname(filename)
+        sequence[filename] = (folder, counts.get(folder, 0))
+        counts[folder] = sequence[filename][1] + 1
+    tree = bk_tree()
+    for filename, (photo_hash, _) in hashes.items():
+        tree.add(photo_hash, filename)
+
+    clustered = set()
+    clusters = {}
+    for filename in sorted(hashes, key = lambda filename: -hashes[filename][1]):
+        if filename in clustered:
+            continue
+        clustered.add(filename)
+        duplicates = [
+            other for other in tree.query(hashes[filename][0], max_distance)
+            if other not in clustered and nearby(filename, other)
+            ]
+        if duplicates:
+            clustered.update(duplicates)
+            clusters[filename] = sorted(duplicates)
+    return clusters
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Peter Betlem
+@institution: University Centre in Svalbard, Svalbard
+@year: 2023
+
+Pre-scan of the photos before they are added to a Metashape project: reads
+the header and EXIF metadata of every photo (see ImageHeaders) in a pool of
+workers, rejects photos that are unreadable or truncated (e.g. copied from a
+damaged SD card) before they fail later processing stages, and groups the
+photos by sensor.
+
+The scan results are cached per photo (validated against the file size and
+modification time), so that repeat runs only read new or changed photos.
+"""
+
+# import standard libs
+import os
+import time
+import shutil
+import logging
+from pathlib import Path
+
+# import multiprocessing libs
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+
+from .ImageHeaders import read_image_header
+from .FileCache import file_cache, unchanged
+
+# reading headers is I/O bound, so threads suffice unless the photos are local
+_scan_backends = {"process": mp.Pool, "thread": ThreadPool}
+
+# version of the cached scan results, to be increased when read_image_header
+# returns other or different metadata
+_SCAN_VERSION = 2
+
+def _scan_photo(task):
+    """
+    Pool worker returning the (filename, scan, stat, cached) of a photo. The
+    scan holds either the header or the error of the photo; the cached scan
+    (see FileCache) is returned as is if the photo has not changed. The stat
+    is None if the photo is missing.
+    """
+    filename, cached = task
+    try:
+        stat = os.stat(filename)
+    except OSError as e:
+        return filename, {"header": None, "error": f"missing ({e})"}, None, False
+    if unchanged(cached, stat):
+        return filename, cached["scan"], stat, True
+
+    scan = {"header": None, "error": None}
+    try:
+        scan["header"] = read_image_header(filename)
+        if not scan["header"]["complete"]:
+            scan["error"] = "truncated"
+    except ValueError as e:
+        scan["error"] = str(e)
+    return filename, scan, stat, False
+
+def scan_photos(photo_files, workers = None, backend = "thread", cache_file = None,
+                logger = logging.getLogger(__name__)):
+    """
+    Scans the headers of photo_files in a pool of workers (thread or process
+    backend). Returns {filename: header} of the readable photos and
+    {filename: error} of the rejected photos. If a cache_file is given, the
+    results of unchanged photos are taken from it.
+    """
+    if backend not in _scan_backends:
+        raise ValueError(f"Unknown pre-scan backend '{backend}', " +\
+                         f"choose from {', '.join(_scan_backends)}.")
+    if workers is None and backend == "thread":
+        workers = min(32, 4 * (os.cpu_count() or 1))
+    cache = file_cache(cache_file, {"version": _SCAN_VERSION}, "scan", name = "photo scan cache",
+                       logger = logger) if cache_file else None
+
+    headers, rejected = {}, {}
+    hits = 0
+    progress_interval = max(1, len(photo_files) // 10)
+    start = time.perf_counter()
+    tasks = [(filename, cache.entry(filename) if cache else None) for filename in photo_files]
+    with _scan_backends[backend](workers) as pool:
+        for i, (filename, scan, stat, cached) in enumerate(pool.imap_unordered(_scan_photo, tasks, chunksize = 16), 1):
+            hits += cached
+            if cache and stat is not None:
+                cache.store(filename, scan, stat)
+            if scan["error"]:
+                rejected[filename] = scan["error"]
+                logger.warning(f"Rejected {filename}: {scan['error']}.")
+            else:
+                headers[filename] = scan["header"]
+            if i % progress_interval == 0:
+                logger.debug(f"Scanned {i}/{len(photo_files)} photos.")
+    elapsed = time.perf_counter() - start
+
+    if cache:
+        cache.save()
+    logger.info(f"Scanned {len(photo_files)} photos in {elapsed:.2f} s " +\
+                f"({len(photo_files) / max(elapsed, 1e-9):.0f} photos/s, {hits} cached): " +\
+                f"{len(headers)} readable, {len(rejected)} rejected.")
+    return headers, rejected
+
+def sensor_groups(headers):
+    """
+    Groups the photos by sensor, i.e. by camera make and model, image size
+    and focal length, as Metashape does when adding photos. Returns
+    {(make, model, width, height, focal_length): [filenames]}.
+    """
+    groups = {}
+    for filename, header in headers.items():
+        key = (header["make"], header["model"], header["width"], header["height"], header["focal_length"])
+        groups.setdefault(key, []).append(filename)
+    return groups
+
+def quarantine_photos(photo_files, photo_path, logger = logging.getLogger(__name__)):
+    """
+    Moves photo_files into {photo_path}/.quarantine, keeping their path
+    relative to photo_path, so that they are no longer found by find_photos.
+    Returns the new paths.
+    """
+    quarantine = Path(photo_path, ".quarantine")
+    moved = []
+    for filename in photo_files:
+        try:
+            target = Path(quarantine, Path(filename).resolve().relative_to(Path(photo_path).resolve()))
+        except ValueError:
+            target = Path(quarantine, Path(filename).name)
+        target.parent.mkdir(parents = True, exist_ok = True)
+        shutil.move(filename, target)
+        moved.append(target)
+    if moved:
+        logger.warning(f"Moved {len(moved)} rejected photos to {quarantine}.")
+    return moved
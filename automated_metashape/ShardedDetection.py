@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Peter Betlem
+@institution: University Centre in Svalbard, Svalbard
+@year: 2023
+
+Sharded marker detection, to spread the detection over several nodes that
+share the photo_path (e.g. the nodes of a Metashape network):
+
+1. create: a manifest splits the photos into shards, stored with the detection
+   configuration in {photo_path}/gcps/shards/manifest.json;
+2. worker: every node runs the worker command on the manifest, which claims
+   unprocessed shards one by one (or processes a given shard) and writes a
+   partial result per shard next to the manifest;
+3. merge: the partial results are merged into gcp_imagecoords_table.
+
+Photos are stored relative to the photo_path, which is derived from the
+location of the manifest, so nodes may mount the shared filesystem at
+different paths. Steps 1-3 are run by sharded_detection when the sharding of
+detectGCPs is enabled, optionally starting local worker processes as nodes.
+From the command line:
+
+    python -m automated_metashape.ShardedDetection create config.yml --shards 24
+    python -m automated_metashape.ShardedDetection worker {photo_path}/gcps/shards/manifest.json
+    python -m automated_metashape.ShardedDetection merge {photo_path}/gcps/shards/manifest.json
+    python -m automated_metashape.ShardedDetection run {photo_path}/gcps/shards/manifest.json --nodes 4
+"""
+
+# import standard libs
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import logging
+import subprocess
+from pathlib import Path
+
+# import calc libs
+import numpy as np
+
+from .read_yaml import read_yaml
+from .PhotoDiscovery import find_photos
+from .ImageMarkers import marker_detection, dictionary_name, aruco_dicts, detection_settings, marker_record
+from .ImageCoordinates import image_coordinate_store, read_image_coordinates
+
+def _shard_dir(photo_path):
+    return Path(photo_path, "gcps", "shards")
+
+def _shard_path(manifest_path, index):
+    return Path(Path(manifest_path).parent, f"shard-{index:05d}")
+
+def _dictionaries(cfg):
+    return {d: dictionary_name(d) for d in aruco_dicts(cfg["detectGCPs"]["aruco_dict"])}
+
+def create_manifest(cfg, shards = None, shard_size = None, logger = logging.getLogger(__name__)):
+    """
+    Splits the photos in the photo_path into shards, either a given number of
+    shards or shards of shard_size photos, of consecutive photos (so that
+    sequences stay together for tracking). Results of previous sharded runs
+    are removed. Returns the path of the manifest.
+    """
+    photo_path = Path(cfg["detectGCPs"]["photo_path"])
+    photo_files = find_photos(
+        photo_path,
+        max_depth = cfg["detectGCPs"].get("max_depth", 1),
+        manifest = cfg["detectGCPs"].get("photo_manifest", False),
+        logger = logger
+        )
+    if not photo_files:
+        raise ValueError(f"No photos found in {photo_path}.")
+    if not shard_size:
+        shard_size = int(np.ceil(len(photo_files) / (shards or 1)))
+    labels = [Path(f).relative_to(photo_path).as_posix() for f in photo_files]
+
+    shard_dir = _shard_dir(photo_path)
+    shard_dir.mkdir(parents = True, exist_ok = True)
+    for entry in os.scandir(shard_dir):
+        if entry.name.startswith("shard-"):
+            if entry.is_dir():
+                for part in os.scandir(entry.path):
+                    os.remove(part.path)
+                os.rmdir(entry.path)
+            else:
+                os.remove(entry.path)
+
+    manifest = {
+        "created": time.time(),
+        "settings": detection_settings(cfg),
+        "detectGCPs": {k: v for k, v in cfg["detectGCPs"].items() if k != "photo_path"},
+        "shards": [labels[i:i + shard_size] for i in range(0, len(labels), shard_size)],
+        }
+    manifest_path = Path(shard_dir, "manifest.json")
+    tmp_file = manifest_path.with_suffix(".tmp")
+    with open(tmp_file, 'w') as file:
+        json.dump(manifest, file, default = str)
+    os.replace(tmp_file, manifest_path)
+
+    logger.info(f"Split {len(photo_files)} photos into {len(manifest['shards'])} shards " +\
+                f"of up to {shard_size} photos, see {manifest_path}.")
+    return manifest_path
+
+def load_manifest(manifest_path):
+    """
+    Returns the configuration (as used by marker_detection) and the shards
+    (lists of photo paths) of a manifest.
+    """
+    manifest_path = Path(manifest_path).resolve()
+    with open(manifest_path, 'r') as file:
+        manifest = json.load(file)
+    photo_path = manifest_path.parents[2]
+    cfg = {
+        "photo_path": photo_path,
+        "detectGCPs": {**manifest["detectGCPs"], "photo_path": photo_path}
+        }
+    shards = [[str(Path(photo_path, label)) for label in shard] for shard in manifest["shards"]]
+    return cfg, shards
+
+def shard_done(manifest_path, index):
+    return image_coordinate_store(_shard_path(manifest_path, index), "npz").exists
+
+def claim_shard(manifest_path, index, claim_timeout = 3600):
+    """
+    Claims a shard for this node, by creating its claim file. Claims older
+    than claim_timeout seconds are considered abandoned and can be taken over.
+    Returns whether the shard was claimed.
+    """
+    claim = _shard_path(manifest_path, index).with_suffix(".claim")
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    try:
+        fd = os.open(claim, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        try:
+            if time.time() - os.stat(claim).st_mtime < claim_timeout:
+                return False
+        except FileNotFoundError:
+            return False
+        tmp_file = claim.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_file, 'w') as file:
+            file.write(owner)
+        os.replace(tmp_file, claim)
+        return True
+    with os.fdopen(fd, 'w') as file:
+        file.write(owner)
+    return True
+
+def process_shard(manifest_path, index, workers = None, logger = logging.getLogger(__name__)):
+    """
+    Runs the marker detection on a single shard, writing its partial result.
+    The detection cache is not used, as it is not safe to share between nodes.
+    """
+    cfg, shards = load_manifest(manifest_path)
+    cfg["detectGCPs"]["cache"] = {"enabled": False}
+    if workers:
+        cfg["detectGCPs"]["workers"] = workers
+
+    logger.info(f"Processing shard {index} ({len(shards[index])} photos) on {socket.gethostname()}.")
+    output = image_coordinate_store(
+        _shard_path(manifest_path, index), "npz", dictionaries = _dictionaries(cfg), logger = logger
+        )
+    marker_detection(cfg, logger = logger, photo_files = shards[index], output = output)
+
+def run_worker(manifest_path, shard = None, workers = None, claim_timeout = 3600,
+               logger = logging.getLogger(__name__)):
+    """
+    Processes the given shard, or claims and processes unfinished shards until
+    all shards are claimed. Returns the indices of the processed shards.
+    """
+    _, shards = load_manifest(manifest_path)
+    if shard is not None:
+        process_shard(manifest_path, shard, workers, logger)
+        return [shard]
+
+    processed = []
+    for index in range(len(shards)):
+        if shard_done(manifest_path, index) or not claim_shard(manifest_path, index, claim_timeout):
+            continue
+        process_shard(manifest_path, index, workers, logger)
+        processed.append(index)
+    logger.info(f"Worker processed {len(processed)} shards: {processed}.")
+    return processed
+
+def wait_for_shards(manifest_path, poll_interval = 10, timeout = None, logger = logging.getLogger(__name__)):
+    """
+    Waits until the partial results of all shards are written.
+    """
+    _, shards = load_manifest(manifest_path)
+    start = time.time()
+    while True:
+        pending = [i for i in range(len(shards)) if not shard_done(manifest_path, i)]
+        if not pending:
+            return
+        if timeout and time.time() - start > timeout:
+            raise TimeoutError(f"{len(pending)} of {len(shards)} shards unfinished after {timeout} s: {pending}.")
+        logger.info(f"Waiting for {len(pending)} of {len(shards)} shards...")
+        time.sleep(poll_interval)
+
+def merge_shards(manifest_path, logger = logging.getLogger(__name__)):
+    """
+    Merges the partial results of all shards into the image coordinate table
+    (in the output_format of the configuration). Returns its path.
+    """
+    cfg, shards = load_manifest(manifest_path)
+    pending = [i for i in range(len(shards)) if not shard_done(manifest_path, i)]
+    if pending:
+        raise ValueError(f"Unable to merge, {len(pending)} shards are unfinished: {pending}.")
+
+    dictionaries = _dictionaries(cfg)
+    tags = {name: d for d, name in dictionaries.items()}
+    output = image_coordinate_store(
+        Path(cfg["detectGCPs"]["photo_path"], "gcps", "prepared", "gcp_imagecoords_table"),
+        output_format = cfg["detectGCPs"].get("output_format", "csv"),
+        dictionaries = dictionaries,
+        logger = logger
+        )
+    marker_count = 0
+    with output:
+        for index in range(len(shards)):
+            df = read_image_coordinates(image_coordinate_store(_shard_path(manifest_path, index), "npz").path)
+            for camera, rows in df.groupby("camera", sort = False):
+                records = np.zeros(len(rows), dtype = marker_record)
+                records["marker"], records["x"], records["y"] = rows["marker"], rows["x"], rows["y"]
+                records["dictionary"] = rows["dictionary"].map(tags).fillna(next(iter(dictionaries)))
+                output.write(camera, records)
+            marker_count += len(df)
+
+    if not marker_count:
+        raise ValueError(f"No markers detected in {sum(map(len, shards))} images.")
+    logger.info(f"Merged {marker_count} markers of {len(shards)} shards into {output.path}.")
+    return output.path
+
+def run_local(manifest_path, nodes = 2, workers = None, logger = logging.getLogger(__name__)):
+    """
+    Runs the worker command in nodes local processes, acting as the nodes of
+    a cluster, and merges their results.
+    """
+    command = [sys.executable, "-m", "automated_metashape.ShardedDetection", "worker", str(manifest_path)]
+    if workers:
+        command += ["--workers", str(workers)]
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [str(Path(__file__).resolve().parents[1]), env.get("PYTHONPATH")]))
+
+    logger.info(f"Starting {nodes} local worker nodes.")
+    processes = [subprocess.Popen(command, env = env) for _ in range(nodes)]
+    failed = [p.args for p in processes if p.wait() != 0]
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {nodes} local worker nodes failed.")
+    return merge_shards(manifest_path, logger)
+
+def sharded_detection(cfg, logger = logging.getLogger(__name__)):
+    """
+    Runs the sharded detection as configured in detectGCPs.sharding: splits
+    the photos into shards (shards or shard_size), starts local_nodes local
+    worker nodes (if set) or waits for workers started on other nodes (for at
+    most timeout seconds, polling every poll_interval seconds), and merges
+    their results.
+    """
+    sharding = cfg["detectGCPs"]["sharding"]
+    manifest_path = create_manifest(cfg, sharding.get("shards"), sharding.get("shard_size"), logger)
+    if sharding.get("local_nodes"):
+        return run_local(manifest_path, sharding["local_nodes"], sharding.get("workers_per_node"), logger)
+
+    logger.info("Start the detection on every node with: " +\
+                f"python -m automated_metashape.ShardedDetection worker {manifest_path}")
+    wait_for_shards(manifest_path, sharding.get("poll_interval", 10), sharding.get("timeout"), logger)
+    return merge_shards(manifest_path, logger)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Sharded marker detection.")
+    commands = parser.add_subparsers(dest = "command", required = True)
+
+    create = commands.add_parser("create", help = "split the photos of a configuration into shards")
+    create.add_argument("config", help = "YML configuration file")
+    create.add_argument("--shards", type = int, default = None)
+    create.add_argument("--shard-size", type = int, default = None)
+
+    worker = commands.add_parser("worker", help = "process a shard, or claim and process unfinished shards")
+    worker.add_argument("manifest")
+    worker.add_argument("--shard", type = int, default = None)
+    worker.add_argument("--workers", type = int, default = None, help = "detection workers on this node")
+    worker.add_argument("--claim-timeout", type = float, default = 3600)
+
+    merge = commands.add_parser("merge", help = "merge the results of all shards")
+    merge.add_argument("manifest")
+
+    run = commands.add_parser("run", help = "run all shards on local worker processes and merge")
+    run.add_argument("manifest")
+    run.add_argument("--nodes", type = int, default = 2)
+    run.add_argument("--workers", type = int, default = None, help = "detection workers per node")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level = logging.INFO, format = '%(asctime)s [%(levelname)s] %(name)s: %(message)s')
+    logger = logging.getLogger("ShardedDetection")
+
+    if args.command == "create":
+        create_manifest(read_yaml(args.config), args.shards, args.shard_size, logger)
+    elif args.command == "worker":
+        run_worker(args.manifest, args.shard, args.workers, args.claim_timeout, logger)
+    elif args.command == "merge":
+        merge_shards(args.manifest, logger)
+    else:
+        run_local(args.manifest, args.nodes, args.workers, logger)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Peter Betlem
+@institution: University Centre in Svalbard, Svalbard
+@year: 2023
+
+Selection of the image pairs to match from the camera positions, as an
+explicit pair list for matchPhotos: every camera is paired with its k nearest
+neighbours (optionally limited to a radius), instead of leaving the pair
+selection of e.g. long corridor surveys to the preselection of Metashape.
+
+Neighbours are found with a KD-tree (scipy), or with a blockwise brute force
+search if scipy is not available. Metashape itself is not imported here, so
+that the pair selection can be used (and benchmarked) with stand-in cameras.
+"""
+
+# import standard libs
+import itertools
+import logging
+
+# import calc libs
+import numpy as np
+
+try:  # optional, for the KD-tree neighbour search
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+# WGS84 ellipsoid
+_WGS84_A = 6378137.0
+_WGS84_E2 = 6.69437999014e-3
+
+def geodetic_to_geocentric(longitude, latitude, altitude = 0):
+    """
+    Returns the geocentric (x, y, z) in metres of a WGS84 position in decimal
+    degrees (and metres), e.g. of an EXIF GPS position.
+    """
+    lon, lat = np.radians(longitude), np.radians(latitude)
+    n = _WGS84_A / np.sqrt(1 - _WGS84_E2 * np.sin(lat)**2)
+    return (
+        (n + altitude) * np.cos(lat) * np.cos(lon),
+        (n + altitude) * np.cos(lat) * np.sin(lon),
+        (n * (1 - _WGS84_E2) + altitude) * np.sin(lat),
+        )
+
+def neighbour_pairs(positions, k = 10, radius = None):
+    """
+    Returns the unique index pairs (i, j), with i < j, of the positions (an
+    n x 2 or n x 3 array in metres) of which j is one of the k nearest
+    neighbours of i or vice versa, within radius if given. Without k, all
+    pairs within radius are returned.
+    """
+    positions = np.asarray(positions, dtype = float)
+    n = len(positions)
+    if k is None and radius is None:
+        raise ValueError("Set k, radius, or both to select neighbour pairs.")
+    if n < 2:
+        return np.empty((0, 2), dtype = np.int64)
+
+    if cKDTree is not None:
+        tree = cKDTree(positions)
+        if k is None:
+            pairs = tree.query_pairs(radius, output_type = 'ndarray').astype(np.int64).reshape(-1, 2)
+        else:
+            k = min(k, n - 1)
+            distances, neighbours = tree.query(positions, k = k + 1, distance_upper_bound = np.inf if radius is None else radius)
+            pairs = np.column_stack([np.repeat(np.arange(n), k + 1), neighbours.ravel()])
+            pairs = pairs[np.isfinite(distances.ravel())]
+    else:
+        pairs = _neighbour_pairs_bruteforce(positions, k, radius)
+
+    pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+    return np.unique(np.sort(pairs, axis = 1), axis = 0)
+
+def _neighbour_pairs_bruteforce(positions, k = None, radius = None, block_size = 512):
+    """
+    Neighbour search without scipy, computing the distances of a block of
+    positions to all positions at a time.
+    """
+    n = len(positions)
+    # relative to the centre, to limit the rounding errors of the squared norms
+    positions = positions - positions.mean(axis = 0)
+    norms = (positions**2).sum(axis = 1)
+    pairs = []
+    for start in range(0, n, block_size):
+        block = np.arange(start, min(start + block_size, n))
+        distances = norms[block, None] + norms[None, :] - 2 * positions[block] @ positions.T
+        distances = np.sqrt(np.maximum(distances, 0))
+        distances[np.arange(len(block)), block] = np.inf
+        if k is not None:
+            kk = min(k, n - 1)
+            neighbours = np.argpartition(distances, kk - 1, axis = 1)[:, :kk]
+            rows = np.repeat(block, kk)
+            columns = neighbours.ravel()
+            within = np.isfinite(distances[rows - start, columns]) if radius is None else \
+                distances[rows - start, columns] <= radius
+        else:
+            rows, columns = np.nonzero(distances <= radius)
+            rows = block[rows]
+            within = slice(None)
+        pairs.append(np.column_stack([rows, columns])[within])
+    return np.concatenate(pairs).astype(np.int64)
+
+def camera_pairs(cameras, locate, k = 10, radius = None, logger = logging.getLogger(__name__)):
+    """
+    Returns the (key, key) pairs of the cameras to match: the neighbour pairs
+    (see neighbour_pairs) of the cameras with a position, as returned by
+    locate(camera) as (x, y, z) in metres, or None if unknown. Cameras
+    without a position are paired with all other cameras. Returns None if
+    fewer than two cameras have a position.
+    """
+    positions, located, unlocated = [], [], []
+    for camera in cameras:
+        position = locate(camera)
+        if position is None:
+            unlocated.append(camera)
+        else:
+            positions.append(tuple(position))
+            located.append(camera)
+    if len(located) < 2:
+        logger.warning(f"Only {len(located)} of {len(cameras)} cameras have a position, " +\
+                       "unable to select image pairs spatially.")
+        return None
+
+    keys = np.array([camera.key for camera in located])
+    pairs = [tuple(pair) for pair in keys[neighbour_pairs(positions, k, radius)].tolist()]
+    if unlocated:
+        logger.warning(f"{len(unlocated)} cameras without position are paired with all other cameras.")
+        unlocated_keys = [camera.key for camera in unlocated]
+        pairs.extend((a, b) for a in unlocated_keys for b in keys.tolist())
+        pairs.extend(itertools.combinations(unlocated_keys, 2))
+    return pairs
@@ -9,8 +9,9 @@ except ModuleNotFoundError as e:
     print("Unable to import Metashape functions." + \
           "Please see readme for instructions." + \
           "This limits scrips capabilities to marker-functions only...")
+    Metashape = None
 
-if Metashape.app.version in ['1.7']:
+if Metashape and Metashape.app.version in ['1.7']:
     raise ValueError(f"Automated_metashape requires Agisoft Metashape v1.7.x. Version Metashape.app.version installed on system.")
     
     
@@ -19,10 +20,14 @@ import pkg_resources
 import distutils.dist
 import io
 
-am = pkg_resources.get_distribution('automated_metashape')
-metadata_str = am.get_metadata(am.PKG_INFO)
 metadata_obj = distutils.dist.DistributionMetadata()
-metadata_obj.read_pkg_file(io.StringIO(metadata_str))
+try:
+    am = pkg_resources.get_distribution('automated_metashape')
+    metadata_str = am.get_metadata(am.PKG_INFO)
+    metadata_obj.read_pkg_file(io.StringIO(metadata_str))
+except pkg_resources.DistributionNotFound:
+    # running from a source checkout, e.g. the benchmarks
+    pass
 
 __version__ = metadata_obj.version
 __author__ = metadata_obj.author
@@ -14,7 +14,12 @@ import os
 # import specialised libs
 import yaml
 import pathlib
-import Metashape
+
+try:
+    import Metashape
+except ModuleNotFoundError:
+    print("Unable to load Metashape libraries.")
+    pass
 
 try:
     from cv2 import aruco
@@ -28,16 +33,27 @@ Part below based on https://stackoverflow.com/a/25896596/237354
 
 """
 
+# prefixes of the values that are evaluated as Metashape or OpenCV constants
+_expression_prefixes = ("Metashape.", "aruco.", "cv2.aruco.")
+
+def _is_expression(value):
+    return isinstance(value, str) and value.strip().startswith(_expression_prefixes)
+
+def _evaluate(value):
+    value = value.strip()
+    # cv2.aruco.X is aruco.X
+    return eval(value[len("cv2."):] if value.startswith("cv2.") else value)
+
 def convert_paths_and_commands(a_dict):
     for k, v in a_dict.items():
         if not isinstance(v, dict):
             if isinstance(v, str):
                 if v and ('path' in k):    # all paths that are supplied in the config file are automatically converted to Path type
                     a_dict[k] = pathlib.Path(v)
-                elif v and ('Metashape' in v or 'aruco' in v) and not ('path' in k) and not ('project' in k): # for Metashape compatibility
-                    a_dict[k] = eval(v)
+                elif _is_expression(v) and not ('path' in k) and not ('project' in k): # for Metashape compatibility
+                    a_dict[k] = _evaluate(v)
             elif isinstance(v, list):
-                a_dict[k] =  [eval(item) for item in v if("Metashape" in item)]
+                a_dict[k] =  [_evaluate(item) if _is_expression(item) else item for item in v]
         else:
             a_dict[k] = convert_paths_and_commands(v)
     return a_dict
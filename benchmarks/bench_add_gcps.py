@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the GCP import of add_gcps on a stand-in chunk.
+
+Builds a stand-in Metashape chunk with synthetic cameras and a table of
+marker projections, and times the import of the projections and reference
+coordinates through the label indexes of ChunkIndex, against the previous
+approach of a linear search through chunk.cameras and chunk.markers per row
+(timed on a subset of the rows, as it scales with rows x cameras). Runs
+offline, without Metashape, e.g.:
+
+    python benchmarks/bench_add_gcps.py --cameras 5000 --projections 60000
+"""
+
+# import standard libs
+import sys
+import argparse
+import logging
+import time
+from pathlib import Path
+
+# import calc libs
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from automated_metashape.ChunkIndex import chunk_index, add_marker_projections, set_marker_references
+
+class stand_in():
+    """
+    Minimal stand-in for Metashape objects (cameras, markers, references).
+    """
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+class stand_in_chunk():
+    def __init__(self, camera_labels):
+        self.cameras = [stand_in(label = label) for label in camera_labels]
+        self.markers = []
+
+    def addMarker(self):
+        marker = stand_in(label = "", projections = {}, reference = stand_in(location = None, accuracy = None))
+        self.markers.append(marker)
+        return marker
+
+def synthetic_tables(n_cameras, n_projections, n_markers, missing = 0.01, seed = 0):
+    """
+    Returns the camera labels, the marker projections (marker, camera, x, y,
+    label; a fraction missing of which on photos that are not in the chunk)
+    and the reference coordinates (marker, x, y, z) of a synthetic survey.
+    """
+    rng = np.random.default_rng(seed)
+    cameras = [f"{100 + i // 500}MEDIA/DJI_{i:05d}.JPG" for i in range(n_cameras)]
+    photos = np.array(cameras + [f"999MEDIA/DJI_{i:05d}.JPG" for i in range(max(1, int(n_cameras * missing)))])
+    weights = np.r_[np.full(n_cameras, (1 - missing) / n_cameras), np.full(len(photos) - n_cameras, missing / (len(photos) - n_cameras))]
+
+    markers = rng.integers(0, n_markers, n_projections)
+    projections = pd.DataFrame({
+        "marker": markers,
+        "camera": rng.choice(photos, n_projections, p = weights),
+        "x": rng.uniform(0, 5472, n_projections),
+        "y": rng.uniform(0, 3648, n_projections),
+        })
+    projections["label"] = projections["marker"].astype(str)
+    references = pd.DataFrame({
+        "marker": np.arange(n_markers),
+        "x": rng.uniform(5e5, 6e5, n_markers),
+        "y": rng.uniform(8.6e6, 8.7e6, n_markers),
+        "z": rng.uniform(0, 1000, n_markers),
+        })
+    return cameras, projections, references
+
+def legacy_import(chunk, projections):
+    """
+    The previous add_gcps loop: iterrows with a linear search per row.
+    """
+    def get_marker(label):
+        for marker in chunk.markers:
+            if marker.label == label:
+                return marker
+        return None
+
+    def get_camera(label):
+        for camera in chunk.cameras:
+            if camera.label.lower() == label.lower():
+                return camera
+        return None
+
+    for _, row in projections.iterrows():
+        camera = get_camera(row.camera)
+        if not camera:
+            continue
+        marker = get_marker(str(int(row.marker)))
+        if not marker:
+            marker = chunk.addMarker()
+            marker.label = str(int(row.marker))
+        marker.projections[camera] = ((float(row.x), float(row.y)), True)
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split("\n\n")[0])
+    parser.add_argument("--cameras", type = int, default = 5000)
+    parser.add_argument("--projections", type = int, default = 60000)
+    parser.add_argument("--markers", type = int, default = 200)
+    parser.add_argument("--legacy-rows", type = int, default = 2000, help = "rows to time the previous approach on")
+    parser.add_argument("--seed", type = int, default = 0)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level = logging.WARNING, format = '%(asctime)s [%(levelname)s] %(name)s: %(message)s')
+    logger = logging.getLogger("benchmark")
+
+    cameras, projections, references = synthetic_tables(args.cameras, args.projections, args.markers, seed = args.seed)
+    print(f"{args.cameras} cameras, {args.projections} projections of {args.markers} markers.\n")
+
+    chunk = stand_in_chunk(cameras)
+    start = time.perf_counter()
+    index = chunk_index(chunk)
+    indexed = time.perf_counter() - start
+    added = add_marker_projections(index, projections, lambda x, y: ((x, y), True), logger)
+    projected = time.perf_counter() - start - indexed
+    set_marker_references(index, references, (0.05, 0.05, 0.05))
+    referenced = time.perf_counter() - start - indexed - projected
+    total = indexed + projected + referenced
+    print(f"Indexed import:  {total:8.3f} s (index {indexed:.3f} s, projections {projected:.3f} s, " +\
+          f"references {referenced:.3f} s), {added} projections added")
+
+    rows = projections.iloc[:args.legacy_rows]
+    legacy_chunk = stand_in_chunk(cameras)
+    start = time.perf_counter()
+    legacy_import(legacy_chunk, rows)
+    legacy = time.perf_counter() - start
+    estimate = legacy * len(projections) / len(rows)
+    print(f"Previous import: {legacy:8.3f} s for {len(rows)} rows, " +\
+          f"~{estimate:.1f} s for all projections (~{estimate / projected:.0f}x slower)")
+
+    # both approaches yield the same projections
+    check = stand_in_chunk(cameras)
+    add_marker_projections(chunk_index(check), rows, lambda x, y: ((x, y), True), logger)
+    same = {m.label: {c.label: p for c, p in m.projections.items()} for m in check.markers} == \
+        {m.label: {c.label: p for c, p in m.projections.items()} for m in legacy_chunk.markers}
+    print(f"Identical projections on the subset: {same}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the marker detection executor backends (process, thread, serial).
+
+Generates one set of synthetic photos (see synthetic.py), runs the full
+marker_detection on it with every backend (each in a fresh process), and
+reports images/s and the peak RSS per backend, verifying that all backends
+yield identical results.
+Runs offline, without Metashape, e.g.:
+
+    python benchmarks/bench_detection_backends.py --images 40 --megapixels 24 --workers 4
+"""
+
+# import standard libs
+import sys
+import argparse
+import logging
+import resource
+import tempfile
+import time
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+from cv2 import aruco
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from automated_metashape.ImageMarkers import marker_detection, _detection_backends
+from automated_metashape.ImageCoordinates import read_image_coordinates
+from bench_marker_detection import detection_config
+from synthetic import generate_scenes
+
+def run_backend(cfg, backend):
+    """
+    Runs marker_detection with the given backend, returning the elapsed time,
+    the (sorted) detected markers and the peak RSS in MB of the largest 
+    process involved. Meant to be run in a fresh process per backend.
+    """
+    cfg["detectGCPs"]["backend"] = backend
+    start = time.perf_counter()
+    detection = marker_detection(cfg, logger = logging.getLogger("benchmark"))
+    elapsed = time.perf_counter() - start
+
+    markers = read_image_coordinates(detection.output_file).sort_values(["camera", "marker"])
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        )
+    return elapsed, markers.reset_index(drop = True), peak / 1024
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description = __doc__.split("\n\n")[0])
+    parser.add_argument("--images", type = int, default = 20)
+    parser.add_argument("--megapixels", type = float, default = 12)
+    parser.add_argument("--markers", type = int, default = 8, help = "markers per image")
+    parser.add_argument("--folders", type = int, default = 1)
+    parser.add_argument("--dict", default = "DICT_4X4_50", help = "OpenCV ArUcO dictionary")
+    parser.add_argument("--format", default = "jpg", choices = ["jpg", "tif"])
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--workers", type = int, default = None)
+    parser.add_argument("--corner", default = "centre")
+    parser.add_argument("--loader", default = "grayscale")
+    parser.add_argument("--reduction", type = int, default = 1)
+    parser.add_argument("--pyramid", type = float, default = None, help = "pyramid scale (disabled if not set)")
+    parser.add_argument("--tracking", action = "store_true")
+    parser.add_argument("--backends", nargs = "+", default = list(_detection_backends),
+                        choices = list(_detection_backends))
+    args = parser.parse_args(argv)
+    args.output_format = "csv"
+
+    logging.basicConfig(level = logging.WARNING, format = '%(asctime)s [%(levelname)s] %(name)s: %(message)s')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        truth = generate_scenes(
+            tmp, args.images, args.megapixels, args.markers, getattr(aruco, args.dict),
+            args.folders, seed = args.seed, image_format = args.format
+            )
+        print(f"Generated {args.images} images of {args.megapixels} MP with {len(truth)} markers.\n")
+
+        cfg = detection_config(Path(tmp), args)
+        reference = None
+        for backend in args.backends:
+            with ProcessPoolExecutor(1) as executor:
+                elapsed, markers, peak = executor.submit(run_backend, cfg, backend).result()
+            if reference is None:
+                reference = markers
+            identical = markers.equals(reference)
+            print(f"  {backend:<8} {elapsed:8.2f} s {args.images / elapsed:8.2f} images/s " +\
+                  f"{peak:8.1f} MB peak RSS   {'identical' if identical else 'DIFFERENT'} results")
+
+if __name__ == "__main__":
+    main()
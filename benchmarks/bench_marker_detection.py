@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the marker detection pipeline on synthetic scenes.
+
+Generates synthetic photos with ArUcO markers at known positions (see
+synthetic.py), runs _assign_marker_coordinates_on_image on a subset of them
+to profile the individual stages, runs the full marker_detection on all of
+them, and reports images/s, per-stage timings (decode, detect, geometry,
+write), peak RSS and the detection accuracy against the ground truth.
+Runs offline, without Metashape, e.g.:
+
+    python benchmarks/bench_marker_detection.py --images 40 --megapixels 24
+"""
+
+# import standard libs
+import sys
+import argparse
+import logging
+import resource
+import tempfile
+import time
+from pathlib import Path
+
+# import calc and image libs
+import numpy as np
+from cv2 import aruco
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from automated_metashape.ImageMarkers import marker_detection, _assign_marker_coordinates_on_image, detection_settings
+from automated_metashape.PhotoDiscovery import find_photos
+from automated_metashape.ImageCoordinates import read_image_coordinates, output_formats
+from synthetic import generate_scenes
+
+_truth_columns = {
+    "topleft": "c1", "topright": "c2", "bottomright": "c3", "bottomleft": "c4"
+    }
+
+def detection_config(photo_path, args):
+    """
+    Builds the configuration (as returned by read_yaml) for marker_detection.
+    """
+    cfg = {
+        "photo_path": photo_path,
+        "detectGCPs": {
+            "enabled": True,
+            "photo_path": photo_path,
+            "aruco_dict": getattr(aruco, args.dict),
+            "corner": args.corner,
+            "workers": args.workers,
+            "image_loader": args.loader,
+            "image_reduction": args.reduction,
+            "output_format": args.output_format,
+            }
+        }
+    if args.pyramid:
+        cfg["detectGCPs"]["pyramid"] = {"enabled": True, "scale": args.pyramid}
+    if args.tracking:
+        cfg["detectGCPs"]["tracking"] = {"enabled": True}
+    return cfg
+
+def profile_stages(photo_files, cfg):
+    """
+    Runs the detection serially on photo_files, returning the mean time per
+    stage.
+    """
+    settings = detection_settings(cfg)
+    settings.pop("tracking")
+    totals = {}
+    for filename in photo_files:
+        timings = {}
+        _assign_marker_coordinates_on_image(filename, timings = timings, **settings)
+        for stage, value in timings.items():
+            totals[stage] = totals.get(stage, 0) + value
+    return {stage: value / len(photo_files) for stage, value in totals.items()}
+
+def accuracy(output_file, truth, corner):
+    """
+    Compares the detected marker positions against the ground truth.
+    """
+    detected = read_image_coordinates(output_file).rename(columns = {"camera": "filename"})
+    column = _truth_columns.get(corner, "centre")
+    merged = truth.merge(detected, on = ["marker", "filename"], how = "outer", indicator = True)
+    found = merged[merged["_merge"] == "both"]
+    error = np.hypot(found["x"] - found[f"{column}_x"], found["y"] - found[f"{column}_y"])
+    return {
+        "markers": len(truth),
+        "detected": len(found),
+        "missed": int((merged["_merge"] == "left_only").sum()),
+        "false_positives": int((merged["_merge"] == "right_only").sum()),
+        "mean_error_px": float(error.mean()) if len(found) else float("nan"),
+        "max_error_px": float(error.max()) if len(found) else float("nan"),
+        }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description = __doc__.split("\n\n")[0])
+    parser.add_argument("--images", type = int, default = 20)
+    parser.add_argument("--megapixels", type = float, default = 12)
+    parser.add_argument("--markers", type = int, default = 8, help = "markers per image")
+    parser.add_argument("--folders", type = int, default = 1)
+    parser.add_argument("--dict", default = "DICT_4X4_50", help = "OpenCV ArUcO dictionary")
+    parser.add_argument("--marker-size", type = int, nargs = 2, default = (80, 300), help = "min/max marker side (px)")
+    parser.add_argument("--rotation", type = float, default = 180, help = "max marker rotation (deg)")
+    parser.add_argument("--noise", type = float, default = 12, help = "background noise (std)")
+    parser.add_argument("--drift", type = float, default = 0, help = "marker drift per image (px), for sequences")
+    parser.add_argument("--format", default = "jpg", choices = ["jpg", "tif"])
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--workers", type = int, default = None)
+    parser.add_argument("--corner", default = "centre", choices = ["centre", *_truth_columns])
+    parser.add_argument("--loader", default = "grayscale")
+    parser.add_argument("--reduction", type = int, default = 1)
+    parser.add_argument("--pyramid", type = float, default = None, help = "pyramid scale (disabled if not set)")
+    parser.add_argument("--tracking", action = "store_true")
+    parser.add_argument("--output-format", default = "csv", choices = output_formats)
+    parser.add_argument("--profile", type = int, default = 5, help = "images to profile serially")
+    parser.add_argument("--keep", type = Path, default = None, help = "directory to keep the scenes in")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level = logging.WARNING, format = '%(asctime)s [%(levelname)s] %(name)s: %(message)s')
+    logger = logging.getLogger("benchmark")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        photo_path = args.keep or Path(tmp)
+
+        start = time.perf_counter()
+        truth = generate_scenes(
+            photo_path, args.images, args.megapixels, args.markers, getattr(aruco, args.dict),
+            args.folders, tuple(args.marker_size), args.rotation, args.noise, args.drift,
+            args.format, args.seed
+            )
+        print(f"Generated {args.images} images of {args.megapixels} MP with {len(truth)} markers " +\
+              f"in {time.perf_counter() - start:.1f} s.")
+
+        cfg = detection_config(photo_path, args)
+        profile = profile_stages(find_photos(photo_path)[:args.profile], cfg)
+        print("\nSerial profile (mean per image):")
+        for stage, value in profile.items():
+            print(f"  {stage:<10} {value:8.4f} s")
+
+        start = time.perf_counter()
+        detection = marker_detection(cfg, logger = logger)
+        elapsed = time.perf_counter() - start
+
+        print(f"\nmarker_detection: {args.images} images in {elapsed:.2f} s " +\
+              f"({args.images / elapsed:.2f} images/s)")
+        for stage, value in detection.stage_times.items():
+            print(f"  {stage:<10} {value / args.images:8.4f} s per image")
+        print(f"  peak RSS   {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:8.1f} MB (main), " +\
+              f"{resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024:.1f} MB (largest worker)")
+
+        print("\nAccuracy:")
+        for key, value in accuracy(detection.output_file, truth, args.corner).items():
+            print(f"  {key:<16} {value:.3f}" if isinstance(value, float) else f"  {key:<16} {value}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the spatial image pair selection for matchPhotos on stand-in
+cameras.
+
+Builds stand-in cameras along a synthetic corridor survey (parallel flight
+lines with GPS noise), and selects the image pairs to match from their
+positions with SpatialPairs, with the KD-tree (if scipy is installed) and
+with the brute force fallback. Reports the number of pairs against the
+exhaustive number of pairs. Runs offline, without Metashape, e.g.:
+
+    python benchmarks/bench_spatial_pairs.py --cameras 8000 --neighbours 20
+"""
+
+# import standard libs
+import sys
+import argparse
+import logging
+import time
+from pathlib import Path
+
+# import calc libs
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from automated_metashape import SpatialPairs
+from automated_metashape.SpatialPairs import camera_pairs
+
+class stand_in():
+    """
+    Minimal stand-in for Metashape cameras.
+    """
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+def corridor_cameras(n_cameras, lines = 3, spacing = 5., line_spacing = 30., noise = 2., seed = 0):
+    """
+    Returns stand-in cameras (key, position) of a corridor survey: lines
+    parallel flight lines, with photos every spacing metres.
+    """
+    rng = np.random.default_rng(seed)
+    per_line = -(-n_cameras // lines)
+    along = np.tile(np.arange(per_line) * spacing, lines)[:n_cameras]
+    across = np.repeat(np.arange(lines) * line_spacing, per_line)[:n_cameras]
+    positions = np.column_stack([along, across, np.full(n_cameras, 100.)]) + rng.normal(0, noise, (n_cameras, 3))
+    return [stand_in(key = i, position = tuple(p)) for i, p in enumerate(positions)]
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split("\n\n")[0])
+    parser.add_argument("--cameras", type = int, default = 8000)
+    parser.add_argument("--lines", type = int, default = 3)
+    parser.add_argument("--neighbours", type = int, default = 20, help = "k nearest neighbours per camera")
+    parser.add_argument("--radius", type = float, default = None, help = "maximum distance of a pair (m)")
+    parser.add_argument("--seed", type = int, default = 0)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level = logging.WARNING, format = '%(asctime)s [%(levelname)s] %(name)s: %(message)s')
+    logger = logging.getLogger("benchmark")
+
+    cameras = corridor_cameras(args.cameras, args.lines, seed = args.seed)
+    exhaustive = args.cameras * (args.cameras - 1) // 2
+    print(f"{args.cameras} cameras on {args.lines} flight lines, {exhaustive} exhaustive pairs.\n")
+
+    results = {}
+    backends = [("KD-tree", SpatialPairs.cKDTree), ("brute force", None)] if SpatialPairs.cKDTree else [("brute force", None)]
+    kd_tree = SpatialPairs.cKDTree
+    for name, tree in backends:
+        SpatialPairs.cKDTree = tree
+        start = time.perf_counter()
+        pairs = camera_pairs(cameras, lambda camera: camera.position, args.neighbours, args.radius, logger)
+        elapsed = time.perf_counter() - start
+        results[name] = set(pairs)
+        print(f"{name:12s} {elapsed:8.3f} s: {len(pairs)} pairs ({len(pairs) / exhaustive:.3%} of exhaustive, " +\
+              f"{2 * len(pairs) / args.cameras:.1f} per camera)")
+    SpatialPairs.cKDTree = kd_tree
+
+    if len(results) > 1:
+        print(f"\nIdentical pairs: {len(set(map(frozenset, results.values()))) == 1}")
+
+if __name__ == "__main__":
+    main()
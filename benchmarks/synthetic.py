@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic test scenes for benchmarking the marker detection pipeline.
+
+ArUcO markers of the configured dictionary are rendered at known positions,
+scales and rotations onto noisy backgrounds, and the ground truth corners
+of every marker are stored alongside the images. No Metashape is required.
+"""
+
+# import standard libs
+import os
+from pathlib import Path
+
+# import calc and image libs
+import numpy as np
+import cv2
+from cv2 import aruco
+import pandas as pd
+
+from automated_metashape.ImageMarkers import legacy_aruco_api
+
+def _render_marker(dictionary, marker_id, side):
+    if legacy_aruco_api:
+        return aruco.drawMarker(dictionary, marker_id, side)
+    return aruco.generateImageMarker(dictionary, marker_id, side)
+
+def _background(rng, height, width, noise):
+    """
+    Terrain-like background: smooth random texture plus pixel noise.
+    """
+    coarse = rng.normal(128, 40, (height // 32 + 1, width // 32 + 1)).astype(np.float32)
+    texture = cv2.resize(coarse, (width, height), interpolation = cv2.INTER_CUBIC)
+    texture += rng.normal(0, noise, (height, width)).astype(np.float32)
+    return np.clip(texture, 0, 255).astype(np.uint8)
+
+def generate_scenes(output_dir, n_images=20, megapixels=12, markers_per_image=8,
+                    aruco_dict=aruco.DICT_4X4_50, folders=1, marker_size=(80, 300),
+                    rotation=180, noise=12, drift=0, image_format="jpg", seed=0):
+    """
+    Generates n_images synthetic photos of megapixels (4:3) in the
+    {output_dir}/{1XXMEDIA}/{photo} layout expected by the marker detection,
+    spread over the given number of folders.
+
+    Every image contains markers_per_image markers with a side length (in
+    pixels) drawn from marker_size and a rotation of up to +/- rotation
+    degrees, each placed in its own cell of a jittered grid. If drift is
+    non-zero, all images of a folder contain the same markers, moving by
+    about drift pixels per image, as in a sequentially captured series.
+    image_format is jpg or tif, the formats matched by
+    PhotoDiscovery.photo_filter.
+
+    Returns the ground truth as a DataFrame with the marker, filename (as
+    {folder}/{photo}) and the x/y coordinates of the four corners (c1-c4, in
+    the OpenCV order) and the centre of every marker.
+    """
+    if image_format.lower() not in ("jpg", "tif"):
+        raise ValueError(f"Unsupported image format {image_format}, use jpg or tif.")
+    rng = np.random.default_rng(seed)
+    dictionary = aruco.getPredefinedDictionary(aruco_dict)
+    n_ids = dictionary.bytesList.shape[0]
+    if markers_per_image > n_ids:
+        raise ValueError(f"Dictionary only contains {n_ids} markers.")
+
+    width = int(round(np.sqrt(megapixels * 1e6 * 4 / 3)))
+    height = int(round(width * 3 / 4))
+    columns = int(np.ceil(np.sqrt(markers_per_image * width / height)))
+    rows = int(np.ceil(markers_per_image / columns))
+    cell = min(width / columns, height / rows)
+
+    truth = []
+    for f in range(folders):
+        folder = f"{100 + f}MEDIA"
+        os.makedirs(Path(output_dir, folder), exist_ok = True)
+        n_folder = n_images // folders + (f < n_images % folders)
+
+        # sequence state, used if drift is set
+        ids = rng.choice(n_ids, markers_per_image, replace = False)
+        cells = rng.choice(rows * columns, markers_per_image, replace = False)
+        sides = rng.uniform(*marker_size, markers_per_image)
+        angles = rng.uniform(-rotation, rotation, markers_per_image)
+        jitter = rng.uniform(-0.5, 0.5, (markers_per_image, 2))
+        velocity = rng.normal(0, 1, (markers_per_image, 2))
+
+        for k in range(n_folder):
+            filename = f"IMG_{k:04d}.{image_format.upper()}"
+            image = _background(rng, height, width, noise)
+
+            if not drift:
+                ids = rng.choice(n_ids, markers_per_image, replace = False)
+                cells = rng.choice(rows * columns, markers_per_image, replace = False)
+                sides = rng.uniform(*marker_size, markers_per_image)
+                angles = rng.uniform(-rotation, rotation, markers_per_image)
+                jitter = rng.uniform(-0.5, 0.5, (markers_per_image, 2))
+
+            for m in range(markers_per_image):
+                side = min(sides[m], cell / 2.5)
+                render = int(max(side, 40))
+                border = render // 4
+                marker = cv2.copyMakeBorder(
+                    _render_marker(dictionary, int(ids[m]), render),
+                    border, border, border, border, cv2.BORDER_CONSTANT, value = 255
+                    )
+
+                # marker centre in its grid cell, moving with the sequence
+                room = cell / 2 - side * 1.07
+                centre = np.array([
+                    (cells[m] % columns + 0.5) * cell,
+                    (cells[m] // columns + 0.5) * cell
+                    ]) + jitter[m] * room
+                if drift:
+                    centre += np.clip(velocity[m] * drift * k, -room, room)
+
+                # affine transform of the (bordered) marker image into the scene
+                scale = side / render
+                M = cv2.getRotationMatrix2D(
+                    ((marker.shape[1] - 1) / 2, (marker.shape[0] - 1) / 2), float(angles[m]), scale
+                    )
+                M[:, 2] += centre - M[:, :2] @ [(marker.shape[1] - 1) / 2, (marker.shape[0] - 1) / 2]
+                warped = cv2.warpAffine(marker, M, (width, height), flags = cv2.INTER_AREA)
+                mask = cv2.warpAffine(np.full_like(marker, 255), M, (width, height), flags = cv2.INTER_NEAREST)
+                image[mask > 0] = warped[mask > 0]
+
+                # pixel-edge corners of the black marker square
+                lo, hi = border - 0.5, border + render - 0.5
+                corners = np.array([[lo, lo], [hi, lo], [hi, hi], [lo, hi]]) @ M[:, :2].T + M[:, 2]
+                midpoints = (corners + np.roll(corners, -1, axis = 0)) / 2
+                row = {"marker": int(ids[m]), "filename": f"{folder}/{filename}"}
+                for i, (x, y) in enumerate(corners, 1):
+                    row[f"c{i}_x"], row[f"c{i}_y"] = x, y
+                row["centre_x"], row["centre_y"] = midpoints.mean(axis = 0)
+                truth.append(row)
+
+            cv2.imwrite(str(Path(output_dir, folder, filename)), image)
+
+    truth = pd.DataFrame(truth)
+    truth.to_csv(Path(output_dir, "ground_truth.csv"), index = False)
+    return truth
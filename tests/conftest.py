@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+"""
+Shared setup of the tests, which run offline, without Metashape, on
+synthetic data (see benchmarks/synthetic.py).
+"""
+
+# import standard libs
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "benchmarks"))
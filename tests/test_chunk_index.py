@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the chunk index with stand-in cameras (Metashape is not needed).
+"""
+
+from automated_metashape.ChunkIndex import chunk_index
+
+class _photo():
+    def __init__(self, path):
+        self.path = path
+
+class _camera():
+    def __init__(self, label, enabled = True, aligned = False):
+        self.label = label
+        self.enabled = enabled
+        self.transform = object() if aligned else None
+        self.photo = _photo(f"/photos/100MEDIA/{label}.JPG")
+
+class _chunk():
+    def __init__(self, cameras):
+        self.cameras = cameras
+        self.markers = []
+
+def test_unaligned_cameras_are_enabled_cameras_only():
+    cameras = [_camera("a"), _camera("b", enabled = False), _camera("c", aligned = True)]
+    index = chunk_index(_chunk(cameras))
+
+    assert index.unaligned_cameras == [cameras[0]]
+    # e.g. disabled by pruneDuplicates after the index was built
+    index.set_enabled([cameras[0]], False)
+    assert index.unaligned_cameras == []
+
+def test_camera_paths_are_cached_until_invalidated():
+    cameras = [_camera("a"), _camera("b")]
+    index = chunk_index(_chunk(cameras))
+
+    assert index.camera_paths == {cameras[0]: "/photos/100MEDIA/a.JPG", cameras[1]: "/photos/100MEDIA/b.JPG"}
+    assert index.cameras_of(["/photos/100MEDIA/b.JPG"]) == [cameras[1]]
+
+    cameras[0].photo = _photo("/photos/101MEDIA/a.JPG")
+    assert index.camera_paths[cameras[0]] == "/photos/100MEDIA/a.JPG"
+    index.invalidate("paths", "photos")
+    assert index.camera_paths[cameras[0]] == "/photos/101MEDIA/a.JPG"
+
+def test_new_photos_skips_the_planes_of_multi_plane_cameras():
+    # e.g. a multispectral camera, with a photo per band
+    camera = _camera("IMG_0001_1")
+    camera.planes = [camera] + [_camera(f"IMG_0001_{band}") for band in (2, 3)]
+    index = chunk_index(_chunk([camera]))
+    bands = [f"/photos/100MEDIA/IMG_0001_{band}.JPG" for band in (1, 2, 3)]
+
+    assert index.new_photos(bands + ["/photos/100MEDIA/IMG_0002_1.JPG"]) == ["/photos/100MEDIA/IMG_0002_1.JPG"]
+    assert index.cameras_of(bands) == [camera]
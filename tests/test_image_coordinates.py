@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of appending to the columnar image coordinate table.
+"""
+
+# import calc libs
+import numpy as np
+
+from automated_metashape.ImageCoordinates import image_coordinate_store, read_image_coordinates, _list_parts
+
+_record = np.dtype([("marker", np.int32), ("x", np.float32), ("y", np.float32), ("dictionary", np.int16)])
+
+def _records(*markers):
+    return np.array([(marker, marker * 10, marker * 20, 0) for marker in markers], dtype = _record)
+
+def _append(path, rows, cameras = None, max_parts = 8):
+    with image_coordinate_store(path, "npz", append = True, max_parts = max_parts) as store:
+        if cameras is not None:
+            store.retain(cameras)
+        for camera, markers in rows.items():
+            store.write(camera, _records(*markers))
+    return store.path
+
+def _table(path):
+    df = read_image_coordinates(path)
+    return {camera: sorted(group["marker"]) for camera, group in df.groupby("camera")}
+
+def test_appending_all_photos_replaces_earlier_parts(tmp_path):
+    # e.g. repeat runs without the detection cache
+    for _ in range(5):
+        path = _append(tmp_path / "coords", {"100MEDIA/a.JPG": [1, 2], "100MEDIA/b.JPG": [3]})
+
+    assert len(_list_parts(path)) == 1
+    assert _table(path) == {"100MEDIA/a.JPG": [1, 2], "100MEDIA/b.JPG": [3]}
+
+def test_appending_compacts_parts(tmp_path):
+    path = _append(tmp_path / "coords", {"100MEDIA/a.JPG": [1]})
+    for k in range(5):
+        _append(tmp_path / "coords", {f"100MEDIA/{k}.JPG": [k + 2]}, max_parts = 3)
+
+    assert len(_list_parts(path)) <= 3
+    assert _table(path) == {"100MEDIA/a.JPG": [1], **{f"100MEDIA/{k}.JPG": [k + 2] for k in range(5)}}
+
+def test_appending_drops_deleted_photos(tmp_path):
+    path = _append(tmp_path / "coords", {"100MEDIA/a.JPG": [1], "100MEDIA/b.JPG": [2]})
+    # b.JPG was deleted, c.JPG is new and a.JPG is taken from the first part
+    _append(tmp_path / "coords", {"100MEDIA/c.JPG": [3]}, cameras = ["100MEDIA/a.JPG", "100MEDIA/c.JPG"])
+
+    assert len(_list_parts(path)) == 1
+    assert _table(path) == {"100MEDIA/a.JPG": [1], "100MEDIA/c.JPG": [3]}
+
+def test_appending_keeps_images_without_markers_superseded(tmp_path):
+    path = _append(tmp_path / "coords", {"100MEDIA/a.JPG": [1], "100MEDIA/b.JPG": [2]})
+    _append(tmp_path / "coords", {"100MEDIA/a.JPG": []})
+
+    assert _table(path) == {"100MEDIA/b.JPG": [2]}
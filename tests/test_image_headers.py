@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the header readers used by the photo pre-scan.
+"""
+
+# import standard libs
+import struct
+
+# import calc and image libs
+import numpy as np
+import cv2
+
+from automated_metashape.ImageHeaders import read_image_header
+
+def _jpeg(path, trailer = b''):
+    image = np.random.default_rng(0).integers(0, 255, (240, 320), dtype = np.uint8)
+    ok, data = cv2.imencode(".jpg", image)
+    path.write_bytes(data.tobytes() + trailer)
+    return data.tobytes()
+
+def test_jpeg_with_trailer_is_complete(tmp_path):
+    # e.g. a maker trailer appended after the end of image
+    _jpeg(tmp_path / "trailer.jpg", b'\x00' * 16 + b'MAKER' * 4000)
+    header = read_image_header(tmp_path / "trailer.jpg")
+    assert (header["width"], header["height"], header["complete"]) == (320, 240, True)
+    assert cv2.imread(str(tmp_path / "trailer.jpg")) is not None
+
+def test_truncated_jpeg_is_incomplete(tmp_path):
+    data = _jpeg(tmp_path / "full.jpg")
+    (tmp_path / "truncated.jpg").write_bytes(data[:len(data) // 2])
+    assert read_image_header(tmp_path / "full.jpg")["complete"]
+    assert not read_image_header(tmp_path / "truncated.jpg")["complete"]
+
+def _bigtiff(path, width, height, truncate = 0):
+    pixels = bytes(width * height)
+    entries = [
+        (256, 3, 1, struct.pack('<H6x', width)),
+        (257, 3, 1, struct.pack('<H6x', height)),
+        (271, 2, 8, b'TestCam\x00'),
+        (273, 16, 1, struct.pack('<Q', 16 + 8 + 5 * 20 + 8)),
+        (279, 16, 1, struct.pack('<Q', len(pixels))),
+        ]
+    ifd = struct.pack('<Q', len(entries)) + b''.join(struct.pack('<HHQ', *e[:3]) + e[3] for e in entries)
+    data = b'II+\x00' + struct.pack('<HHQ', 8, 0, 16) + ifd + struct.pack('<Q', 0) + pixels
+    path.write_bytes(data[:len(data) - truncate])
+
+def test_bigtiff_header(tmp_path):
+    _bigtiff(tmp_path / "big.tif", 64, 32)
+    _bigtiff(tmp_path / "truncated.tif", 64, 32, truncate = 100)
+    header = read_image_header(tmp_path / "big.tif")
+    assert (header["width"], header["height"], header["make"], header["complete"]) == (64, 32, "TestCam", True)
+    assert not read_image_header(tmp_path / "truncated.tif")["complete"]
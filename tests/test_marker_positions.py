@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests of the marker positions computed from the detected corners,
+against fixed values and against the previous pandas implementation.
+"""
+
+# import calc and image libs
+import numpy as np
+import pandas as pd
+import pytest
+from cv2 import aruco
+
+from automated_metashape.ImageMarkers import marker_detection, _marker_positions, _detect_marker_corners
+from automated_metashape.ImageCoordinates import read_image_coordinates
+from automated_metashape.ImageIO import load_grayscale
+from synthetic import generate_scenes
+
+_corners = ["topleft", "topright", "bottomright", "bottomleft", None]
+
+def _reference_positions(corners, ids, corner = None):
+    """
+    The marker positions as computed before _marker_positions, with a
+    MultiIndex unstack/stack round-trip. Returns the (marker, x, y) arrays.
+    """
+    corners2 = np.array([c[0] for c in corners])
+    data = pd.DataFrame(
+        {"x": corners2[:,:,0].flatten(),
+        "y": corners2[:,:,1].flatten()},
+        index = pd.MultiIndex.from_product(
+            [ids.flatten(), ["c{0}".format(i )for i in np.arange(4)+1]],
+            names = ["marker", ""]
+            )
+        )
+    data = data.unstack().swaplevel(0, 1, axis = 1).stack()
+    data["m1"] = data[["c1", "c2"]].mean(axis = 1)
+    data["m2"] = data[["c2", "c3"]].mean(axis = 1)
+    data["m3"] = data[["c3", "c4"]].mean(axis = 1)
+    data["m4"] = data[["c4", "c1"]].mean(axis = 1)
+    data["centre"] = data[["m1", "m2", "m3", "m4"]].mean(axis = 1)
+    data = data.reset_index()
+
+    column = {"topleft": "c1", "topright": "c2", "bottomright": "c3", "bottomleft": "c4"}.get(corner, "centre")
+    return (
+        data[data['level_1']=='x'].marker.values,
+        data[data['level_1']=='x'][column].values,
+        data[data['level_1']=='y'][column].values,
+        )
+
+def _as_detected(corners):
+    # the OpenCV layout: a list of (1, 4, 2) float32 arrays
+    return [np.array([c], dtype = np.float32) for c in corners]
+
+def test_marker_positions_fixed_values():
+    corners = _as_detected([
+        [[10, 20], [30, 20], [30, 40], [10, 40]],
+        [[100.5, 200], [140, 210], [130.25, 250], [90, 240]],
+        ])
+    ids = np.array([[7], [3]])
+
+    expected = {
+        "topleft": [(3, 100.5, 200), (7, 10, 20)],
+        "topright": [(3, 140, 210), (7, 30, 20)],
+        "bottomright": [(3, 130.25, 250), (7, 30, 40)],
+        "bottomleft": [(3, 90, 240), (7, 10, 40)],
+        None: [(3, 115.1875, 225), (7, 20, 30)],
+        }
+    for corner in _corners:
+        records = _marker_positions(corners, ids, corner)
+        assert records[["marker", "x", "y"]].tolist() == expected[corner]
+
+def test_marker_positions_duplicate_ids():
+    # e.g. a marker that is visible twice, or a false positive with the same id
+    corners = _as_detected([
+        [[10, 20], [30, 20], [30, 40], [10, 40]],
+        [[50, 60], [70, 60], [70, 80], [50, 80]],
+        [[0, 0], [2, 0], [2, 2], [0, 2]],
+        ])
+    ids = np.array([[5], [2], [5]])
+
+    records = _marker_positions(corners, ids)
+    # all markers are kept, duplicates in the order of detection
+    assert records[["marker", "x", "y"]].tolist() == [(2, 60, 70), (5, 20, 30), (5, 1, 1)]
+    # the previous implementation could not unstack duplicate ids
+    with pytest.raises(ValueError):
+        _reference_positions(corners, ids)
+
+@pytest.fixture(scope = "module")
+def scenes(tmp_path_factory):
+    photo_path = tmp_path_factory.mktemp("scenes")
+    truth = generate_scenes(photo_path, n_images = 6, megapixels = 2, markers_per_image = 6,
+                            marker_size = (60, 160), seed = 3)
+    return photo_path, truth
+
+def test_marker_positions_match_previous_implementation(scenes):
+    photo_path, truth = scenes
+    for filename in truth.filename.unique():
+        corners, ids = _detect_marker_corners(load_grayscale(photo_path / filename), aruco.DICT_4X4_50)
+        assert ids is not None
+        for corner in _corners:
+            records = _marker_positions(corners, ids, corner)
+            marker, x, y = _reference_positions(corners, ids, corner)
+            assert np.array_equal(records["marker"], marker)
+            # bit-identical
+            assert np.array_equal(records["x"], x) and np.array_equal(records["y"], y)
+
+def test_image_coordinate_table_matches_previous_implementation(scenes):
+    photo_path, truth = scenes
+    cfg = {
+        "photo_path": photo_path,
+        "detectGCPs": {
+            "photo_path": photo_path,
+            "aruco_dict": aruco.DICT_4X4_50,
+            "corner": "center",
+            "backend": "serial",
+            }
+        }
+    marker_detection(cfg)
+    df = read_image_coordinates(photo_path / "gcps" / "prepared" / "gcp_imagecoords_table.csv")
+
+    assert sorted(df.camera.unique()) == sorted(truth.filename.unique())
+    for camera, rows in df.groupby("camera", sort = False):
+        corners, ids = _detect_marker_corners(load_grayscale(photo_path / camera), aruco.DICT_4X4_50)
+        marker, x, y = _reference_positions(corners, ids)
+        assert np.array_equal(rows["marker"], marker)
+        assert np.array_equal(rows["x"], x) and np.array_equal(rows["y"], y)
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the sequence-aware marker tracking against full frame detection.
+"""
+
+# import standard libs
+from pathlib import Path
+
+# import calc and image libs
+import numpy as np
+import cv2
+from cv2 import aruco
+
+from automated_metashape.ImageMarkers import marker_detection
+from synthetic import generate_scenes
+
+def _detect(photo_path, tracking = None):
+    cfg = {
+        "photo_path": photo_path,
+        "detectGCPs": {
+            "photo_path": photo_path,
+            "aruco_dict": aruco.DICT_4X4_50,
+            "corner": "center",
+            "backend": "serial",
+            }
+        }
+    if tracking is not None:
+        cfg["detectGCPs"]["tracking"] = tracking
+    df = marker_detection(cfg).image_coordinates
+    return df.sort_values(["camera", "marker"]).reset_index(drop = True)
+
+def _hide_marker(photo_path, truth, marker, filenames):
+    """
+    Paints over a marker in some of the photos, so that it enters the field
+    of view mid-sequence.
+    """
+    for filename in filenames:
+        row = truth[(truth.marker == marker) & (truth.filename == filename)].iloc[0]
+        corners = np.array([[row[f"c{i}_x"], row[f"c{i}_y"]] for i in range(1, 5)])
+        centre, side = corners.mean(axis = 0), np.abs(corners - corners.mean(axis = 0)).max()
+        image = cv2.imread(str(Path(photo_path, filename)))
+        cv2.circle(image, tuple(int(v) for v in centre), int(2 * side), (128, 128, 128), -1)
+        cv2.imwrite(str(Path(photo_path, filename)), image)
+
+def test_tracking_matches_full_frame_detection(tmp_path):
+    # a marker entering the field of view in the fifth photo
+    truth = generate_scenes(tmp_path, n_images = 8, megapixels = 2, markers_per_image = 4,
+                            marker_size = (100, 140), drift = 10, image_format = "jpg", seed = 1)
+    entering = truth.marker.iloc[0]
+    _hide_marker(tmp_path, truth, entering, [f"100MEDIA/IMG_{k:04d}.JPG" for k in range(4)])
+
+    full = _detect(tmp_path)
+    tracked = _detect(tmp_path, {"enabled": True})
+
+    assert len(full) == len(truth) - 4
+    assert full[["camera", "marker"]].equals(tracked[["camera", "marker"]])
+    assert np.allclose(full[["x", "y"]], tracked[["x", "y"]], atol = 1e-3)
+
+def test_tracking_without_scan_misses_entering_marker(tmp_path):
+    truth = generate_scenes(tmp_path, n_images = 8, megapixels = 2, markers_per_image = 4,
+                            marker_size = (100, 140), drift = 10, image_format = "jpg", seed = 1)
+    _hide_marker(tmp_path, truth, truth.marker.iloc[0], [f"100MEDIA/IMG_{k:04d}.JPG" for k in range(4)])
+
+    # without the scan, only a keyframe picks up the entering marker
+    assert len(_detect(tmp_path, {"enabled": True, "scan_scale": None})) < len(truth) - 4
+    assert len(_detect(tmp_path, {"enabled": True, "scan_scale": None, "keyframe_interval": 1})) == len(truth) - 4
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the near-duplicate detection on flat, vignetted (e.g. snow) photos.
+"""
+
+# import standard libs
+from pathlib import Path
+
+# import calc and image libs
+import numpy as np
+import cv2
+import pytest
+
+from automated_metashape.PhotoDuplicates import photo_hashes, find_duplicates
+
+HEIGHT, WIDTH = 600, 800
+
+def _low_contrast(seed):
+    """
+    A bright, low-contrast photo with strong vignetting, which dominates the
+    image content.
+    """
+    rng = np.random.default_rng(seed)
+    coarse = rng.normal(0, 1, (HEIGHT // 40 + 1, WIDTH // 40 + 1)).astype(np.float32)
+    texture = cv2.resize(coarse, (WIDTH, HEIGHT), interpolation = cv2.INTER_CUBIC) * 3
+    y, x = np.mgrid[0:HEIGHT, 0:WIDTH]
+    vignetting = 1 - 0.5 * ((x - WIDTH / 2)**2 + (y - HEIGHT / 2)**2) / ((WIDTH / 2)**2 + (HEIGHT / 2)**2)
+    return (220 + texture + rng.normal(0, 2, (HEIGHT, WIDTH))) * vignetting
+
+def _write(folder, images):
+    folder.mkdir(parents = True, exist_ok = True)
+    photo_files = []
+    for i, image in enumerate(images):
+        photo_files.append(str(Path(folder, f"IMG_{i:04d}.JPG")))
+        cv2.imwrite(photo_files[-1], np.clip(image, 0, 255).astype(np.uint8))
+    return photo_files
+
+def _burst(seed, n):
+    """
+    A burst of near-duplicates, e.g. of a hovering drone: small shifts and
+    sensor noise.
+    """
+    image = _low_contrast(seed)
+    return [np.roll(image, (i, 2 * i), axis = (0, 1)) + np.random.default_rng(i).normal(0, 2, image.shape)
+            for i in range(n)]
+
+def test_distinct_low_contrast_photos_are_kept(tmp_path):
+    photo_files = _write(tmp_path / "100MEDIA", [_low_contrast(seed) for seed in range(30)])
+    hashes = photo_hashes(photo_files, workers = 2)
+
+    assert find_duplicates(hashes) == {}
+    # not even by hash alone
+    assert find_duplicates(hashes, max_sequence_gap = len(photo_files)) == {}
+
+def test_near_duplicates_are_clustered(tmp_path):
+    photo_files = _write(tmp_path / "100MEDIA", _burst(100, 4))
+    clusters = find_duplicates(photo_hashes(photo_files, workers = 2))
+
+    assert len(clusters) == 1
+    kept, duplicates = next(iter(clusters.items()))
+    assert sorted([kept] + duplicates) == photo_files
+
+def test_duplicates_need_nearby_positions(tmp_path):
+    photo_files = _write(tmp_path / "100MEDIA", _burst(100, 4))
+    hashes = photo_hashes(photo_files, workers = 2)
+
+    # every photo 10 m from the previous one
+    positions = {filename: (10.0 * i, 0.0, 0.0) for i, filename in enumerate(photo_files)}
+    assert find_duplicates(hashes, positions = positions, max_offset = 2) == {}
+    assert len(find_duplicates(hashes, positions = positions, max_offset = 50)) == 1
+
+def test_duplicates_need_a_sequence_or_position_constraint():
+    with pytest.raises(ValueError):
+        find_duplicates({}, max_sequence_gap = None)
+
+def test_sequence_restarts_in_every_folder(tmp_path):
+    burst = _burst(100, 4)
+    # a burst split over two folders
+    photo_files = _write(tmp_path / "100MEDIA", burst[:2]) + _write(tmp_path / "101MEDIA", burst[2:])
+    clusters = find_duplicates(photo_hashes(photo_files, workers = 2))
+
+    assert len(clusters) == 2
+    for kept, duplicates in clusters.items():
+        assert [Path(d).parent for d in duplicates] == [Path(kept).parent]
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the conversion of the YML configuration file.
+"""
+
+# import standard libs
+import pathlib
+
+# import calc and image libs
+from cv2 import aruco
+
+from automated_metashape.read_yaml import read_yaml
+
+def test_lists_keep_plain_items(tmp_path):
+    config_file = pathlib.Path(tmp_path, "config.yml")
+    config_file.write_text(
+        "detectGCPs:\n"
+        "  photo_path: photos\n"
+        "  aruco_dict: [aruco.DICT_4X4_50, aruco.DICT_5X5_100]\n"
+        "  gpkg:\n"
+        "    bounds: [15.5, 78.1, 15.9, 78.3]\n"
+        "    accuracy_columns: [dx, dy, dz]\n"
+        "masks:\n"
+        "  cameras: [0, 1, 2]\n"
+        )
+    cfg = read_yaml(config_file)
+
+    assert cfg["detectGCPs"]["photo_path"] == pathlib.Path("photos")
+    assert cfg["detectGCPs"]["aruco_dict"] == [aruco.DICT_4X4_50, aruco.DICT_5X5_100]
+    assert cfg["detectGCPs"]["gpkg"]["bounds"] == [15.5, 78.1, 15.9, 78.3]
+    assert cfg["detectGCPs"]["gpkg"]["accuracy_columns"] == ["dx", "dy", "dz"]
+    assert cfg["masks"]["cameras"] == [0, 1, 2]
+
+def test_only_constants_are_evaluated(tmp_path):
+    config_file = pathlib.Path(tmp_path, "config.yml")
+    config_file.write_text(
+        "detectGCPs:\n"
+        "  aruco_dict: cv2.aruco.DICT_6X6_250\n"
+        "  label: aruco markers (Metashape)\n"
+        "  labels: [aruco_board_1, Metashape markers, cv2.aruco.DICT_4X4_50]\n"
+        )
+    cfg = read_yaml(config_file)
+
+    assert cfg["detectGCPs"]["aruco_dict"] == aruco.DICT_6X6_250
+    assert cfg["detectGCPs"]["label"] == "aruco markers (Metashape)"
+    assert cfg["detectGCPs"]["labels"] == ["aruco_board_1", "Metashape markers", aruco.DICT_4X4_50]
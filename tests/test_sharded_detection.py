@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the sharded marker detection, with local worker processes acting as
+the nodes, against a single node detection run.
+"""
+
+# import calc and image libs
+from cv2 import aruco
+
+from automated_metashape.ImageMarkers import marker_detection
+from automated_metashape.ImageCoordinates import read_image_coordinates
+from automated_metashape.ShardedDetection import (
+    sharded_detection, create_manifest, claim_shard, shard_done, load_manifest, _shard_path
+    )
+from synthetic import generate_scenes
+
+def _config(photo_path, **detect_gcps):
+    return {
+        "photo_path": photo_path,
+        "detectGCPs": {
+            "photo_path": photo_path,
+            "aruco_dict": aruco.DICT_4X4_50,
+            "corner": "center",
+            "backend": "serial",
+            **detect_gcps
+            }
+        }
+
+def _sorted(df):
+    return df.sort_values(["camera", "marker", "x"]).reset_index(drop = True)
+
+def test_sharded_detection_matches_single_node(tmp_path):
+    generate_scenes(tmp_path, n_images = 14, megapixels = 1, markers_per_image = 4,
+                    marker_size = (60, 120), folders = 2, seed = 4)
+    single = _sorted(read_image_coordinates(marker_detection(_config(tmp_path)).output_file))
+
+    cfg = _config(tmp_path, sharding = {"enabled": True, "shards": 5, "local_nodes": 2, "workers_per_node": 1})
+    merged = _sorted(read_image_coordinates(sharded_detection(cfg)))
+
+    manifest_path = tmp_path / "gcps" / "shards" / "manifest.json"
+    _, shards = load_manifest(manifest_path)
+    assert len(shards) == 5 and sum(map(len, shards)) == 14
+    assert all(shard_done(manifest_path, index) for index in range(len(shards)))
+    assert len(single) > 0
+    assert merged.equals(single)
+
+def test_shards_are_claimed_once(tmp_path):
+    generate_scenes(tmp_path, n_images = 4, megapixels = 0.5, markers_per_image = 2, seed = 5)
+    manifest_path = create_manifest(_config(tmp_path), shards = 2)
+
+    assert claim_shard(manifest_path, 0)
+    assert not claim_shard(manifest_path, 0)
+    assert claim_shard(manifest_path, 1)
+    # abandoned claims can be taken over
+    assert claim_shard(manifest_path, 0, claim_timeout = 0)
+    assert _shard_path(manifest_path, 0).with_suffix(".claim").exists()
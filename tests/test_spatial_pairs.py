@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the spatial image pair selection with stand-in cameras, against a
+reference computed from all camera distances.
+"""
+
+# import calc libs
+import numpy as np
+import pytest
+
+from automated_metashape import SpatialPairs
+from automated_metashape.SpatialPairs import neighbour_pairs, camera_pairs, geodetic_to_geocentric
+
+class _camera():
+    def __init__(self, key):
+        self.key = key
+
+def _reference_pairs(positions, k = None, radius = None):
+    distances = np.linalg.norm(positions[:, None] - positions[None, :], axis = 2)
+    np.fill_diagonal(distances, np.inf)
+    pairs = set()
+    for i in range(len(positions)):
+        neighbours = np.argsort(distances[i])[:k] if k is not None else np.arange(len(positions))
+        pairs.update(tuple(sorted((i, int(j)))) for j in neighbours
+                     if radius is None or distances[i, j] <= radius)
+    return sorted(pairs)
+
+def _corridor(n, seed = 0):
+    # a corridor survey: 3 km long, 40 m wide, 100 m above the ground
+    rng = np.random.default_rng(seed)
+    return np.column_stack([np.linspace(0, 3000, n), rng.uniform(-20, 20, n), 100 + rng.normal(0, 2, n)])
+
+@pytest.fixture(params = ["kdtree", "bruteforce"])
+def search(request, monkeypatch):
+    if request.param == "kdtree":
+        pytest.importorskip("scipy")
+    else:
+        monkeypatch.setattr(SpatialPairs, "cKDTree", None)
+    return request.param
+
+@pytest.mark.parametrize("k, radius", [(5, None), (5, 30.0), (None, 30.0)])
+def test_neighbour_pairs_match_reference(search, k, radius):
+    positions = _corridor(300)
+    pairs = neighbour_pairs(positions, k, radius)
+
+    assert [tuple(pair) for pair in pairs.tolist()] == _reference_pairs(positions, k, radius)
+
+def test_bruteforce_spans_several_blocks():
+    positions = _corridor(1200, seed = 1)
+    pairs = SpatialPairs._neighbour_pairs_bruteforce(positions, k = 4)
+    pairs = np.unique(np.sort(pairs, axis = 1), axis = 0)
+
+    assert [tuple(pair) for pair in pairs.tolist()] == _reference_pairs(positions, k = 4)
+
+def test_camera_pairs_of_stand_in_cameras(search):
+    positions = _corridor(50)
+    cameras = [_camera(100 + i) for i in range(len(positions))]
+    # the last two cameras have no position
+    locate = lambda camera: None if camera.key >= 148 else positions[camera.key - 100]
+    pairs = camera_pairs(cameras, locate, k = 3)
+
+    located = {(100 + i, 100 + j) for i, j in _reference_pairs(positions[:48], k = 3)}
+    unlocated = {(a, b) for a in (148, 149) for b in range(100, 148)} | {(148, 149)}
+    assert len(pairs) == len(set(pairs))
+    assert set(pairs) == located | unlocated
+
+def test_camera_pairs_needs_two_positions():
+    cameras = [_camera(key) for key in range(3)]
+    assert camera_pairs(cameras, lambda camera: None if camera.key else (0, 0, 0)) is None
+
+def test_geodetic_to_geocentric_distances():
+    # one arc second of latitude is about 31.0 m at 78 degrees north
+    a = np.array(geodetic_to_geocentric(15.6, 78.2, 10))
+    b = np.array(geodetic_to_geocentric(15.6, 78.2 + 1 / 3600, 10))
+    assert np.linalg.norm(a - b) == pytest.approx(31.0, abs = 0.05)